@@ -11,6 +11,7 @@ from props import getNode
 from lib import matcher
 from lib import match_cleanup
 from lib import project
+from lib import tracks
 
 # Reset all match point locations to their original direct
 # georeferenced locations based on estimated camera pose and
@@ -67,6 +68,6 @@ matches_direct = match_cleanup.make_match_structure(proj)
 #direct_file = os.path.join(proj.analysis_dir, "matches_direct")
 #pickle.dump(matches_direct, open(direct_file, "wb"))
 
-matches_grouped = match_cleanup.link_matches(proj, matches_direct)
-print("Writing full group chain matches_grouped file ...")
-pickle.dump(matches_grouped, open(os.path.join(proj.analysis_dir, "matches_grouped"), "wb"))
+matches_grouped = match_cleanup.link_tracks(proj, matches_direct)
+print("Writing full group chain tracks ...")
+tracks.save(tracks.tracks_dir(proj.analysis_dir), matches_grouped)
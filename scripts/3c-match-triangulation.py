@@ -4,7 +4,6 @@ import argparse
 import cv2
 import numpy as np
 import os
-import pickle
 from tqdm import tqdm
 
 from props import getNode
@@ -16,6 +15,7 @@ from lib.logger import log
 from lib import project
 from lib import match_cleanup
 from lib import srtm
+from lib import tracks
 
 parser = argparse.ArgumentParser(description='Keypoint projection.')
 parser.add_argument('project', help='project directory')
@@ -26,9 +26,9 @@ args = parser.parse_args()
 proj = project.ProjectMgr(args.project)
 proj.load_images_info()
 
-source = 'matches_grouped'
-print("Loading source matches:", source)
-matches = pickle.load( open( os.path.join(proj.analysis_dir, source), 'rb' ) )
+source = tracks.migrate(proj.analysis_dir)
+print("Loading source tracks:", source)
+matches = tracks.load(source)
 
 # load the group connections within the image set
 group_list = groups.load(proj.analysis_dir)
@@ -132,35 +132,37 @@ if args.method == 'srtm':
     #     for i in bad_indices:
     #         del matches[i]
 elif args.method == 'triangulate':
-    for i, match in enumerate(matches):
-        if match[1] == args.group: # used in current group
-            # print(match)
-            points = []
-            vectors = []
-            for m in match[2:]:
-                if proj.image_list[m[0]].name in group_list[args.group]:
-                    # print(m)
-                    image = proj.image_list[m[0]]
-                    cam2body = image.get_cam2body()
-                    body2ned = image.get_body2ned()
-                    ned, ypr, quat = image.get_camera_pose(opt=True)
-                    uv_list = [ undistort(m[1]) ] # just one uv element
-                    vec_list = project.projectVectors(IK, body2ned, cam2body, uv_list)
-                    points.append( ned )
-                    vectors.append( vec_list[0] )
-                    # print(' ', image.name)
-                    # print(' ', uv_list)
-                    # print('  ', vec_list)
-            if len(points) >= 2:
-                # print('points:', points)
-                # print('vectors:', vectors)
-                p = line_solver.ls_lines_intersection(points, vectors, transpose=True).tolist()
-                # print('result:',  p, p[0])
-                print(i, match[0], '>>>', end=" ")
-                match[0] = [ p[0][0], p[1][0], p[2][0] ]
-                if p[2][0] > 0:
-                    print("WHOA!")
-                print(match[0])
+    ned_list = np.array(matches.ned)
+    for i in np.flatnonzero(matches.group == args.group): # used in current group
+        # print(i)
+        points = []
+        vectors = []
+        start, end = matches.offsets[i], matches.offsets[i+1]
+        for m in zip(matches.obs_img[start:end], matches.obs_uv[start:end]):
+            if proj.image_list[m[0]].name in group_list[args.group]:
+                # print(m)
+                image = proj.image_list[m[0]]
+                cam2body = image.get_cam2body()
+                body2ned = image.get_body2ned()
+                ned, ypr, quat = image.get_camera_pose(opt=True)
+                uv_list = [ undistort(m[1]) ] # just one uv element
+                vec_list = project.projectVectors(IK, body2ned, cam2body, uv_list)
+                points.append( ned )
+                vectors.append( vec_list[0] )
+                # print(' ', image.name)
+                # print(' ', uv_list)
+                # print('  ', vec_list)
+        if len(points) >= 2:
+            # print('points:', points)
+            # print('vectors:', vectors)
+            p = line_solver.ls_lines_intersection(points, vectors, transpose=True).tolist()
+            # print('result:',  p, p[0])
+            print(i, ned_list[i], '>>>', end=" ")
+            ned_list[i] = [ p[0][0], p[1][0], p[2][0] ]
+            if p[2][0] > 0:
+                print("WHOA!")
+            print(ned_list[i])
+    matches.ned = ned_list
     
 print("Writing:", source)
-pickle.dump(matches, open(os.path.join(proj.analysis_dir, source), "wb"))
+tracks.save(source, matches, ['ned'])
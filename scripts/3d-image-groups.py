@@ -4,11 +4,12 @@
 # connections to each other cannot be correctly placed.
 
 import argparse
-import pickle
+import numpy as np
 import os.path
 
 from lib import groups
 from lib import project
+from lib import tracks
 
 parser = argparse.ArgumentParser(description='Keypoint projection.')
 parser.add_argument('project', help='project directory')
@@ -17,9 +18,9 @@ args = parser.parse_args()
 proj = project.ProjectMgr(args.project)
 proj.load_images_info()
 
-source = 'matches_grouped'
-print("Loading source matches:", source)
-matches = pickle.load( open( os.path.join(proj.analysis_dir, source), 'rb' ) )
+source = tracks.migrate(proj.analysis_dir)
+print("Loading source tracks:", source)
+matches = tracks.load(source, ['offsets', 'obs_img'])
 
 print("features:", len(matches))
 
@@ -35,14 +36,11 @@ print()
 
 # debug
 print("Counting allocated features...")
-count = 0
-for i, match in enumerate(matches):
-    if match[1] >= 0:
-        count += 1
+count = np.count_nonzero(matches.group >= 0)
 
 print("Writing:", source, "...")
 print("Features: %d/%d" % (count, len(matches)))
-pickle.dump(matches, open(os.path.join(proj.analysis_dir, source), "wb"))
+tracks.save(source, matches, ['group'])
 
 # this is extra (and I'll put it here for now for lack of a better
 # place), but for visualization's sake, create a gnuplot data file
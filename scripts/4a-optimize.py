@@ -5,7 +5,6 @@
 # collective data set.
 
 import argparse
-import pickle
 import cv2
 import math
 import numpy as np
@@ -15,6 +14,7 @@ from lib import camera
 from lib import groups
 from lib import optimizer
 from lib import project
+from lib import tracks
 from lib import transformations
 
 d2r = math.pi / 180.0
@@ -23,6 +23,8 @@ r2d = 180.0 / math.pi
 parser = argparse.ArgumentParser(description='Keypoint projection.')
 parser.add_argument('project', help='project directory')
 parser.add_argument('--group', type=int, default=0, help='group number')
+parser.add_argument('--all-groups', action='store_true', help='optimize every group (in parallel with --workers)')
+parser.add_argument('--workers', type=int, default=1, help='number of worker processes for --all-groups')
 parser.add_argument('--refine', action='store_true', help='refine a previous optimization.')
 parser.add_argument('--cam-calibration', action='store_true', help='include camera calibration in the optimization.')
 
@@ -31,15 +33,23 @@ args = parser.parse_args()
 proj = project.ProjectMgr(args.project)
 proj.load_images_info()
 
-source_file = os.path.join(proj.analysis_dir, 'matches_grouped' )
+source_file = tracks.migrate(proj.analysis_dir)
 print('Match file:', source_file)
-matches = pickle.load( open(source_file, "rb") )
+matches = tracks.load(source_file)
 print('Match features:', len(matches))
 
 # load the group connections within the image set
 group_list = groups.load(proj.analysis_dir)
 # sort from smallest to largest: groups.sort(key=len)
 
+if args.all_groups:
+    # optimize, refit and save every group
+    optimizer.optimize_all_groups(proj, group_list, source_file,
+                                  workers=args.workers,
+                                  optimized=args.refine,
+                                  cam_calib=args.cam_calibration)
+    quit()
+
 opt = optimizer.Optimizer(args.project)
 
 opt.setup( proj, group_list, args.group, matches, optimized=args.refine,
@@ -62,29 +72,29 @@ proj.save()
 #
 # each optimized group needs a separate/unique fit
 
-matches_opt = list(matches) # shallow copy
 refit_group_orientations = True
 if refit_group_orientations:
     opt.refit(proj, matches, group_list, args.group)
 else:
     # not refitting group orientations, just copy over optimized
     # coordinates
+    ned_list = np.array(matches.ned)
     for i, feat in enumerate(features):
         match_index = feat_index_map[i]
-        match = matches_opt[match_index]
-        match[0] = feat
+        ned_list[match_index] = feat
+    matches.ned = ned_list
 
-# write out the updated match_dict
-print('Updating matches file:', len(matches_opt), 'features')
-pickle.dump(matches_opt, open(source_file, 'wb'))
+# write out the updated track locations
+print('Updating matches file:', len(matches), 'features')
+tracks.save(source_file, matches, ['ned'])
 
 #camera.set_K(fx_opt/scale[0], fy_opt/scale[0], cu_opt/scale[0], cv_opt/scale[0], optimized=True)
 #proj.save()
 
 # temp write out just the points so we can plot them with gnuplot
 f = open(os.path.join(proj.analysis_dir, 'opt-plot.txt'), 'w')
-for m in matches_opt:
-    f.write('%.2f %.2f %.2f\n' % (m[0][0], m[0][1], m[0][2]))
+for ned in matches.ned:
+    f.write('%.2f %.2f %.2f\n' % (ned[0], ned[1], ned[2]))
 f.close()
 
 # temp write out direct and optimized camera positions
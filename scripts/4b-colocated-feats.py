@@ -5,13 +5,13 @@ import math
 import numpy as np
 import os.path
 from tqdm import tqdm
-import pickle
 
 from props import getNode
 
 from lib import groups
 from lib import project
 from lib import match_culling as cull
+from lib import tracks
 
 r2d = 180.0 / math.pi
 
@@ -31,10 +31,8 @@ if min_chain_len == 0:
     min_chain_len = 3
 print("Notice: min_chain_len is:", min_chain_len)
 
-#source = 'matches_direct'
-source = 'matches_grouped'
-print("Loading matches:", source)
-matches = pickle.load( open( os.path.join(proj.analysis_dir, source), "rb" ) )
+print("Loading matches:", tracks.tracks_dir(proj.analysis_dir))
+matches = tracks.load_matches(proj.analysis_dir)
 print('Number of original features:', len(matches))
 
 # load the group connections within the image set
@@ -102,6 +100,6 @@ if mark_sum > 0:
     if result == 'y' or result == 'Y':
         cull.delete_marked_features(matches, min_chain_len)
         # write out the updated match dictionaries
-        print("Writing original matches:", source)
-        pickle.dump(matches, open(os.path.join(proj.analysis_dir, source), "wb"))
+        print("Writing original matches:", tracks.tracks_dir(proj.analysis_dir))
+        tracks.save_matches(proj.analysis_dir, matches)
 
@@ -4,7 +4,6 @@
 # reprojection error
 
 import argparse
-import pickle
 import math
 import numpy as np
 import os
@@ -15,6 +14,7 @@ from lib import groups
 from lib import optimizer
 from lib import project
 from lib import match_culling as cull
+from lib import tracks
 
 parser = argparse.ArgumentParser(description='Keypoint projection.')
 parser.add_argument('project', help='project directory')
@@ -36,9 +36,9 @@ if min_chain_len == 0:
     min_chain_len = 3
 print("Notice: min_chain_len is:", min_chain_len)
 
-source = 'matches_grouped'
+source = tracks.tracks_dir(proj.analysis_dir)
 print("Loading matches:", source)
-matches = pickle.load( open( os.path.join(proj.analysis_dir, source), "rb" ) )
+matches = tracks.load_matches(proj.analysis_dir)
 print('Number of original features:', len(matches))
 
 # load the group connections within the image set
@@ -50,9 +50,11 @@ print()
 
 opt = optimizer.Optimizer(args.project)
 if args.initial_pose:
-    opt.setup( proj, group_list, args.group, matches, optimized=False )
+    opt.setup( proj, group_list, args.group, tracks.from_matches(matches),
+               optimized=False )
 else:
-    opt.setup( proj, group_list, args.group, matches, optimized=True )
+    opt.setup( proj, group_list, args.group, tracks.from_matches(matches),
+               optimized=True )
 x0 = np.hstack((opt.camera_params.ravel(), opt.points_3d.ravel(),
                 opt.K[0,0], opt.K[0,2], opt.K[1,2],
                 opt.distCoeffs))
@@ -191,5 +193,5 @@ if mark_sum > 0:
         cull.delete_marked_features(matches, min_chain_len, strong=args.strong)
         # write out the updated match dictionaries
         print("Writing:", source)
-        pickle.dump(matches, open(os.path.join(proj.analysis_dir, source), "wb"))
+        tracks.save_matches(proj.analysis_dir, matches)
 
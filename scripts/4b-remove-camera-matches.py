@@ -4,7 +4,6 @@
 # blunt hammer when something is going wrong with that image
 
 import argparse
-import pickle
 import os
 
 from props import getNode
@@ -12,6 +11,7 @@ from props import getNode
 from lib import groups
 from lib import project
 from lib import match_culling as cull
+from lib import tracks
 
 parser = argparse.ArgumentParser(description='Remove all matches referencing the specific image.')
 parser.add_argument('project', help='project directory')
@@ -23,8 +23,8 @@ args = parser.parse_args()
 proj = project.ProjectMgr(args.project)
 proj.load_images_info()
 
-print("Loading matches_grouped...")
-matches = pickle.load( open( os.path.join(proj.analysis_dir, "matches_grouped"), "rb" ) )
+print("Loading matches...")
+matches = tracks.load_matches(proj.analysis_dir)
 print("  features:", len(matches))
 
 # load the group connections within the image set
@@ -78,5 +78,5 @@ if count > 0:
         cull.delete_marked_features(matches, min_chain_len)
         print("Updating groups file")
         groups.save(proj.analysis_dir, group_list)
-        print("Writing: matches_grouped")
-        pickle.dump(matches, open(os.path.join(proj.analysis_dir, "matches_grouped"), "wb"))
+        print("Writing:", tracks.tracks_dir(proj.analysis_dir))
+        tracks.save_matches(proj.analysis_dir, matches)
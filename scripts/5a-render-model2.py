@@ -25,6 +25,7 @@ from lib import groups
 from lib import panda3d
 from lib import project
 from lib import srtm
+from lib import tracks
 from lib import transformations
 
 ac3d_steps = 8
@@ -53,7 +54,7 @@ ref = [ ref_node.getFloat('lat_deg'),
 srtm.initialize( ref, 6000, 6000, 30 )
 
 print("Loading optimized match points ...")
-matches = pickle.load( open( os.path.join(proj.analysis_dir, "matches_grouped"), "rb" ) )
+matches = tracks.load_matches(proj.analysis_dir)
 
 # load the group connections within the image set
 group_list = groups.load(proj.analysis_dir)
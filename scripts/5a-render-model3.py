@@ -28,6 +28,7 @@ from lib import groups
 from lib import panda3d
 from lib import project
 from lib import srtm
+from lib import tracks
 from lib import transformations
 
 mesh_steps = 8                  # 1 = corners only
@@ -59,7 +60,7 @@ srtm.initialize( ref, 6000, 6000, 30 )
 width, height = proj.cam.get_image_params()
 
 print("Loading optimized match points ...")
-matches = pickle.load( open( os.path.join(proj.analysis_dir, "matches_grouped"), "rb" ) )
+matches = tracks.load_matches(proj.analysis_dir)
 
 # load the group connections within the image set
 group_list = groups.load(proj.analysis_dir)
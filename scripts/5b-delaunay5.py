@@ -1,7 +1,6 @@
 #!/usr/bin/python3
 
 import argparse
-import pickle
 import cv2
 import fnmatch
 import itertools
@@ -13,6 +12,7 @@ import scipy.spatial
 
 from lib import groups
 from lib import project
+from lib import tracks
 from lib import transformations
 
 parser = argparse.ArgumentParser(description='Compute Delauney triangulation of matches.')
@@ -53,7 +53,7 @@ proj = project.ProjectMgr(args.project)
 proj.load_images_info()
 
 print("Loading optimized points ...")
-matches = pickle.load( open( os.path.join(proj.analysis_dir, "matches_grouped"), "rb" ) )
+matches = tracks.load(tracks.migrate(proj.analysis_dir), ['ned', 'group'])
 
 # load the group connections within the image set
 group_list = groups.load(proj.analysis_dir)
@@ -73,12 +73,9 @@ for image in proj.image_list:
 
 # elevation stats
 print("Computing stats...")
-ned_list = []
-for match in matches:
-    if match[1] == args.group:  # used by current group
-        ned_list.append(match[0])
-avg = -np.mean(np.array(ned_list)[:,2])
-std = np.std(np.array(ned_list)[:,2])
+ned_list = matches.ned[matches.group == args.group] # used by current group
+avg = -np.mean(ned_list[:,2])
+std = np.std(ned_list[:,2])
 print("Average elevation: %.2f" % avg)
 print("Standard deviation: %.2f" % std)
 
@@ -86,16 +83,14 @@ print("Standard deviation: %.2f" % std)
 print('Reading feature locations from optimized match points ...')
 global_raw_points = []
 global_raw_values = []
-for match in matches:
-    # if match[1] == args.group:  # used by current group
-    if match[1] >= 0:  # used by a group
-        ned = match[0]
-        diff = abs(-ned[2] - avg)
-        if diff < 5*std:
-            global_raw_points.append( [ned[1], ned[0]] )
-            global_raw_values.append( -ned[2] )
-        else:
-            print("Discarding match with excessive altitude:", match)
+# for ned in matches.ned[matches.group == args.group]: # used by current group
+for ned in matches.ned[matches.group >= 0].tolist(): # used by a group
+    diff = abs(-ned[2] - avg)
+    if diff < 5*std:
+        global_raw_points.append( [ned[1], ned[0]] )
+        global_raw_values.append( -ned[2] )
+    else:
+        print("Discarding match with excessive altitude:", ned)
 
 print('Generating Delaunay meshes ...')
 global_tri_list = scipy.spatial.Delaunay(np.array(global_raw_points))
@@ -127,7 +127,8 @@ print("Populating the cache directory with symbolic links.")
 for p in args.source:
     cache_src = os.path.join(p, "ImageAnalysis", "cache")
     for file in sorted(os.listdir(cache_src)):
-        if fnmatch.fnmatch(file, '*.feat') or fnmatch.fnmatch(file, '*.desc'):
+        if fnmatch.fnmatch(file, '*.feat') or fnmatch.fnmatch(file, '*.feat.npy') \
+           or fnmatch.fnmatch(file, '*.desc'):
             src = os.path.join(cache_src, file)
             dest = os.path.join(cache_dir, file)
             if os.path.exists(dest):
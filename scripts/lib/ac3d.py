@@ -20,28 +20,9 @@ def make_textures_opencv(src_dir, project_dir, image_list, resolution=256):
         print("Notice: creating texture directory =", dst_dir)
         os.makedirs(dst_dir)
     for image in image_list:
-        src = image.image_file
         dst = os.path.join(dst_dir, image.name + '.JPG')
         if not os.path.exists(dst):
-            print(src)
-            src = cv2.imread(src, flags=cv2.IMREAD_ANYCOLOR|cv2.IMREAD_ANYDEPTH|cv2.IMREAD_IGNORE_ORIENTATION)
-            height, width = src.shape[:2]
-            # downscale image first
-            method = cv2.INTER_AREA  # cv2.INTER_AREA
-            scale = cv2.resize(src, (0,0),
-                               fx=resolution/float(width),
-                               fy=resolution/float(height),
-                               interpolation=method)
-            # convert to hsv color space
-            hsv = cv2.cvtColor(scale, cv2.COLOR_BGR2HSV)
-            hue,sat,val = cv2.split(hsv)
-            # adaptive histogram equalization on 'value' channel
-            clahe = cv2.createCLAHE(clipLimit=3.0, tileGridSize=(8,8))
-            aeq = clahe.apply(val)
-            # recombine
-            hsv = cv2.merge((hue,sat,aeq))
-            # convert back to rgb
-            result = cv2.cvtColor(hsv, cv2.COLOR_HSV2BGR)
+            result = image.load_texture(resolution, equalize=True)
             cv2.imwrite(dst, result)
             print("Texture %dx%d %s" % (resolution, resolution, dst))
             
@@ -0,0 +1,73 @@
+# keep track of which images have their keypoints/descriptors loaded
+# and unload the least recently used ones when we go over a memory
+# budget (in bytes).  Images are evicted as soon as the budget is
+# exceeded (when another image is accessed), not on a timer.
+
+from collections import OrderedDict
+
+from props import getNode
+
+from .logger import qlog
+
+matcher_node = getNode('/config/matcher', True)
+
+# default budget if not specified in the config (2 Gb)
+default_budget = 2 * 1024 * 1024 * 1024
+
+budget = default_budget
+cache = OrderedDict()           # image name -> [image, bytes]
+total = 0
+
+# read the budget from the property tree (/config/matcher/cache_bytes)
+def configure():
+    global budget
+    if matcher_node.hasChild("cache_bytes"):
+        budget = matcher_node.getInt("cache_bytes")
+    else:
+        budget = default_budget
+
+# estimate the memory used by the image keypoints/descriptors and
+# their search indexes.  Descriptors that are memory mapped aren't
+# resident until they are touched, but the pages we read count against
+# the system just the same, so treat them as loaded.  The flann index
+# size is the estimate stored with it by matcher.get_flann_index().
+def image_bytes(image):
+    size = 0
+    if image.des_list is not None:
+        size += image.des_list.nbytes
+    if image.kp_array is not None:
+        size += image.kp_array.nbytes
+    if image.flann_index is not None:
+        size += image.flann_index[2]
+    if image.hash_index is not None:
+        size += image.hash_index.nbytes(image.des_list)
+    return size
+
+# mark the image as most recently used (call after loading its
+# features/descriptors) and evict the least recently used images if
+# we are over budget.  The most recent 'keep' images are never evicted
+# (i.e. both images of the pair currently being matched.)
+def touch(image, keep=2):
+    global total
+    if image.name in cache:
+        total -= cache[image.name][1]
+        cache.move_to_end(image.name)
+    size = image_bytes(image)
+    cache[image.name] = [image, size]
+    total += size
+    while total > budget and len(cache) > keep:
+        name, (oldest, size) = next(iter(cache.items()))
+        qlog("descriptor cache over budget (%.0f Mb), clearing: %s" % (total / (1024*1024), name))
+        evict(oldest)
+
+# unload the image keypoints/descriptors
+def evict(image):
+    global total
+    if image.name in cache:
+        total -= cache[image.name][1]
+        del cache[image.name]
+    image.kp_list = None
+    image.des_list = None
+    image.uv_list = None
+    image.flann_index = None
+    image.hash_index = None
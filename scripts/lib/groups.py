@@ -2,6 +2,7 @@
 # images with the most connections (features matches) to neighbors.
 
 import cv2
+import heapq
 import json
 import math
 import numpy as np
@@ -16,14 +17,46 @@ min_group = 10
 min_connections = 25
 max_wanted = 250                # possibly overridden later
 
-def my_add(placed_matches, matches, group_level, i):
-    # print("adding feature:", i)
-    for m in matches[i][2:]:
-        placed_matches[m[0]] += 1
-    matches[i][1] = group_level
+# which placed count threshold an image has reached.  The grouping
+# tests only depend on this (not the exact count.)
+def placed_level(count, max_wanted):
+    if count >= max_wanted:
+        return 3
+    elif count >= min_connections:
+        return 2
+    elif count > 0:
+        return 1
+    else:
+        return 0
+
+# add a feature to the group, returns the images that crossed a
+# placed count threshold
+def my_add(placed_matches, levels, chain, max_wanted):
+    # print("adding feature:", chain)
+    changed = []
+    for m in chain:
+        placed_matches[m] += 1
+        level = placed_level(placed_matches[m], max_wanted)
+        if level != levels[m]:
+            levels[m] = level
+            changed.append(m)
+    return changed
         
 # NEW GROUPING TEST
-def compute(image_list, matches):
+#
+# tracks needs the offsets and obs_img columns, the group column is
+# set to the group index of each track (-1 if unused.)
+#
+# Each group is grown by sweeping the features (in order) and adding
+# any feature that connects to the group so far, until a sweep adds
+# nothing.  Whether a feature gets added only depends on which placed
+# count threshold each of its images has reached (and the seed image),
+# so when a feature is added only the features sharing an image that
+# crossed a threshold are looked at again (found through the image ->
+# feature incidence.)
+# Later features are checked again in the same sweep, earlier ones in
+# the next sweep, so the result is the same as rescanning everything.
+def compute(image_list, tracks):
     # notice: we assume that matches have been previously sorted by
     # longest chain first!
     
@@ -42,12 +75,28 @@ def compute(image_list, matches):
     log("max features desired per image:", max_wanted)
     print("Notice: I should really work on this formula ...")
     
+    # image indices of each chain
+    n_images = len(image_list)
+    n_tracks = len(tracks)
+    offsets = tracks.offsets.tolist()
+    obs_img = np.asarray(tracks.obs_img)
+    obs_track = tracks.obs_track()
+    sizes = tracks.sizes()
+    img_list = obs_img.tolist()
+    chains = [ img_list[offsets[i]:offsets[i+1]] for i in range(n_tracks) ]
+    eligible = ((sizes > 2) | use_single_pairs).tolist()
+
+    # image -> feature incidence (CSR)
+    order = np.argsort(obs_img, kind='stable')
+    image_offsets = np.searchsorted(obs_img[order], np.arange(n_images + 1)).tolist()
+    image_tracks = obs_track[order].tolist()
+
     # mark all features as unaffiliated
-    for match in matches:
-        match[1] = -1
+    group = [ -1 ] * n_tracks
         
     # start with no placed images or features
     placed_images = set()
+    placed_mask = np.zeros(n_images, dtype=bool)
     groups = []
 
     done = False
@@ -55,82 +104,104 @@ def compute(image_list, matches):
         group_level = len(groups)
         log("Start of new group level:", group_level)
         
-        placed_matches = [0] * len(image_list)
+        placed_matches = [0] * n_images
+        levels = [0] * n_images
         
         # find the unused feature with the most connections to
-        # unplaced images
-        max_connections = 2
-        seed_index = -1
-        for i, match in enumerate(matches):
-            if match[1] < 0:
-                count = 0
-                connected = False
-                for m in match[2:]:
-                    if m[0] in placed_images:
-                        connected = True
-                    else:
-                        count += 1
-                if not connected and count > max_connections:
-                    max_connections = count
-                    seed_index = i
-        if seed_index == -1:
+        # unplaced images (and none to placed images)
+        unused = np.array(group) < 0
+        connected = np.bincount(obs_track[placed_mask[obs_img]],
+                                minlength=n_tracks) > 0
+        counts = np.where(unused & ~connected, sizes, 0)
+        seed_index = int(np.argmax(counts)) if n_tracks else -1
+        if seed_index == -1 or counts[seed_index] <= 2:
             break
+        max_connections = int(counts[seed_index])
         log("Seed index:", seed_index, "connections:", max_connections)
-        match = matches[seed_index]
-        m = match[3]            # first image referenced by match
-        # group_images.add(m[0])
-        my_add(placed_matches, matches, group_level, seed_index)
-        seed_image = m[0]
+        m = chains[seed_index][1] # first image referenced by match
+        # group_images.add(m)
+        my_add(placed_matches, levels, chains[seed_index], max_wanted)
+        group[seed_index] = group_level
+        seed_image = m
         log('Seeding group with:', image_list[seed_image].name)
 
+        # a feature with no images over a threshold (and not seeing
+        # the seed image) can't be added, so the first sweep only
+        # needs the features sharing an image with the seed
+        dirty = set()
+        for m in chains[seed_index]:
+            for j in image_tracks[image_offsets[m]:image_offsets[m+1]]:
+                if group[j] < 0 and eligible[j]:
+                    dirty.add(j)
+        dirty = sorted(dirty)
         still_working = True
         iteration = 0
         while still_working:
             log("Iteration:", iteration)
             still_working = False
-            for i, match in enumerate(matches):
-                if match[1] < 0 and (use_single_pairs or len(match[2:]) > 2):
-                    # determine if we should add this feature
-                    placed_count = 0
-                    placed_need_count = 0
-                    unplaced_count = 0
-                    seed_connection = False
-                    for m in match[2:]:
-                        if m[0] in placed_images:
-                            # placed in a previous grouping, skip
-                            continue
-                        if m[0] == seed_image:
-                            seed_connection = True
-                        if placed_matches[m[0]] >= max_wanted:
-                            placed_count += 1
-                        elif placed_matches[m[0]] >= min_connections:
-                            placed_count += 1
-                            placed_need_count += 1
-                        elif placed_matches[m[0]] > 0:
-                            placed_need_count += 1
-                        else:
-                            unplaced_count += 1
-                    # print("Match:", i, placed_count, seed_connection, placed_need_count, unplaced_count)
-                    if placed_count > 1 or seed_connection:
-                        if placed_need_count > 0 or unplaced_count > 0:
-                            my_add(placed_matches, matches, group_level, i)
-                            still_working = True
+            heap = dirty
+            queued = set(heap)
+            dirty = set()
+            while len(heap):
+                i = heapq.heappop(heap)
+                # determine if we should add this feature
+                placed_count = 0
+                placed_need_count = 0
+                unplaced_count = 0
+                seed_connection = False
+                for m in chains[i]:
+                    if m in placed_images:
+                        # placed in a previous grouping, skip
+                        continue
+                    if m == seed_image:
+                        seed_connection = True
+                    level = levels[m]
+                    if level == 3:
+                        placed_count += 1
+                    elif level == 2:
+                        placed_count += 1
+                        placed_need_count += 1
+                    elif level == 1:
+                        placed_need_count += 1
+                    else:
+                        unplaced_count += 1
+                # print("Match:", i, placed_count, seed_connection, placed_need_count, unplaced_count)
+                if placed_count > 1 or seed_connection:
+                    if placed_need_count > 0 or unplaced_count > 0:
+                        changed = my_add(placed_matches, levels, chains[i],
+                                         max_wanted)
+                        group[i] = group_level
+                        still_working = True
+                        # revisit the features sharing a changed image
+                        for m in changed:
+                            for j in image_tracks[image_offsets[m]:image_offsets[m+1]]:
+                                if group[j] >= 0 or not eligible[j]:
+                                    continue
+                                if j > i:
+                                    if not j in queued:
+                                        queued.add(j)
+                                        heapq.heappush(heap, j)
+                                else:
+                                    dirty.add(j)
+            dirty = sorted(dirty)
             iteration += 1
             
         # count up the placed images in this group
         group_images = set()
-        for i in range(len(image_list)):
+        for i in range(n_images):
             if placed_matches[i] >= min_connections:
                 group_images.add(i)
         group_list = []
         for i in list(group_images):
             placed_images.add(i)
+            placed_mask[i] = True
             group_list.append(image_list[i].name)
         if len(group_images) >= min_group:
             log(group_list)
             groups.append(group_list)
         if len(group_images) < 3:
             done = True
+    tracks.group = np.array(group, dtype=np.int32)
     return groups
 
 def save(path, groups):
@@ -17,8 +17,7 @@ templates = {}
 # resolution)
 def get_histogram_rgb(image, scale=0.25):
     print(image.name)
-    rgb = image.load_rgb()
-    scaled = cv2.resize(rgb, (0,0), fx=scale, fy=scale)
+    scaled = image.load_rgb(scale=scale)
     g, b, r = cv2.split(scaled)
     
     g_hist = np.bincount(g.ravel(), minlength=256)
@@ -5,13 +5,17 @@
 import pickle
 import cv2
 import gzip
+import hashlib
 import json
 import math
 #from matplotlib import pyplot as plt
 import navpy
 import numpy as np
 import os.path
+import struct
 import sys
+import threading
+import time
 
 from props import getNode
 
@@ -23,6 +27,183 @@ d2r = math.pi / 180.0
 r2d = 180.0 / math.pi
 
 detector = None
+max_features = 0                # per image feature budget (0 = unlimited)
+
+# tiled detection: neighboring tiles overlap by this many pixels so
+# features near tile edges are detected with their full support
+# region (only features inside the tile proper are kept)
+grid_overlap = 32
+
+# keypoints are stored as a numpy structured array (one record per
+# keypoint.)  cv2.KeyPoint objects are only built when an opencv call
+# needs them (see Image.kp_list)
+kp_dtype = np.dtype([ ('x', np.float32), ('y', np.float32),
+                      ('size', np.float32), ('angle', np.float32),
+                      ('response', np.float32),
+                      ('octave', np.int32), ('class_id', np.int32) ])
+
+def keypoints_to_array(kp_list):
+    kp_array = np.zeros(len(kp_list), dtype=kp_dtype)
+    for i, kp in enumerate(kp_list):
+        kp_array[i] = (kp.pt[0], kp.pt[1], kp.size, kp.angle, kp.response,
+                       kp.octave, kp.class_id)
+    return kp_array
+
+def array_to_keypoints(kp_array):
+    kp_list = []
+    for x, y, size, angle, response, octave, class_id in kp_array.tolist():
+        kp = cv2.KeyPoint(x, y, size, angle, response, octave, class_id)
+        kp_list.append(kp)
+    return kp_list
+
+# temp file name for writing path (unique per process and thread, the
+# prefetch threads may write cache files too)
+def tmp_name(path):
+    return path + ".%d.%d.tmp" % (os.getpid(), threading.get_ident())
+
+# legacy cache file conversions can be triggered from the main thread
+# and a prefetch thread at the same time, only one runs at a time
+migrate_lock = threading.Lock()
+
+# reduced resolution image cache (see pyramid.py): levels 1..N are
+# 1/2, 1/4, ... of the full image size plus fixed size square textures
+pyramid_levels = 3
+pyramid_version = 2             # levels are lossless copies of read_level()
+texture_sizes = [ 512, 1024 ]
+reduced_flags = { 2: cv2.IMREAD_REDUCED_COLOR_2,
+                  4: cv2.IMREAD_REDUCED_COLOR_4,
+                  8: cv2.IMREAD_REDUCED_COLOR_8 }
+reduced_gray_flags = { 2: cv2.IMREAD_REDUCED_GRAYSCALE_2,
+                       4: cv2.IMREAD_REDUCED_GRAYSCALE_4,
+                       8: cv2.IMREAD_REDUCED_GRAYSCALE_8 }
+
+# read the (width, height, components) of a jpeg file from its frame
+# header without decoding the image.  Returns None if the file isn't a
+# (readable) jpeg.
+def jpeg_header(path):
+    with open(path, 'rb') as fp:
+        if fp.read(2) != b'\xff\xd8':
+            return None
+        while True:
+            byte = fp.read(1)
+            if not byte:
+                return None
+            if byte != b'\xff':
+                continue
+            marker = fp.read(1)
+            while marker == b'\xff':
+                marker = fp.read(1)
+            if not marker:
+                return None
+            m = marker[0]
+            if m == 0x01 or 0xd0 <= m <= 0xd8:
+                continue        # markers without a segment
+            if m == 0xda:
+                return None     # start of scan, no frame header found
+            length = struct.unpack('>H', fp.read(2))[0]
+            if 0xc0 <= m <= 0xcf and m not in (0xc4, 0xc8, 0xcc):
+                precision, height, width, components = \
+                    struct.unpack('>BHHB', fp.read(6))
+                return width, height, components
+            fp.seek(length - 2, os.SEEK_CUR)
+
+# true if the jpeg header is for an image the reduced jpeg decoder
+# handles (8 bit gray or color)
+def reduced_jpeg(header):
+    return header is not None and header[2] in (1, 3)
+
+# halve the image level times (rounding up like the reduced jpeg
+# decoder does)
+def reduce_level(img, level):
+    for i in range(level):
+        h, w = img.shape[:2]
+        img = cv2.resize(img, ((w+1) // 2, (h+1) // 2),
+                         interpolation=cv2.INTER_AREA)
+    return img
+
+# read an image file at 1/2^level size.  8 bit jpegs are decoded
+# directly at the reduced size (in the DCT domain, much faster than
+# decoding the full image), other images are read at full size (any
+# depth) and halved.  Returns the image and the full resolution
+# (width, height).  The pyramid cache stores exactly these images so
+# detection results don't depend on whether it was built.
+def read_level(path, level):
+    header = None
+    if level > 0:
+        header = jpeg_header(path)
+    if reduced_jpeg(header):
+        w, h, components = header
+        if components == 1:
+            flags = reduced_gray_flags[1 << level]
+        else:
+            flags = reduced_flags[1 << level]
+        img = cv2.imread(path, flags=flags|cv2.IMREAD_IGNORE_ORIENTATION)
+    else:
+        flags = cv2.IMREAD_ANYCOLOR|cv2.IMREAD_ANYDEPTH|cv2.IMREAD_IGNORE_ORIENTATION
+        img = cv2.imread(path, flags=flags)
+        if img is not None:
+            h, w = img.shape[:2]
+            img = reduce_level(img, level)
+    if img is None:
+        raise IOError("cannot read image: " + path)
+    return img, (w, h)
+
+# adaptive histogram equalization of the value channel (essentially
+# gray scale level)
+def equalize_rgb(rgb):
+    clahe = cv2.createCLAHE(clipLimit=3.0, tileGridSize=(8,8))
+    hsv = cv2.cvtColor(rgb, cv2.COLOR_BGR2HSV)
+    hue, sat, val = cv2.split(hsv)
+    aeq = clahe.apply(val)
+    # recombine
+    hsv = cv2.merge((hue,sat,aeq))
+    # convert back to rgb
+    return cv2.cvtColor(hsv, cv2.COLOR_HSV2BGR)
+
+# keep the (up to) max_features strongest keypoints (and their
+# descriptors)
+def strongest_features(kp_array, des_list, max_features):
+    if max_features <= 0 or len(kp_array) <= max_features:
+        return kp_array, des_list
+    keep = np.sort(np.argsort(-kp_array['response'], kind='stable')[:max_features])
+    return kp_array[keep], des_list[keep]
+
+# run the detector separately on a grid_size x grid_size grid of
+# (overlapping) tile views of the image and keep the strongest
+# features of each tile.  This spreads the features evenly over the
+# image (low texture areas get their share) and bounds the total.
+def grid_detect(detector, image, grid_size, max_features):
+    h, w = image.shape[:2]
+    per_tile = 0
+    if max_features > 0:
+        per_tile = int(math.ceil(max_features / float(grid_size*grid_size)))
+    kp_parts = []
+    des_parts = []
+    for i in range(grid_size):
+        y0 = (h * i) // grid_size
+        y1 = (h * (i+1)) // grid_size
+        vy0 = max(0, y0 - grid_overlap)
+        vy1 = min(h, y1 + grid_overlap)
+        for j in range(grid_size):
+            x0 = (w * j) // grid_size
+            x1 = (w * (j+1)) // grid_size
+            vx0 = max(0, x0 - grid_overlap)
+            vx1 = min(w, x1 + grid_overlap)
+            kp_list, des_list = detector.detectAndCompute(image[vy0:vy1,vx0:vx1], None)
+            if des_list is None or not len(kp_list):
+                continue
+            kp_array = keypoints_to_array(kp_list)
+            kp_array['x'] += vx0
+            kp_array['y'] += vy0
+            core = (kp_array['x'] >= x0) & (kp_array['x'] < x1) \
+                & (kp_array['y'] >= y0) & (kp_array['y'] < y1)
+            kp_array, des_list = strongest_features(kp_array[core],
+                                                    des_list[core], per_tile)
+            kp_parts.append(kp_array)
+            des_parts.append(des_list)
+    if not len(kp_parts):
+        return np.zeros(0, dtype=kp_dtype), None
+    return np.concatenate(kp_parts), np.concatenate(des_parts)
 
 class Image():
     def __init__(self, analysis_dir=None, image_base=None):
@@ -33,9 +214,12 @@ class Image():
             self.name = None
         #self.img = None
         #self.img_rgb = None
-        self.kp_list = []       # opencv keypoint list
+        self.kp_array = np.zeros(0, dtype=kp_dtype) # keypoint records
+        self._kp_list = None    # opencv keypoint list (built on demand)
         self.kp_usage = []
         self.des_list = None      # opencv descriptor list
+        self.flann_index = None   # flann search index of des_list
+        self.hash_index = None    # cascade hashing index of des_list
         self.match_list = {}
 
         self.uv_list = []       # the 'undistorted' uv coordinates of all kp's
@@ -93,27 +277,77 @@ class Image():
             meta_dir = os.path.join(analysis_dir, 'meta')
             cache_dir = os.path.join(analysis_dir, 'cache')
             file_root = os.path.join(analysis_dir, 'meta', image_base)
-            self.features_file = os.path.join(cache_dir, image_base + ".feat")
+            self.features_file = os.path.join(cache_dir, image_base + ".feat.npy")
+            self.legacy_features_file = os.path.join(cache_dir, image_base + ".feat")
             self.desc_file = os.path.join(cache_dir, image_base + ".desc")
+            self.flann_file = os.path.join(cache_dir, image_base + ".flann")
+            self.uv_file = os.path.join(cache_dir, image_base + ".uv.npz")
+            self.pyramid_base = os.path.join(cache_dir, 'pyramid', image_base)
             self.match_file = os.path.join(meta_dir, image_base + ".match")
             
-    def load_rgb(self, equalize=False):
+    # the pyramid cache files for this image
+    def pyramid_file(self, level):
+        return self.pyramid_base + ".%d.png" % (1 << level)
+
+    def texture_file(self, resolution):
+        return self.pyramid_base + ".t%d.jpg" % resolution
+
+    def pyramid_info_file(self):
+        return self.pyramid_base + ".json"
+
+    # the pyramid cache is valid if it was built from the current
+    # version (size and modification time) of the source image
+    def pyramid_valid(self):
+        if self.image_file is None or not os.path.exists(self.pyramid_info_file()):
+            return False
+        try:
+            with open(self.pyramid_info_file(), 'r') as fp:
+                info = json.load(fp)
+        except:
+            return False
+        stat = os.stat(self.image_file)
+        return info.get('version') == pyramid_version \
+            and info['size'] == stat.st_size \
+            and info['mtime_ns'] == stat.st_mtime_ns
+
+    # load the image, optionally scaled down (and equalized.)  The
+    # smallest pyramid level that is at least as big as the requested
+    # scale is used (level=k asks for 1/2^k of the full size
+    # directly), from the pyramid cache if it is built or else with
+    # read_level().  Only the remainder is resized, and equalization
+    # is done after scaling so it only touches the pixels we keep.
+    # The full resolution image size is always saved in the image
+    # node.
+    def load_rgb(self, equalize=False, scale=1.0, level=None):
         # print("Loading:", self.image_file)
         try:
-            img_rgb = cv2.imread(self.image_file, flags=cv2.IMREAD_ANYCOLOR|cv2.IMREAD_ANYDEPTH|cv2.IMREAD_IGNORE_ORIENTATION)
-            if equalize:
-                # equalize val (essentially gray scale level)
-                clahe = cv2.createCLAHE(clipLimit=3.0, tileGridSize=(8,8))
-                hsv = cv2.cvtColor(img_rgb, cv2.COLOR_BGR2HSV)
-                hue, sat, val = cv2.split(hsv)
-                aeq = clahe.apply(val)
-                # recombine
-                hsv = cv2.merge((hue,sat,aeq))
-                # convert back to rgb
-                img_rgb = cv2.cvtColor(hsv, cv2.COLOR_HSV2BGR)
-            h, w = img_rgb.shape[:2]
+            if level is None:
+                level = 0
+                while level < pyramid_levels and scale <= 1.0 / (2 << level):
+                    level += 1
+            else:
+                scale = 1.0 / (1 << level)
+            # smaller requests are resized from the smallest level
+            level = min(level, pyramid_levels)
+            reduce = 1 << level
+            if level > 0 and self.pyramid_valid():
+                flags = cv2.IMREAD_ANYCOLOR|cv2.IMREAD_ANYDEPTH
+                img_rgb = cv2.imread(self.pyramid_file(level), flags=flags)
+                if img_rgb is None:
+                    raise IOError("cannot read pyramid level %d" % level)
+                with open(self.pyramid_info_file(), 'r') as fp:
+                    info = json.load(fp)
+                w, h = info['width'], info['height']
+            else:
+                img_rgb, (w, h) = read_level(self.image_file, level)
             self.node.setInt('height', h)
             self.node.setInt('width', w)
+            remainder = scale * reduce
+            if abs(remainder - 1.0) > 0.0001:
+                img_rgb = cv2.resize(img_rgb, (0,0), fx=remainder,
+                                     fy=remainder)
+            if equalize:
+                img_rgb = equalize_rgb(img_rgb)
             return img_rgb
 
         except:
@@ -121,6 +355,29 @@ class Image():
                 + str(sys.exc_info()[1]))
             return None
 
+    # the load_rgb() scale for making a resolution x resolution
+    # texture: the texture is resized from this to the exact size so
+    # both dimensions must still be at least as large as the texture.
+    def texture_scale(self, resolution):
+        width, height = camera.get_image_params()
+        if not width or not height:
+            return 1.0
+        return min(1.0, resolution / float(min(width, height)))
+
+    # load a resolution x resolution (square, stretched) texture of
+    # the image, from the pyramid cache when available
+    def load_texture(self, resolution, equalize=False):
+        if resolution in texture_sizes and self.pyramid_valid():
+            rgb = cv2.imread(self.texture_file(resolution),
+                             flags=cv2.IMREAD_COLOR)
+        else:
+            rgb = self.load_rgb(scale=self.texture_scale(resolution))
+            rgb = cv2.resize(rgb, (resolution, resolution),
+                             interpolation=cv2.INTER_AREA)
+        if equalize:
+            rgb = equalize_rgb(rgb)
+        return rgb
+
     def load_gray(self):
         #print "Loading " + self.image_file
         try:
@@ -138,40 +395,92 @@ class Image():
     def get_size(self):
         return self.node.getInt('width'), self.node.getInt('height')
     
+    # opencv keypoint list, built from the keypoint array the first
+    # time it is needed (only a few opencv calls need these, everything
+    # else should work directly with kp_array)
+    @property
+    def kp_list(self):
+        if self.kp_array is None:
+            return None
+        if self._kp_list is None:
+            self._kp_list = array_to_keypoints(self.kp_array)
+        return self._kp_list
+
+    @kp_list.setter
+    def kp_list(self, kp_list):
+        if kp_list is None:
+            self.kp_array = None
+        else:
+            self.kp_array = keypoints_to_array(kp_list)
+        self._kp_list = kp_list
+
+    # return the (distorted) keypoint uv coordinates as an Nx2 array
+    def kp_uv(self):
+        return np.stack((self.kp_array['x'], self.kp_array['y']), axis=1)
+
+    # keypoints are stored as a raw .npy structured array and memory
+    # mapped (read only.)  Legacy gzip/pickle .feat files are
+    # converted the first time they are loaded.
     def load_features(self):
+        if not os.path.exists(self.features_file) and \
+           os.path.exists(self.legacy_features_file):
+            with migrate_lock:
+                if not os.path.exists(self.features_file):
+                    self.migrate_features()
         if os.path.exists(self.features_file):
             #print "Loading " + self.features_file
             try:
-                fp = gzip.open(self.features_file, "rb")
-                feature_list = pickle.load(fp)
-                fp.close()
-                self.kp_list = []
-                for point in feature_list:
-                    kp = cv2.KeyPoint(x=point[0][0], y=point[0][1],
-                                      _size=point[1], _angle=point[2],
-                                      _response=point[3], _octave=point[4],
-                                      _class_id=point[5])
-                    self.kp_list.append(kp)
+                self.kp_array = np.load(self.features_file, mmap_mode='r')
+                self._kp_list = None
                 return True
             except:
                 print(self.features_file + ":\n" + "  feature load error: " \
                       + str(sys.exc_info()[0]) + ": " + str(sys.exc_info()[1]))
         return False
 
-    def load_descriptors(self):
+    # convert a legacy (gzip compressed pickle) feature file to the
+    # structured array format
+    def migrate_features(self):
+        qlog("Converting legacy feature file:", self.legacy_features_file)
+        try:
+            fp = gzip.open(self.legacy_features_file, "rb")
+            feature_list = pickle.load(fp)
+            fp.close()
+        except:
+            print(self.legacy_features_file + ":\n" + "  feature load error: " \
+                  + str(sys.exc_info()[0]) + ": " + str(sys.exc_info()[1]))
+            return
+        kp_array = np.zeros(len(feature_list), dtype=kp_dtype)
+        for i, point in enumerate(feature_list):
+            kp_array[i] = (point[0][0], point[0][1], point[1], point[2],
+                           point[3], point[4], point[5])
+        self.write_features(kp_array)
+        os.remove(self.legacy_features_file)
+
+    def write_features(self, kp_array):
+        tmp_file = tmp_name(self.features_file)
+        with open(tmp_file, 'wb') as fp:
+            np.save(fp, kp_array)
+        os.replace(tmp_file, self.features_file)
+
+    # descriptors are stored as an uncompressed .npy file and memory
+    # mapped (read only) so loading doesn't copy anything.  Older
+    # projects stored them gzip compressed, these are converted in
+    # place the first time they are loaded.  With mmap=False the file
+    # is read into memory right away (for background prefetching.)
+    def load_descriptors(self, mmap=True):
         if os.path.exists(self.desc_file):
             if self.des_list is None:
                 #print "Loading " + self.desc_file
                 try:
-                    fp = gzip.open(self.desc_file, 'rb')
-                    self.des_list = np.load(fp)
-                    fp.close()
-                    #print np.any(self.des_list)
-                    #val = "%s" % self.des_list
-                    #print
-                    #print "des_list.size =", self.des_list.size
-                    #print val
-                    #print
+                    if self.desc_compressed():
+                        with migrate_lock:
+                            if self.desc_compressed():
+                                self.migrate_descriptors()
+                    if mmap:
+                        self.des_list = np.load(self.desc_file, mmap_mode='r')
+                    else:
+                        self.des_list = np.load(self.desc_file)
                     return True
                 except:
                     print(self.desc_file + ":\n" + "  desc load error: " \
@@ -179,6 +488,28 @@ class Image():
         #else:
         #    print("no file:", self.desc_file)
         return False
+
+    def desc_compressed(self):
+        with open(self.desc_file, 'rb') as fp:
+            magic = fp.read(2)
+        return magic == b'\x1f\x8b'
+
+    # convert a gzip compressed descriptor file to the uncompressed
+    # (memory mappable) format
+    def migrate_descriptors(self):
+        qlog("Converting compressed descriptor file:", self.desc_file)
+        fp = gzip.open(self.desc_file, 'rb')
+        des_list = np.load(fp)
+        fp.close()
+        self.write_descriptors(des_list)
+
+    # write to a temp file and rename so a partially written file (or
+    # another process reading it) never sees a truncated file
+    def write_descriptors(self, des_list):
+        tmp_file = tmp_name(self.desc_file)
+        with open(tmp_file, 'wb') as fp:
+            np.save(fp, des_list)
+        os.replace(tmp_file, self.desc_file)
     
     def load_matches(self):
         try:
@@ -190,16 +521,8 @@ class Image():
             return
 
     def save_features(self):
-        # convert from native opencv kp class to a python list
-        feature_list = []
-        for kp in self.kp_list:
-            point = (kp.pt, kp.size, kp.angle, kp.response, kp.octave,
-                     kp.class_id)
-            feature_list.append(point)
         try:
-            fp = gzip.open(self.features_file, 'wb', compresslevel=6)
-            pickle.dump(feature_list, fp)
-            fp.close()
+            self.write_features(self.kp_array)
         except IOError as e:
             print("save_features(): I/O error({0}): {1}".format(e.errno, e.strerror))
             return
@@ -207,11 +530,8 @@ class Image():
             raise
 
     def save_descriptors(self):
-        # write descriptors as 'ppm image' format
         try:
-            fp = gzip.open(self.desc_file, 'wb', compresslevel=6)
-            result = np.save(fp, self.des_list)
-            fp.close()
+            self.write_descriptors(self.des_list)
         except:
             print(self.desc_file + ": error saving file: " \
                 + str(sys.exc_info()[1]))
@@ -228,12 +548,19 @@ class Image():
 
     def make_detector(self):
         global detector
+        global max_features
         
         detector_node = getNode('/config/detector', True)
+        max_features = 0
         if detector_node.getString('detector') == 'SIFT':
+            # (the feature budget is applied after detection so it
+            # also works per tile with grid detection)
             max_features = detector_node.getInt('sift_max_features')
-            #detector = cv2.xfeatures2d.SIFT_create(nfeatures=max_features)
-            detector = cv2.xfeatures2d.SIFT_create()
+            if hasattr(cv2, 'SIFT_create'):
+                # opencv >= 4.4
+                detector = cv2.SIFT_create()
+            else:
+                detector = cv2.xfeatures2d.SIFT_create()
         elif detector_node.getString('detector') == 'SURF':
             threshold = detector_node.getFloat('surf_hessian_threshold')
             nOctaves = detector_node.getInt('surf_noctaves')
@@ -249,40 +576,65 @@ class Image():
             suppressNonmaxSize = detector_node.getInt('star_suppress_nonmax_size')
             detector = cv2.xfeatures2d.StarDetector_create(maxSize, responseThreshold, lineThresholdProjected, lineThresholdBinarized, suppressNonmaxSize)
 
-    def orb_grid_detect_depricated(self, detector, image, grid_size):
-        steps = grid_size
-        kp_list = []
-        h, w = image.shape
-        dx = 1.0 / float(steps)
-        dy = 1.0 / float(steps)
-        x = 0.0
-        for i in xrange(steps):
-            y = 0.0
-            for j in xrange(steps):
-                #print "create mask (%dx%d) %d %d" % (w, h, i, j)
-                #print "  roi = %.2f,%.2f %.2f,%2f" % (y*h,(y+dy)*h-1, x*w,(x+dx)*w-1)
-                mask = np.zeros((h,w,1), np.uint8)
-                mask[y*h:(y+dy)*h-1,x*w:(x+dx)*w-1] = 255
-                kps = detector.detect(image, mask)
-                kp_list.extend( kps )
-                y += dy
-            x += dx
-        return kp_list
-
-    def undistort_features(self):
-        if not len(self.kp_list):
+    # the undistorted keypoint cache holds one set of coordinates per
+    # camera calibration (K and distortion coefficients), named by a
+    # hash of the calibration.  The size and modification time of the
+    # features file are stored too: when the features change all the
+    # entries are stale.
+    def features_stamp(self):
+        stat = os.stat(self.features_file)
+        return np.array([stat.st_size, stat.st_mtime_ns], dtype=np.int64)
+
+    def load_uv_cache(self):
+        if not os.path.exists(self.uv_file) or not os.path.exists(self.features_file):
+            return {}
+        try:
+            with np.load(self.uv_file) as data:
+                uv_cache = { key: data[key] for key in data.files }
+        except:
+            print(self.uv_file + ":\n" + "  uv load error: " \
+                  + str(sys.exc_info()[1]))
+            return {}
+        if not 'features' in uv_cache \
+           or not np.array_equal(uv_cache['features'], self.features_stamp()):
+            return {}
+        return uv_cache
+
+    def write_uv_cache(self, uv_cache):
+        uv_cache['features'] = self.features_stamp()
+        tmp_file = tmp_name(self.uv_file)
+        with open(tmp_file, 'wb') as fp:
+            np.savez(fp, **uv_cache)
+        os.replace(tmp_file, self.uv_file)
+
+    # compute (or load from the cache) the undistorted uv coordinates
+    # of all the keypoints (Nx2 array) with the original or optimized
+    # camera calibration
+    def undistort_features(self, optimized=False):
+        K = camera.get_K(optimized)
+        dist_coeffs = np.array(camera.get_dist_coeffs(optimized))
+        calib = np.concatenate((np.ravel(K), dist_coeffs)).astype(np.float64)
+        key = "uv_" + hashlib.sha1(calib.tobytes()).hexdigest()[:16]
+        uv_cache = self.load_uv_cache()
+        if key in uv_cache:
+            self.uv_list = uv_cache[key]
             return
-        K = self.cam.get_K(optimized)
-        uv_raw = np.zeros((len(image.kp_list),1,2), dtype=np.float32)
-        for i, kp in enumerate(image.kp_list):
-            uv_raw[i][0] = (kp.pt[0], kp.pt[1])
-        dist_coeffs = self.cam.get_dist_coeffs(optimized)
-        uv_new = cv2.undistortPoints(uv_raw, K, np.array(dist_coeffs), P=K)
-        image.uv_list = []
-        for i, uv in enumerate(uv_new):
-            image.uv_list.append(uv_new[i][0])
-            # print("  orig = %s  undistort = %s" % (uv_raw[i][0], uv_new[i]     
-    def detect_features(self, scale, use_cache=True):
+        if self.kp_array is None or not len(self.kp_array):
+            self.uv_list = np.zeros((0, 2), dtype=np.float32)
+            return
+        uv_raw = self.kp_uv().reshape(-1, 1, 2)
+        uv_new = cv2.undistortPoints(uv_raw, K, dist_coeffs, P=K)
+        self.uv_list = uv_new.reshape(-1, 2)
+        if os.path.exists(self.features_file):
+            uv_cache[key] = self.uv_list
+            self.write_uv_cache(uv_cache)
+
+    # detect (or load cached) features and descriptors.  rgb is the
+    # (optional) already loaded load_rgb(equalize=True, scale=scale)
+    # image.  Returns a dictionary of the time spent (seconds) in each
+    # step of the detection, or None if the features were loaded from
+    # the cache.
+    def detect_features(self, scale, use_cache=True, rgb=None):
         if use_cache:
             success = True
             if not self.load_features():
@@ -290,31 +642,42 @@ class Image():
             if not self.load_descriptors():
                 success = False
             if success:
+                self.num_features = len(self.kp_array)
                 qlog("Loaded features/descriptors from cache:", self.name)
-                return
+                return None
 
         qlog("Detecting features/descriptors for:", self.name)
-        rgb = self.load_rgb(equalize=True)
-        
         # scale image for feature detection.  Note that with feature
         # detection, often less is more ... scaling to a smaller image
         # can allow the feature detector to see bigger scale features.
         # With outdoor natural images at full detail, oftenthe
         # detector/matcher gets lots in the microscopic details and
         # sees more noise than valid features.
-        scaled = cv2.resize(rgb, (0,0), fx=scale, fy=scale)
+        timing = {}
+        start = time.time()
+        if rgb is None:
+            scaled = self.load_rgb(equalize=True, scale=scale)
+        else:
+            scaled = rgb
+        timing['load'] = time.time() - start
         
         if not detector:
             self.make_detector()
-        #detector_node = getNode('/config/detector', True)
-        #grid_size = detector_node.getInt('grid_detect')
-        #if detector_node.getString('detector') == 'ORB' and grid_size > 1:
-        #    kp_list = self.orb_grid_detect(detector, scaled, grid_size)
-        #else:
-        #    kp_list = detector.detect(scaled)
+        detector_node = getNode('/config/detector', True)
+        grid_size = detector_node.getInt('grid_detect')
 
-        self.kp_list, self.des_list = detector.detectAndCompute(scaled, None)
-        self.num_features = len(self.kp_list)
+        start = time.time()
+        if grid_size > 1:
+            kp_array, des_list = grid_detect(detector, scaled, grid_size,
+                                             max_features)
+        else:
+            kp_list, des_list = detector.detectAndCompute(scaled, None)
+            kp_array, des_list = strongest_features(keypoints_to_array(kp_list), des_list, max_features)
+        self.kp_array = kp_array
+        self._kp_list = None
+        self.des_list = des_list
+        self.num_features = len(self.kp_array)
+        timing['detect'] = time.time() - start
         
         if False:
             # [pasted code from project.py needs to be fixed before
@@ -333,13 +696,15 @@ class Image():
                     image.des_list = np.delete(image.des_list, i, 0) # np array
 
         # scale the keypoint coordinates back to the original image size
-        for kp in self.kp_list:
-            #print('scaled:', kp.pt, ' ', end='')
-            kp.pt = (kp.pt[0]/scale, kp.pt[1]/scale)
-            #print('full:', kp.pt)
+        self.kp_array['x'] = self.kp_array['x'].astype(float) / scale
+        self.kp_array['y'] = self.kp_array['y'].astype(float) / scale
+        self._kp_list = None
             
+        start = time.time()
         self.save_features()
         self.save_descriptors()
+        timing['save'] = time.time() - start
+        return timing
 
     # Displays the image in a window and waits for a keystroke and
     # then destroys the window.  Returns the value of the keystroke.
@@ -451,6 +816,10 @@ class Image():
         for i in range(4):
             cam_pose_node.setFloatEnum('quat', i, ned2cam[i])
 
+    def get_aircraft_yaw_error_estimate(self):
+        ac_pose_node = self.node.getChild('aircraft_pose', True)
+        return ac_pose_node.getFloat("yaw_error_deg")
+
     # ned = [n_m, e_m, d_m] relative to the project ned reference point
     # ypr = [yaw_deg, pitch_deg, roll_deg] in the ned coordinate frame
     # note that the matrix derived from 'quat' is inv(R) is transpose(R)
@@ -13,6 +13,7 @@ from .logger import log, qlog
 from . import matcher
 from . import project
 from . import srtm
+from . import tracks
 
 # Reset all match point locations to their original direct
 # georeferenced locations based on estimated camera pose and
@@ -30,23 +31,19 @@ def merge_duplicates(proj):
     # resolve to the same uv coordinate in an image.
     log("Indexing features by unique uv coordinates:")
     for image in tqdm(proj.image_list, smoothing=0.05):
-        # pass one, build a tmp structure of unique keypoints (by uv) and
-        # the index of the first instance.
-        image.kp_remap = {}
-        used = 0
-        for i, kp in enumerate(image.kp_list):
-            if image.kp_used[i]:
-                used += 1
-                key = "%.2f-%.2f" % (kp.pt[0], kp.pt[1])
-                if not key in image.kp_remap:
-                    image.kp_remap[key] = i
-                else:
-                    #print("%d -> %d" % (i, image.kp_remap[key]))
-                    #print(" ", image.coord_list[i], image.coord_list[image.kp_remap[key]])
-                    pass
-
-        #print(" features used:", used)
-        #print(" unique by uv and used:", len(image.kp_remap))
+        # remap each used keypoint to the first used keypoint with the
+        # same uv coordinate (unused keypoints map to themselves)
+        image.kp_remap = np.arange(len(image.kp_array))
+        used = np.flatnonzero(image.kp_used)
+        if len(used):
+            uv = image.kp_uv()[used]
+            quantized = np.round(uv.astype(np.float64) * 100).astype(np.int64)
+            unique, first, inverse = np.unique(quantized, axis=0,
+                                               return_index=True,
+                                               return_inverse=True)
+            image.kp_remap[used] = used[first][inverse.reshape(-1)]
+        #print(" features used:", len(used))
+        #print(" unique by uv and used:", len(unique))
 
     # after feature matching we don't care about other attributes, just
     # the uv coordinate.
@@ -62,49 +59,18 @@ def merge_duplicates(proj):
     for i, i1 in enumerate(tqdm(proj.image_list, smoothing=0.05)):
         for key in i1.match_list:
             matches = i1.match_list[key]
-            count = 0
             i2 = proj.findImageByName(key)
-            if i2 is None:
+            if i2 is None or not len(matches):
                 # ignore pairs outside our area set
                 continue
-            for k, pair in enumerate(matches):
-                # print pair
-                idx1 = pair[0]
-                idx2 = pair[1]
-                kp1 = i1.kp_list[idx1]
-                kp2 = i2.kp_list[idx2]
-                key1 = "%.2f-%.2f" % (kp1.pt[0], kp1.pt[1])
-                key2 = "%.2f-%.2f" % (kp2.pt[0], kp2.pt[1])
-                # print key1, key2
-                new_idx1 = i1.kp_remap[key1]
-                new_idx2 = i2.kp_remap[key2]
-                # count the number of match rewrites
-                if idx1 != new_idx1 or idx2 != new_idx2:
-                    count += 1
-                if idx1 != new_idx1:
-                    # sanity check
-                    uv1 = list(i1.kp_list[idx1].pt)
-                    new_uv1 = list(i1.kp_list[new_idx1].pt)
-                    if not np.allclose(uv1, new_uv1):
-                        print("OOPS!!!")
-                        print("  index 1: %d -> %d" % (idx1, new_idx1))
-                        print("  [%.2f, %.2f] -> [%.2f, %.2f]" % (uv1[0], uv1[1],
-                                                                  new_uv1[0],
-                                                                  new_uv1[1]))
-                if idx2 != new_idx2:
-                    # sanity check
-                    uv2 = list(i2.kp_list[idx2].pt)
-                    new_uv2 = list(i2.kp_list[new_idx2].pt)
-                    if not np.allclose(uv2, new_uv2):
-                        print("OOPS!")
-                        print("  index 2: %d -> %d" % (idx2, new_idx2))
-                        print("  [%.2f, %.2f] -> [%.2f, %.2f]" % (uv2[0], uv2[1],
-                                                                  new_uv2[0],
-                                                                  new_uv2[1]))
-                # rewrite matches
-                matches[k] = [new_idx1, new_idx2]
+            # rewrite matches
+            pairs = np.array(matches, dtype=int).reshape(-1, 2)
+            new_pairs = np.stack((i1.kp_remap[pairs[:,0]],
+                                  i2.kp_remap[pairs[:,1]]), axis=1)
+            #count = np.count_nonzero(np.any(new_pairs != pairs, axis=1))
             #if count > 0:
             #    print('Match:', i1.name, 'vs', i2.name, '%d/%d' % ( count, len(matches) ), 'rewrites')
+            i1.match_list[key] = new_pairs.tolist()
 
 # enable the following code to visualize the matches after collapsing
 # identical uv coordinates
@@ -131,22 +97,16 @@ def check_for_pair_dups(proj):
         for key in i1.match_list:
             matches = i1.match_list[key]
             i2 = proj.findImageByName(key)
-            if i2 is None:
+            if i2 is None or not len(matches):
                 # ignore pairs not in our area set
                 continue
-            count = 0
-            pair_dict = {}
-            new_matches = []
-            for k, pair in enumerate(matches):
-                pair_key = "%d-%d" % (pair[0], pair[1])
-                if not pair_key in pair_dict:
-                    pair_dict[pair_key] = True
-                    new_matches.append(pair)
-                else:
-                    count += 1
+            # keep the first instance of each pair (in order)
+            pairs = np.array(matches, dtype=int).reshape(-1, 2)
+            first = np.sort(np.unique(pairs, axis=0, return_index=True)[1])
+            count = len(pairs) - len(first)
             if count > 0:
                 print('Match:', i1.name, 'vs', i2.name, 'matches:', len(matches), 'dups:', count)
-            i1.match_list[key] = new_matches
+                i1.match_list[key] = pairs[first].tolist()
         
 # enable the following code to visualize the matches after eliminating
 # duplicates (duplicates can happen after collapsing uv coordinates.)
@@ -172,24 +132,23 @@ def check_for_1vn_dups(proj):
         for key in i1.match_list:
             matches = i1.match_list[key]
             i2 = proj.findImageByName(key)
-            if i2 is None:
+            if i2 is None or not len(matches):
                 # skip pairs outside our area set
                 continue
-            count = 0
-            kp_dict = {}
-            for k, pair in enumerate(matches):
-                if not pair[0] in kp_dict:
-                    kp_dict[pair[0]] = pair[1]
-                else:
-                    log("Warning keypoint idx", pair[0], "already used in another match.")
-                    uv2a = list(i2.kp_list[ kp_dict[pair[0]] ].pt)
-                    uv2b = list(i2.kp_list[ pair[1] ].pt)
-                    if not np.allclose(uv2, new_uv2):
+            pairs = np.array(matches, dtype=int).reshape(-1, 2)
+            unique, first, inverse = np.unique(pairs[:,0], return_index=True,
+                                               return_inverse=True)
+            dups = np.flatnonzero(np.arange(len(pairs)) != first[inverse.reshape(-1)])
+            if len(dups):
+                uv2 = i2.kp_uv()
+                for k in dups:
+                    log("Warning keypoint idx", pairs[k,0], "already used in another match.")
+                    uv2a = uv2[pairs[first[inverse[k]],1]]
+                    uv2b = uv2[pairs[k,1]]
+                    if not np.allclose(uv2a, uv2b):
                         qlog("  [%.2f, %.2f] -> [%.2f, %.2f]" % (uv2a[0], uv2a[1],
                                                                  uv2b[0], uv2b[1]))
-                    count += 1
-            if count > 0:
-                qlog('Match:', i, 'vs', j, 'matches:', len(matches), 'dups:', count)
+                qlog('Match:', i1.name, 'vs', i2.name, 'matches:', len(matches), 'dups:', len(dups))
 
 def make_match_structure(proj):
     log("Constructing unified match structure:")
@@ -223,88 +182,115 @@ def make_match_structure(proj):
 
     return matches_direct
 
-# collect/group match chains that refer to the same keypoint
-def link_matches(proj, matches_direct):
+# disjoint set forest over node ids 0..n-1 joined by the (u, v) edge
+# arrays.  Returns the root (smallest node id) of each node's set.
+# Each pass hooks the larger root of every edge onto the smaller root
+# (all edges at once) and then fully compresses the paths, so the
+# whole thing runs in a handful of vectorized passes.
+def union_find(n, u, v):
+    parent = np.arange(n)
+    while True:
+        ru = parent[u]
+        rv = parent[v]
+        lo = np.minimum(ru, rv)
+        hi = np.maximum(ru, rv)
+        join = lo != hi
+        if not np.any(join):
+            break
+        np.minimum.at(parent, hi[join], lo[join])
+        # path compression (pointer jumping)
+        while True:
+            grand = parent[parent]
+            if np.array_equal(grand, parent):
+                break
+            parent = grand
+    return parent
+
+# collect/group match chains that refer to the same keypoint.  Every
+# (image, keypoint) observation gets an int64 id, matches join the
+# observations into tracks (union-find), and each track keeps only
+# the first observation (in match order) of each image.  Returns the
+# tracks (longest first) as a tracks.Tracks store.
+def link_tracks(proj, matches_direct):
     log("Linking common matches together into chains:")
-    count = 0
-    done = False
-    while not done:
-        log("Iteration %d (%d):" % (count, len(matches_direct)))
-        count += 1
-        matches_new = []
-        matches_lookup = {}
-        for i, match in enumerate(tqdm(matches_direct, smoothing=0.05)):
-            # scan if any of these match points have been previously seen
-            # and record the match index
-            index = -1
-            for p in match[2:]:
-                key = "%d-%d" % (p[0], p[1])
-                if key in matches_lookup:
-                    index = matches_lookup[key]
-                    break
-            if index < 0:
-                # not found, append to the new list
-                for p in match[2:]:
-                    key = "%d-%d" % (p[0], p[1])
-                    matches_lookup[key] = len(matches_new)
-                matches_new.append(list(match)) # shallow copy
-            else:
-                # found a previous reference, append these match items
-                existing = matches_new[index]
-                for p in match[2:]:
-                    key = "%d-%d" % (p[0], p[1])
-                    found = False
-                    for e in existing[2:]:
-                        if p[0] == e[0]:
-                            found = True
-                            break
-                    if not found:
-                        # add
-                        existing.append(list(p)) # shallow copy
-                        matches_lookup[key] = index
-                # no 3d location estimation yet
-                # # attempt to combine location equitably
-                # size1 = len(match[2:])
-                # size2 = len(existing[2:])
-                # ned1 = np.array(match[0])
-                # ned2 = np.array(existing[0])
-                # avg = (ned1 * size1 + ned2 * size2) / (size1 + size2)
-                # existing[0] = avg.tolist()
-                # # print(ned1, ned2, existing[0])
-                # # print "new:", existing
-                # # print
-        if len(matches_new) == len(matches_direct):
-            done = True
-        else:
-            matches_direct = list(matches_new) # shallow copy
+    n_matches = len(matches_direct)
+    sizes = [ len(match) - 2 for match in matches_direct ]
+    obs = [ p for match in matches_direct for p in match[2:] ]
+    obs = np.array(obs, dtype=np.int64).reshape(-1, 2)
+    obs_match = np.repeat(np.arange(n_matches), sizes)
+    obs_img = obs[:,0]
+    obs_kp = obs[:,1]
+    keys = (obs_img << 32) | obs_kp
+    ids, node = np.unique(keys, return_inverse=True)
+    node = node.reshape(-1)
+
+    # consecutive observations of the same match are linked
+    same = obs_match[1:] == obs_match[:-1]
+    root = union_find(len(ids), node[:-1][same], node[1:][same])
+    track = root[node]
+
+    # one observation per image per track: the first one seen wins
+    order = np.lexsort((np.arange(len(track)), obs_img, track))
+    first = np.ones(len(order), dtype=bool)
+    first[1:] = (track[order][1:] != track[order][:-1]) \
+        | (obs_img[order][1:] != obs_img[order][:-1])
+    keep = np.sort(order[first])
+
+    # tracks are numbered in order of their first match and
+    # observations kept in the order they were seen
+    track_keep = track[keep]
+    uniq, start = np.unique(track_keep, return_index=True)
+    rank = np.empty(len(ids), dtype=np.int64)
+    rank[uniq[np.argsort(start, kind='stable')]] = np.arange(len(uniq))
+    keep = keep[np.argsort(rank[track_keep], kind='stable')]
+    obs_rank = rank[track[keep]]
+    log("Linked %d matches into %d tracks" % (n_matches, len(uniq)))
+
+    # sort by longest match chains first
+    log("Sorting matches by longest chain first.")
+    track_sizes = np.bincount(obs_rank, minlength=len(uniq))
+    by_size = np.argsort(-track_sizes, kind='stable')
+    position = np.empty(len(uniq), dtype=np.int64)
+    position[by_size] = np.arange(len(uniq))
+    keep = keep[np.argsort(position[obs_rank], kind='stable')]
+    offsets = np.zeros(len(uniq) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum(track_sizes[by_size])
 
     # replace the keypoint index in the matches file with the actual kp
     # values.  This will save time later and avoid needing to load the
     # full original feature files which are quite large.  This also will
     # reduce the in-memory footprint for many steps.
     log('Replacing keypoint indices with uv coordinates:')
-    for match in tqdm(matches_direct):
-        for m in match[2:]:
-            kp = proj.image_list[m[0]].kp_list[m[1]].pt
-            m[1] = list(kp)
-        # print(match)
+    img_keep = obs_img[keep]
+    kp_keep = obs_kp[keep]
+    uv = np.zeros((len(keep), 2))
+    for i in np.unique(img_keep):
+        sel = img_keep == i
+        kp_array = proj.image_list[i].kp_array
+        uv[sel,0] = kp_array['x'][kp_keep[sel]]
+        uv[sel,1] = kp_array['y'][kp_keep[sel]]
 
-    # sort by longest match chains first
-    log("Sorting matches by longest chain first.")
-    matches_direct.sort(key=len, reverse=True)
+    # ned place holder, no group yet
+    result = tracks.Tracks(ned=np.full((len(uniq), 3), np.nan),
+                           group=np.full(len(uniq), -1, dtype=np.int32),
+                           offsets=offsets,
+                           obs_img=img_keep.astype(np.int32),
+                           obs_uv=uv)
 
-    sum = 0.0
-    for i, match in enumerate(matches_direct):
-        refs = len(match[2:])
-        sum += refs
+    if len(result):
+        log("Total unique features in image set:", len(result))
+        log("Keypoint average instances:", "%.2f" % (len(keep) / len(result)))
 
-    if count >= 1:
-        log("Total unique features in image set:", len(matches_direct))
-        log("Keypoint average instances:", "%.2f" % (sum / len(matches_direct)))
+    return result
 
-    return matches_direct
+# link_tracks() as a legacy matches list: [None, -1, [img, [u, v]], ...]
+def link_matches(proj, matches_direct):
+    return tracks.to_matches(link_tracks(proj, matches_direct))
 
-def triangulate_srtm(proj, matches):
+# estimate an initial location for each track by projecting its
+# observations onto the SRTM surface.  Needs the offsets, obs_img and
+# obs_uv columns, sets the ned column.
+def triangulate_srtm(proj, tracks):
     K = camera.get_K(optimized=False)
     IK = np.linalg.inv(K)
     
@@ -316,29 +302,43 @@ def triangulate_srtm(proj, matches):
         # print(image.name, image.base_elev)
 
     log("Estimating initial projection for each feature...")
-    bad_count = 0
-    bad_indices = []
-    for i, match in enumerate(tqdm(matches, smoothing=0.02)):
-        sum = np.zeros(3)
-        array = []              # fixme: temp/debug
-        for m in match[2:]:
-            image = proj.image_list[m[0]]
-            cam2body = image.get_cam2body()
-            body2ned = image.get_body2ned()
-            ned, ypr, quat = image.get_camera_pose()
-            uv_list = [ m[1] ] # just one uv element
-            vec_list = project.projectVectors(IK, body2ned, cam2body, uv_list)
-            v = vec_list[0]
-            if v[2] > 0.0:
-                d_proj = -(ned[2] + image.base_elev)
-                factor = d_proj / v[2]
-                n_proj = v[0] * factor
-                e_proj = v[1] * factor
-                p = [ ned[0] + n_proj, ned[1] + e_proj, ned[2] + d_proj ]
-                # print('  ', p)
-                sum += np.array(p)
-                array.append(p)
-            else:
-                log('vector projected above horizon.')
-        match[0] = (sum/len(match[2:])).tolist()
-        # print(match[0])
+    track = tracks.obs_track()
+    obs_img = np.asarray(tracks.obs_img)
+    obs_uv = np.asarray(tracks.obs_uv)
+
+    # project each image's observations together and intersect them
+    # with a flat surface at the image base elevation.  (The vector
+    # length cancels out of the intersection so they aren't normalized.)
+    points = np.zeros((len(track), 3))
+    valid = np.zeros(len(track), dtype=bool)
+    order = np.argsort(obs_img, kind='stable')
+    bounds = np.searchsorted(obs_img[order], np.arange(len(proj.image_list) + 1))
+    for i, image in enumerate(tqdm(proj.image_list, smoothing=0.02)):
+        sel = order[bounds[i]:bounds[i+1]]
+        if not len(sel):
+            continue
+        cam2body = image.get_cam2body()
+        body2ned = image.get_body2ned()
+        ned, ypr, quat = image.get_camera_pose()
+        M = body2ned.dot(cam2body).dot(IK)
+        uvh = np.hstack((obs_uv[sel], np.ones((len(sel), 1))))
+        v = uvh.dot(M.T)
+        down = v[:,2] > 0.0
+        d_proj = -(ned[2] + image.base_elev)
+        factor = d_proj / v[down,2]
+        p = np.empty((np.count_nonzero(down), 3))
+        p[:,0] = ned[0] + v[down,0] * factor
+        p[:,1] = ned[1] + v[down,1] * factor
+        p[:,2] = ned[2] + d_proj
+        points[sel[down]] = p
+        valid[sel[down]] = True
+    if not np.all(valid):
+        log('%d vectors projected above horizon.' % np.count_nonzero(~valid))
+
+    # the track location is the sum of the (valid) projections over the
+    # number of observations
+    sum = np.zeros((len(tracks), 3))
+    for k in range(3):
+        sum[:,k] = np.bincount(track[valid], weights=points[valid,k],
+                               minlength=len(tracks))
+    tracks.ned = sum / np.maximum(tracks.sizes(), 1)[:,np.newaxis]
@@ -7,17 +7,24 @@ import copy
 import cv2
 import math
 import numpy as np
+import os
 import time
 from tqdm import tqdm
 import random
+import scipy.spatial
 import time
 
 from props import getNode
 
 from . import camera
+from . import cascade_hash
+from . import desc_cache
 from .find_obj import explore_match
 from . import image_list
 from .logger import log, qlog
+from . import pair_cache
+from . import pool
+from . import prefetch
 from . import project
 from . import smart
 from . import transformations
@@ -27,8 +34,13 @@ matcher_node = getNode('/config/matcher', True)
 
 detect_scale = 0.40
 the_matcher = None
+flann_params = None
+search_params = None
+engine = "flann"
+guided = False
 max_distance = None
 min_pairs = 25
+prefetch_window = 8             # images/pairs loaded ahead (0 = off)
 
 # the flann based matcher uses random starting points so some
 # borderline matching results may change from one run to the next.
@@ -41,10 +53,16 @@ random.seed(time.time())
 def configure():
     global detect_scale
     global the_matcher
+    global flann_params
+    global search_params
+    global engine
+    global guided
     global max_distance
     global min_pairs
+    global prefetch_window
 
     detect_scale = detector_node.getFloat('scale')
+    desc_cache.configure()
     detector_str = detector_node.getString('detector')
     if detector_str == 'SIFT' or detector_str == 'SURF':
         norm = cv2.NORM_L2
@@ -75,7 +93,25 @@ def configure():
         'checks': 100
     }
     the_matcher = cv2.FlannBasedMatcher(flann_params, search_params)
+
+    # nearest neighbor search engine: flann (default) or cascade
+    # hashing (float descriptors only)
+    engine = "flann"
+    if matcher_node.hasChild("engine"):
+        engine = matcher_node.getString("engine")
+    if engine == "cascade" and norm != cv2.NORM_L2:
+        log("Cascade hashing needs SIFT/SURF descriptors, using flann")
+        engine = "flann"
+
+    # guided search compares descriptors by L2 distance (float
+    # descriptors only)
+    guided = matcher_node.getBool("guided")
+    if guided and norm != cv2.NORM_L2:
+        log("Guided search needs SIFT/SURF descriptors, matching unguided")
+        guided = False
     min_pairs = matcher_node.getFloat('min_pairs')
+    if matcher_node.hasChild("prefetch"):
+        prefetch_window = matcher_node.getInt("prefetch")
 
 # Iterate through all the matches for the specified image and
 # delete keypoints that don't satisfy the homography (or
@@ -143,29 +179,44 @@ def filter_by_transform(K, i1, i2, transform):
 # feature at different scales/orientations which can lead to duplicate
 # match pairs, or possibly one feature in image1 matching two or more
 # features in images2.  Find and remove these from the set.
+# integer ids for uv coordinates: coordinates that are equal to 0.01
+# pixel get the same id
+def uv_ids(uv):
+    quantized = np.round(np.asarray(uv, dtype=np.float64) * 100).astype(np.int64)
+    ids = np.unique(quantized.reshape(-1, 2), axis=0, return_inverse=True)[1]
+    return ids.reshape(-1)
+
+# mask of the entries that are the first occurrence of their value
+def first_occurrence(ids):
+    first = np.zeros(len(ids), dtype=bool)
+    first[np.unique(ids, return_index=True)[1]] = True
+    return first
+
+# walk the pairs in order and keep each pair unless its image1 or
+# image2 uv coordinate is already used by a kept pair.  This is done
+# in rounds: pairs that touch a used coordinate are dropped, and pairs
+# that are the first remaining user of both their coordinates are kept
+# (no earlier pair can take these coordinates from them.)
 def filter_duplicates(i1, i2, idx_pairs):
-    count = 0
-    result = []
-    kp1_dict = {}
-    kp2_dict = {}
-    for pair in idx_pairs:
-        kp1 = i1.kp_list[pair[0]]
-        kp2 = i2.kp_list[pair[1]]
-        key1 = "%.2f-%.2f" % (kp1.pt[0], kp1.pt[1])
-        key2 = "%.2f-%.2f" % (kp2.pt[0], kp2.pt[1])
-        if key1 in kp1_dict and key2 in kp2_dict:
-            # print("image1 and image2 key point already used:", key1, key2)
-            count += 1
-        elif key1 in kp1_dict:
-            # print("image1 key point already used:", key1)
-            count += 1
-        elif key2 in kp2_dict:
-            # print( "image2 key point already used:", key2)
-            count += 1
-        else:
-            kp1_dict[key1] = True
-            kp2_dict[key2] = True
-            result.append(pair)
+    if not len(idx_pairs):
+        return idx_pairs
+    pairs = np.array(idx_pairs, dtype=int).reshape(-1, 2)
+    key1 = uv_ids(i1.kp_uv()[pairs[:,0]])
+    key2 = uv_ids(i2.kp_uv()[pairs[:,1]])
+    used1 = np.zeros(len(pairs), dtype=bool)
+    used2 = np.zeros(len(pairs), dtype=bool)
+    keep = np.zeros(len(pairs), dtype=bool)
+    remain = np.arange(len(pairs))
+    while len(remain):
+        remain = remain[~used1[key1[remain]] & ~used2[key2[remain]]]
+        accept = remain[first_occurrence(key1[remain])
+                        & first_occurrence(key2[remain])]
+        keep[accept] = True
+        used1[key1[accept]] = True
+        used2[key2[accept]] = True
+        remain = remain[~keep[remain]]
+    result = [ idx_pairs[k] for k in np.flatnonzero(keep) ]
+    count = len(idx_pairs) - len(result)
     if count > 0:
         qlog("  removed %d/%d duplicate features" % (count, len(idx_pairs)))
     return result
@@ -188,6 +239,65 @@ def filter_cross_check(idx_pairs1, idx_pairs2):
         qlog("  cross check: (%d, %d) => (%d, %d)" % (len(idx_pairs1), len(idx_pairs2), len(new1), len(new2)))
     return new1, new2                                               
 
+# return the flann search index for the image descriptors.  The index
+# is built once per image and kept (with the descriptors) until the
+# descriptor cache evicts the image.  If /config/matcher/flann_cache is
+# set the index is also saved in the cache directory and reloaded
+# later (as long as it is newer than the descriptor file.)
+def get_flann_index(image):
+    if image.flann_index is None:
+        # note: the flann index references the descriptor memory (it
+        # doesn't make a copy) so keep our own reference with it.
+        des = image.des_list
+        index = None
+        use_file = matcher_node.getBool("flann_cache")
+        if use_file and os.path.exists(image.flann_file) and \
+           os.path.getmtime(image.flann_file) >= os.path.getmtime(image.desc_file):
+            index = cv2.flann_Index()
+            if not index.load(des, image.flann_file):
+                index = None
+        if index is None:
+            index = cv2.flann_Index(des, flann_params)
+            if use_file:
+                tmp_file = image.flann_file + ".%d.tmp" % os.getpid()
+                index.save(tmp_file)
+                os.replace(tmp_file, image.flann_file)
+        image.flann_index = (index, des, flann_index_bytes(len(des)))
+        desc_cache.touch(image)
+    return image.flann_index[0]
+
+# estimated memory used by a flann index of n descriptors (flann
+# doesn't report it.)  A kdtree is about 2n nodes of 24 bytes plus an
+# index vector per tree, lsh stores each descriptor index in a bucket
+# of every table (plus the hash table overhead.)
+def flann_index_bytes(n):
+    if flann_params['algorithm'] == 1: # FLANN_INDEX_KDTREE
+        return flann_params['trees'] * n * (4 + 2 * 24)
+    else:
+        return flann_params['table_number'] * n * 20
+
+# return the cascade hashing index for the image descriptors (kept
+# until the descriptor cache evicts the image)
+def get_hash_index(image):
+    if image.hash_index is None:
+        image.hash_index = cascade_hash.HashIndex(image.des_list)
+        desc_cache.touch(image)
+    return image.hash_index
+
+# find the k nearest neighbors in i2 for each i1 descriptor, returns
+# an array of i2 indices and distances (index < 0 means no neighbor
+# found.)  Distances are the same as cv2.FlannBasedMatcher reports.
+def knn_search(i1, i2, k=2):
+    if engine == "cascade":
+        return cascade_hash.knn_search(get_hash_index(i1),
+                                       get_hash_index(i2), k)
+    index = get_flann_index(i2)
+    idx, dist = index.knnSearch(i1.des_list, k, params=search_params)
+    if dist.dtype == np.float32:
+        # the kdtree index reports squared (L2) distances
+        dist = np.sqrt(dist)
+    return idx, dist
+
 # run the knn matcher for the two sets of keypoints
 def raw_matches(i1, i2, k=2):
     # sanity check
@@ -198,14 +308,23 @@ def raw_matches(i1, i2, k=2):
     if len(i2.des_list.shape) == 0 or i2.des_list.shape[0] <= 1:
         return []
 
-    matches = the_matcher.knnMatch(np.array(i1.des_list),
-                                   np.array(i2.des_list),
-                                   k=k)
+    idx, dist = knn_search(i1, i2, k)
+    matches = []
+    for i, (row_idx, row_dist) in enumerate(zip(idx.tolist(), dist.tolist())):
+        m = []
+        for j, d in zip(row_idx, row_dist):
+            if j >= 0:
+                m.append( cv2.DMatch(i, j, d) )
+        matches.append(m)
     qlog("  raw matches:", len(matches))
     return matches
 
 def basic_pair_matches(i1, i2):
-    matches = raw_matches(i1, i2)
+    # the ratio test needs two neighbors (rows can come back short
+    # when the train image has very few features)
+    matches = [ m for m in raw_matches(i1, i2) if len(m) >= 2 ]
+    if not len(matches):
+        return []
     match_ratio = matcher_node.getFloat('match_ratio')
     sum = 0.0
     max_good = 0
@@ -344,7 +463,130 @@ def gen_grid(w, h, steps):
             grid_list.append( [u, v] )
     return grid_list
 
-def smart_pair_matches(i1, i2, review=False):
+# guided search: find the k nearest i2 descriptors for each i1
+# descriptor, but only considering the i2 keypoints within radius
+# (pixels) of the i1 keypoint location predicted by H.  The i2
+# keypoints are hashed into a grid of radius sized cells so each
+# block of i1 keypoints (predicted into the same cell) is compared
+# with the i2 keypoints of the surrounding 3x3 cells in one matrix
+# multiply.  Returns the same arrays as knn_search().
+def guided_search(i1, i2, H, k, radius):
+    uv1 = i1.kp_uv()
+    uv2 = i2.kp_uv()
+    des1 = np.asarray(i1.des_list, dtype=np.float32)
+    des2 = np.asarray(i2.des_list, dtype=np.float32)
+    norm1 = np.sum(des1*des1, axis=1)
+    norm2 = np.sum(des2*des2, axis=1)
+    pred = cv2.perspectiveTransform(uv1.reshape(-1, 1, 2), H).reshape(-1, 2)
+
+    # i2 keypoints sorted by grid cell
+    cell2 = np.floor(uv2 / radius).astype(int)
+    nx = np.max(cell2[:,0]) + 1
+    ny = np.max(cell2[:,1]) + 1
+    key2 = cell2[:,0] * ny + cell2[:,1]
+    order2 = np.argsort(key2, kind='stable')
+    starts = np.zeros(nx * ny + 1, dtype=int)
+    starts[1:] = np.cumsum(np.bincount(key2, minlength=nx * ny))
+
+    # i1 keypoints grouped by the cell of their predicted location
+    # (only cells touching the i2 grid can have neighbors)
+    idx = np.full((len(uv1), k), -1, dtype=np.int32)
+    dist = np.zeros((len(uv1), k), dtype=np.float32)
+    with np.errstate(invalid='ignore'):
+        cell1 = np.floor(pred / radius)
+    inside = (cell1[:,0] >= -1) & (cell1[:,0] <= nx) \
+        & (cell1[:,1] >= -1) & (cell1[:,1] <= ny)
+    rows = np.flatnonzero(inside)
+    cell1 = cell1[rows].astype(int)
+    key1 = (cell1[:,0] + 1) * (ny + 2) + (cell1[:,1] + 1)
+    order1 = np.argsort(key1, kind='stable')
+    bounds = np.flatnonzero(np.r_[True, key1[order1][1:] != key1[order1][:-1], True])
+    comparisons = 0
+    for b in range(len(bounds) - 1):
+        qi = rows[order1[bounds[b]:bounds[b+1]]]
+        cx, cy = cell1[order1[bounds[b]]]
+        ranges = []
+        for x in range(max(cx-1, 0), min(cx+2, nx)):
+            for y in range(max(cy-1, 0), min(cy+2, ny)):
+                c = x * ny + y
+                ranges.append(order2[starts[c]:starts[c+1]])
+        if not len(ranges):
+            continue
+        ti = np.concatenate(ranges)
+        if not len(ti):
+            continue
+        comparisons += len(qi) * len(ti)
+        d2 = norm1[qi][:,np.newaxis] + norm2[ti] - 2 * des1[qi].dot(des2[ti].T)
+        v = uv2[ti] - pred[qi][:,np.newaxis,:]
+        d2[np.sum(v*v, axis=2) > radius*radius] = np.inf
+        kk = min(k, len(ti))
+        if kk < len(ti):
+            top = np.argpartition(d2, kk - 1, axis=1)[:,:kk]
+        else:
+            top = np.broadcast_to(np.arange(kk), (len(qi), kk))
+        d2 = np.take_along_axis(d2, top, axis=1)
+        best = np.argsort(d2, axis=1, kind='stable')
+        d2 = np.take_along_axis(d2, best, axis=1)
+        cand = ti[np.take_along_axis(top, best, axis=1)]
+        cand[np.isinf(d2)] = -1
+        idx[qi,:kk] = cand
+        dist[qi,:kk] = np.sqrt(np.maximum(np.where(np.isinf(d2), 0, d2), 0))
+    qlog("  guided search comparisons: %d (%.1f%% of all pairs)" % (comparisons, 100.0 * comparisons / max(len(uv1) * len(uv2), 1)))
+    return idx, dist
+
+# run the knn search (k neighbors in i2 for each i1 keypoint) and
+# return (N,k) arrays of the neighbor indices, distances and distance
+# ratios (first / j-th) plus a mask of the leading candidates in each
+# row that are closer than max_dist and pass the ratio test.  The scan
+# of each row stops at the first candidate that fails.  If a
+# homography H (i1 -> i2 uv) is provided, use a guided search around
+# the predicted locations.
+def knn_candidates(i1, i2, k, max_dist, match_ratio, H=None, radius=None):
+    # sanity check
+    if i1.des_list is None or i2.des_list is None \
+       or len(i1.des_list.shape) == 0 or i1.des_list.shape[0] <= 1 \
+       or len(i2.des_list.shape) == 0 or i2.des_list.shape[0] <= 1:
+        idx = np.zeros((0, k), dtype=int)
+        dist = np.zeros((0, k))
+        return idx, dist, dist, np.zeros((0, k), dtype=bool)
+    if H is not None:
+        idx, dist = guided_search(i1, i2, H, k, radius)
+    else:
+        idx, dist = knn_search(i1, i2, k)
+    dist = dist.astype(float)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        ratio = dist[:,:1] / dist
+    # (only exact duplicate descriptors have a zero j-th distance)
+    ratio[dist == 0] = 1.0
+    ok = (idx >= 0) & (dist < max_dist) & (ratio >= match_ratio)
+    valid = np.logical_and.accumulate(ok, axis=1)
+    qlog("  raw matches:", len(idx))
+    return idx, dist, ratio, valid
+
+# keypoint size ratio (larger / smaller) of the i1 keypoints (rows)
+# vs. their i2 candidates (idx)
+def size_ratio(i1, i2, rows, idx):
+    s1 = i1.kp_array['size'].astype(float)[rows]
+    s2 = i2.kp_array['size'].astype(float)[np.maximum(idx, 0)]
+    return np.maximum(s1, s2) / np.minimum(s1, s2)
+
+# for each row pick the eligible candidate with the smallest metric
+# (first one wins a tie), returns the row and column of the choice for
+# the rows that have one
+def select_best(metric, eligible):
+    metric = np.where(eligible, metric, np.inf)
+    best = np.argmin(metric, axis=1)
+    rows = np.flatnonzero(np.any(eligible, axis=1))
+    return rows, best[rows]
+
+# cv2.DMatch list for the opencv calls/drawing functions that need them
+def make_dmatches(query, train, dist):
+    matches = []
+    for q, t, d in zip(query.tolist(), train.tolist(), dist.tolist()):
+        matches.append( cv2.DMatch(q, t, d) )
+    return matches
+
+def smart_pair_matches(i1, i2, review=False, ground_m=None):
     # common camera parameters
     K = camera.get_K()
     IK = np.linalg.inv(K)
@@ -355,7 +597,10 @@ def smart_pair_matches(i1, i2, review=False):
     grid_steps = 8
     grid_list = gen_grid(w, h, grid_steps)
 
-    if matcher_node.hasChild("ground_m"):
+    if ground_m is not None:
+        # provided by the caller (i.e. the parent of a worker process)
+        qlog("  Ground estimate: %.1f" % ground_m)
+    elif matcher_node.hasChild("ground_m"):
         ground_m = matcher_node.getFloat("ground_m")
         qlog("Forced ground:", ground_m)
     else:
@@ -408,79 +653,62 @@ def smart_pair_matches(i1, i2, review=False):
                                    0)
     #print("Preliminary H:", H)
 
-    matches = raw_matches(i1, i2, k=3)
-    print("Raw matches:", len(matches))
+    if guided:
+        # only search near the H predicted locations
+        if matcher_node.hasChild("guided_radius"):
+            radius = matcher_node.getFloat("guided_radius") * diag
+        else:
+            radius = 0.05 * diag
+        qlog("  guided search radius: %.0f (px)" % radius)
+        idx, dist, ratio, valid = knn_candidates(i1, i2, 3, 300, match_ratio,
+                                                 H, radius)
+    else:
+        idx, dist, ratio, valid = knn_candidates(i1, i2, 3, 300, match_ratio)
+    print("Raw matches:", len(idx))
 
     best_fitted_matches = 20    # don't proceed if we can't beat this value
     matches_fit = []
     
-    src_pts = np.float32([i1.kp_list[i].pt for i in range(len(i1.kp_list))]).reshape(-1, 1, 2)
-    dst_pts = np.float32([i2.kp_list[i].pt for i in range(len(i2.kp_list))]).reshape(-1, 1, 2)
+    src_pts = i1.kp_uv().reshape(-1, 1, 2)
+    dst_pts = i2.kp_uv().reshape(-1, 1, 2)
+
+    # candidates with a compatible keypoint size (these don't depend
+    # on H so compute them once)
+    rows = np.arange(len(idx)).reshape(-1, 1)
+    size_diff = size_ratio(i1, i2, rows, idx)
+    eligible = valid & (size_diff <= 1.25)
+    dst_cand = dst_pts.reshape(-1, 2)[np.maximum(idx, 0)]
     
     while True:
         # print('H:', H)
         trans_pts = cv2.perspectiveTransform(src_pts, H)
 
         print("collect stats...")
-        match_stats = []
-        for i, m in enumerate(matches):
-            best_index = -1
-            best_metric = 9
-            best_angle = 0
-            best_size = 0
-            best_dist = 0
-            for j in range(len(m)):
-                if m[j].distance >= 300:
-                    break
-                ratio = m[0].distance / m[j].distance
-                if ratio < match_ratio:
-                    break
-                p1 = trans_pts[m[j].queryIdx]
-                p2 = dst_pts[m[j].trainIdx]
-                #print(p1, p2)
-                raw_dist = np.linalg.norm(p2 - p1)
-                s1 = np.array(i1.kp_list[m[j].queryIdx].size)
-                s2 = np.array(i2.kp_list[m[j].trainIdx].size)
-                if s1 > s2:
-                    size_diff = s1 / s2
-                else:
-                    size_diff = s2 / s1
-                if size_diff > 1.25:
-                    continue
-                metric = raw_dist * size_diff / ratio
-                #print(" ", j, m[j].distance, size_diff, metric)
-                if best_index < 0 or metric < best_metric:
-                    best_metric = metric
-                    best_index = j
-                    best_dist = raw_dist
-            if best_index >= 0:
-                match_stats.append( [ m[best_index], best_dist ] )
+        # pick the candidate with the best metric for each keypoint
+        v = dst_cand - trans_pts.reshape(-1, 1, 2)
+        raw_dist = np.sqrt(np.sum(v*v, axis=2))
+        metric = raw_dist.astype(float) * size_diff / ratio
+        q, j = select_best(metric, eligible)
+        t = idx[q, j]
+        best_dist = raw_dist[q, j]
 
         tol = int(diag*0.005)
         if tol < 5: tol = 5
 
         cutoffs = [ 16, 32, 64, 128, 256, 512, 1024 ]
-        dist_bins = [[] for i in range(len(cutoffs))]
-        print("bins:", len(dist_bins))
-        for line in match_stats:
-            m = line[0]
-            best_dist = line[1]
-            for i, d in enumerate(cutoffs):
-                if best_dist < cutoffs[i]:
-                    dist_bins[i].append(m)
+        print("bins:", len(cutoffs))
 
         done = True
-        for i, dist_matches in enumerate(dist_bins):
-            print("bin:", i, "cutoff:", cutoffs[i], "len:", len(dist_matches))
-            if len(dist_matches) >= min_pairs:
-                src = np.float32([src_pts[m.queryIdx] for m in dist_matches]).reshape(1, -1, 2)
-                dst = np.float32([dst_pts[m.trainIdx] for m in dist_matches]).reshape(1, -1, 2)
+        for i, cutoff in enumerate(cutoffs):
+            members = np.flatnonzero(best_dist < cutoff)
+            print("bin:", i, "cutoff:", cutoff, "len:", len(members))
+            if len(members) >= min_pairs:
+                src = src_pts[q[members]].reshape(1, -1, 2)
+                dst = dst_pts[t[members]].reshape(1, -1, 2)
                 H_test, status = cv2.findHomography(src, dst, cv2.RANSAC, tol)
                 num_fit = np.count_nonzero(status)
                 if num_fit > best_fitted_matches:
                     done = False
-                    matches_fit = []
-                    matches_dist = []
                     # affine, astatus = \
                     #     cv2.estimateAffinePartial2D(np.array([src]).astype(np.float32),
                     #                                 np.array([dst]).astype(np.float32))
@@ -491,15 +719,13 @@ def smart_pair_matches(i1, i2, review=False):
                     # print("Skew:", sx, sy)
                     H = np.copy(H_test)
                     # print("H:", H)
-                    for i, m in enumerate(dist_matches):
-                        if status[i]:
-                            matches_fit.append(m)
-                            matches_dist.append(m.distance)
-                    best_fitted_matches = len(matches_fit)
-                    print("Filtered matches:", len(dist_matches),
-                          "Fitted matches:", len(matches_fit))
+                    fit = members[status.ravel() != 0]
+                    matches_fit = [ q[fit], t[fit], dist[q[fit], j[fit]] ]
+                    best_fitted_matches = len(fit)
+                    print("Filtered matches:", len(members),
+                          "Fitted matches:", len(fit))
                     #print("metric cutoff:", best_metric)
-                    matches_dist = np.array(matches_dist)
+                    matches_dist = matches_fit[2]
                     print("avg match quality:", np.average(matches_dist))
                     print("max match quality:", np.max(matches_dist))
                     if review:
@@ -507,7 +733,7 @@ def smart_pair_matches(i1, i2, review=False):
                         blend = cv2.addWeighted(i1_new, 0.5, rgb2, 0.5, 0)
                         blend = cv2.resize(blend, (int(w*args.scale), int(h*args.scale)))
                         cv2.imshow('blend', blend)
-                        draw_inlier(rgb1, rgb2, i1.kp_list, i2.kp_list, matches_fit, 'ONLY_LINES', args.scale)
+                        draw_inlier(rgb1, rgb2, i1.kp_list, i2.kp_list, make_dmatches(*matches_fit), 'ONLY_LINES', args.scale)
 
             # check for diminishing returns and bail early
             #print(best_fitted_matches)
@@ -520,10 +746,8 @@ def smart_pair_matches(i1, i2, review=False):
         if done:
             break
         
-    if len(matches_fit) >= min_pairs:
-        idx_pairs = []
-        for m in matches_fit:
-            idx_pairs.append( [m.queryIdx, m.trainIdx] )
+    if len(matches_fit) and len(matches_fit[0]) >= min_pairs:
+        idx_pairs = np.stack(matches_fit[:2], axis=1).tolist()
         idx_pairs = filter_duplicates(i1, i2, idx_pairs)
         if len(idx_pairs) >= min_pairs:
             rev_pairs = []
@@ -544,54 +768,21 @@ def bruteforce_pair_matches(i1, i2, review=False):
         rgb1 = i1.load_rgb()
         rgb2 = i2.load_rgb()
 
-    matches = raw_matches(i1, i2, k=3)
+    idx, dist, ratio, valid = knn_candidates(i1, i2, 3, 290, match_ratio)
+    uv1 = i1.kp_uv()
+    uv2 = i2.kp_uv()
     
     qlog("  collect stats...")
-    match_stats = []
-    for i, m in enumerate(matches):
-        best_index = -1
-        best_metric = 9
-        best_angle = 0
-        best_size = 0
-        best_dist = 0
-        best_vangle = 0
-        for j in range(len(m)):
-            if m[j].distance >= 290:
-                break
-            ratio = m[0].distance / m[j].distance
-            if ratio < match_ratio:
-                break
-            p1 = np.float32(i1.kp_list[m[j].queryIdx].pt)
-            p2 = np.float32(i2.kp_list[m[j].trainIdx].pt)
-            v = p2 - p1
-            raw_dist = np.linalg.norm(v)
-            vangle = math.atan2(v[1], v[0])
-            if vangle < 0: vangle += 2*math.pi
-            # angle difference mapped to +/- 90
-            a1 = np.array(i1.kp_list[m[j].queryIdx].angle)
-            a2 = np.array(i2.kp_list[m[j].trainIdx].angle)
-            angle_diff = abs((a1-a2+90) % 180 - 90)
-            s1 = np.array(i1.kp_list[m[j].queryIdx].size)
-            s2 = np.array(i2.kp_list[m[j].trainIdx].size)
-            if s1 > s2:
-                size_diff = s1 / s2
-            else:
-                size_diff = s2 / s1
-            if size_diff > 1.25:
-                continue
-            metric = size_diff / ratio
-            #print(" ", j, m[j].distance, size_diff, metric)
-            if best_index < 0 or metric < best_metric:
-                best_metric = metric
-                best_index = j
-                best_angle = angle_diff
-                best_size = size_diff
-                best_dist = raw_dist
-                best_vangle = vangle
-        if best_index >= 0:
-            #print(i, best_index, m[best_index].distance, best_size, best_metric)
-            match_stats.append( [ m[best_index], best_index, ratio, best_metric,
-                                  best_angle, best_size, best_dist, best_vangle ] )
+    # pick the candidate with the best metric for each keypoint
+    rows = np.arange(len(idx)).reshape(-1, 1)
+    size_diff = size_ratio(i1, i2, rows, idx)
+    metric = size_diff / ratio
+    q, j = select_best(metric, valid & (size_diff <= 1.25))
+    t = idx[q, j]
+    v = uv2[t] - uv1[q]
+    best_dist = np.sqrt(np.sum(v*v, axis=1))
+    best_vangle = np.arctan2(v[:,1].astype(float), v[:,0].astype(float))
+    best_vangle[best_vangle < 0] += 2*math.pi
 
     maxdist = int(diag*0.55)
     maxrange = int(diag*0.02)
@@ -600,46 +791,28 @@ def bruteforce_pair_matches(i1, i2, review=False):
     tol = int(diag*0.005)
     if tol < 5: tol = 5
     best_fitted_matches = 0
-    dist_bins = [[] for i in range(divs + 1)]
-    print("bins:", len(dist_bins))
-    for line in match_stats:
-        best_dist = line[6]
-        bin = int(round(best_dist / step))
-        if bin < len(dist_bins):
-            dist_bins[bin].append(line)
-            if bin > 0:
-                dist_bins[bin-1].append(line)
-            if bin < len(dist_bins) - 1:
-                dist_bins[bin+1].append(line)
+    # each match goes in its distance bin and both neighbors
+    dist_bin = np.rint(best_dist / step).astype(int)
+    print("bins:", divs + 1)
         
     matches_fit = []
-    for i, dist_matches in enumerate(dist_bins):
+    for i in range(divs + 1):
+        dist_matches = np.flatnonzero((dist_bin <= divs)
+                                      & (np.abs(dist_bin - i) <= 1))
         print("bin:", i, "len:", len(dist_matches))
         best_of_bin = 0
-        divs = 20
-        step = 2*math.pi / divs
-        angle_bins = [[] for i in range(divs + 1)]
-        for line in dist_matches:
-            match = line[0]
-            vangle = line[7]
-            bin = int(round(vangle / step))
-            angle_bins[bin].append(match)
-            if bin == 0:
-                angle_bins[-1].append(match)
-                angle_bins[bin+1].append(match)
-            elif bin == divs:
-                angle_bins[bin-1].append(match)
-                angle_bins[0].append(match)
-            else:
-                angle_bins[bin-1].append(match)
-                angle_bins[bin+1].append(match)
-        for angle_matches in angle_bins:
+        adivs = 20
+        astep = 2*math.pi / adivs
+        # each match goes in its angle bin and both neighbors (the
+        # first and last bins are neighbors of each other)
+        abin = np.rint(best_vangle[dist_matches] / astep).astype(int)
+        lower = np.where(abin == 0, adivs, abin - 1)
+        upper = np.where(abin == adivs, 0, abin + 1)
+        for b in range(adivs + 1):
+            angle_matches = dist_matches[(abin == b) | (lower == b) | (upper == b)]
             if len(angle_matches) >= min_pairs:
-                src = []
-                dst = []
-                for m in angle_matches:
-                    src.append( i1.kp_list[m.queryIdx].pt )
-                    dst.append( i2.kp_list[m.trainIdx].pt )
+                src = uv1[q[angle_matches]]
+                dst = uv2[t[angle_matches]]
                 H, status = cv2.findHomography(np.array([src]).astype(np.float32),
                                                np.array([dst]).astype(np.float32),
                                                cv2.RANSAC,
@@ -648,16 +821,12 @@ def bruteforce_pair_matches(i1, i2, review=False):
                 if num_fit > best_of_bin:
                        best_of_bin = num_fit
                 if num_fit > best_fitted_matches:
-                    matches_fit = []
-                    matches_dist = []
-                    for i, m in enumerate(angle_matches):
-                        if status[i]:
-                            matches_fit.append(m)
-                            matches_dist.append(m.distance)
+                    fit = angle_matches[status.ravel() != 0]
+                    matches_fit = [ q[fit], t[fit], dist[q[fit], j[fit]] ]
                     best_fitted_matches = num_fit
                     print("Filtered matches:", len(angle_matches),
                           "Fitted matches:", num_fit)
-                    matches_dist = np.array(matches_dist)
+                    matches_dist = matches_fit[2]
                     print("avg match quality:", np.average(matches_dist))
                     print("max match quality:", np.max(matches_dist))
                     if review:
@@ -665,7 +834,7 @@ def bruteforce_pair_matches(i1, i2, review=False):
                         blend = cv2.addWeighted(i1_new, 0.5, rgb2, 0.5, 0)
                         blend = cv2.resize(blend, (int(w*detect_scale), int(h*detect_scale)))
                         cv2.imshow('blend', blend)
-                        #draw_inlier(rgb1, rgb2, i1.kp_list, i2.kp_list, matches_fit, 'ONLY_LINES', detect_scale)
+                        #draw_inlier(rgb1, rgb2, i1.kp_list, i2.kp_list, make_dmatches(*matches_fit), 'ONLY_LINES', detect_scale)
                        
         # check for diminishing returns and bail early
         print("bin:", i, "len:", len(dist_matches),
@@ -676,10 +845,8 @@ def bruteforce_pair_matches(i1, i2, review=False):
     if review:
         cv2.waitKey()
 
-    if len(matches_fit) >= min_pairs:
-        idx_pairs = []
-        for m in matches_fit:
-            idx_pairs.append( [m.queryIdx, m.trainIdx] )
+    if len(matches_fit) and len(matches_fit[0]) >= min_pairs:
+        idx_pairs = np.stack(matches_fit[:2], axis=1).tolist()
         idx_pairs = filter_duplicates(i1, i2, idx_pairs)
         if len(idx_pairs) >= min_pairs:
             rev_pairs = []
@@ -689,70 +856,192 @@ def bruteforce_pair_matches(i1, i2, review=False):
             return idx_pairs, rev_pairs
     return [], []
     
-def find_matches(proj, K, strategy="smart", transform="homography",
-                 sort=False, review=False):
-    n = len(proj.image_list) - 1
-    n_work = float(n*(n+1)/2)
-    t_start = time.time()
-
-    intervals = []
-    for i in range(len(proj.image_list)-1):
-        ned1, ypr1, q1 = proj.image_list[i].get_camera_pose()
-        ned2, ypr2, q2 = proj.image_list[i+1].get_camera_pose()
-        dist = np.linalg.norm(np.array(ned2) - np.array(ned1))
-        intervals.append(dist)
-        print(i, dist)
-    median = np.median(intervals)
-    log("Median pair interval: %.1f m" % median)
-    median_int = int(round(median))
-
-    if matcher_node.hasChild("min_dist"):
-        min_dist = matcher_node.getFloat("min_dist")
+# detect (or load cached) features for the image and then drop them
+# again, the caller only needs the cache files written.  Returns the
+# number of features, the detection step timing (None if loaded from
+# the cache) and the total time spent on the image.  rgb is the
+# (prefetched) detection image, if already loaded.
+def detect_image(image, use_cache=True, rgb=None):
+    start = time.time()
+    timing = image.detect_features(detect_scale, use_cache=use_cache,
+                                   rgb=rgb)
+    num_features = image.num_features
+    desc_cache.evict(image)
+    return num_features, timing, time.time() - start
+
+# worker process entry point, task is (image index, use_cache)
+def detect_image_task(task):
+    index, use_cache = task
+    return detect_image(pool.proj.image_list[index], use_cache)
+
+# detect the features of the images one at a time, with the next
+# images decoded in background threads
+def gen_detect_results(proj, tasks):
+    prefetcher = None
+    if prefetch_window > 0:
+        load = lambda task: proj.image_list[task[0]].load_rgb(equalize=True, scale=detect_scale)
+        prefetcher = prefetch.Prefetcher(load, tasks, window=prefetch_window)
+    for k, task in enumerate(tasks):
+        rgb = None
+        if prefetcher is not None:
+            rgb = prefetcher.get(k)
+        yield task, detect_image(proj.image_list[task[0]], task[1], rgb)
+    if prefetcher is not None:
+        prefetcher.close()
+
+# detect the features of all the images up front (optionally in a
+# pool of worker processes) so the matching stage starts with a warm
+# feature/descriptor cache.  Images with cache files are skipped
+# unless force is set.
+def detect_all_features(proj, workers=1, force=False):
+    tasks = []
+    for i, image in enumerate(proj.image_list):
+        if not force and os.path.exists(image.features_file) \
+           and os.path.exists(image.desc_file):
+            # memory mapped, this only reads the header
+            image.num_features = len(np.load(image.features_file,
+                                             mmap_mode='r'))
+            continue
+        tasks.append( (i, not force) )
+    log("Detecting features: %d images (%d already cached)" %
+        (len(tasks), len(proj.image_list) - len(tasks)))
+    if not len(tasks):
+        return
+
+    start = time.time()
+    if workers > 1:
+        log("Detecting with %d worker processes" % workers)
+        results = pool.run(detect_image_task, tasks, workers,
+                           proj.project_dir, setup=configure)
     else:
-        min_dist = 0
-    if matcher_node.hasChild("max_dist"):
-        max_dist = matcher_node.getFloat("max_dist")
-    else:
-        max_dist = median_int * 4
+        results = gen_detect_results(proj, tasks)
+    totals = {}
+    busy = 0.0
+    for task, result in tqdm(results, total=len(tasks), smoothing=0.05):
+        image = proj.image_list[task[0]]
+        num_features, timing, seconds = result
+        image.num_features = num_features
+        busy += seconds
+        if timing is None:
+            qlog("%s: %d features (cached) %.2fs" %
+                 (image.name, num_features, seconds))
+            continue
+        for key in timing:
+            totals[key] = totals.get(key, 0.0) + timing[key]
+        steps = " ".join([ "%s: %.2fs" % (key, timing[key]) for key in timing ])
+        qlog("%s: %d features %s total: %.2fs" %
+             (image.name, num_features, steps, seconds))
+    elapsed = time.time() - start
+    log("Detection time: %.1fs elapsed, %.1fs per image" %
+        (elapsed, busy / len(tasks)))
+    if len(totals):
+        log("Detection time by step:",
+            " ".join([ "%s: %.1fs" % (key, totals[key]) for key in totals ]))
+
+# make sure features/descriptors are loaded (or detected) for the
+# image and mark it as recently used in the descriptor cache
+def load_image_features(image):
+    if image.kp_array is None or image.des_list is None or not len(image.kp_array) or not len(image.des_list):
+        image.detect_features(detect_scale)
+    desc_cache.touch(image)
+
+# background load of the features/descriptors of a work list pair
+# (descriptors are read into memory rather than memory mapped so the
+# reading happens here.)  Pairs that are already done are skipped and
+# pairs with a cached result only need their features.  Everything
+# loaded here is added to the descriptor cache (and its budget) when
+# the pair is processed.
+def prefetch_pair(proj, line, strategy):
+    i1 = proj.image_list[line[1]]
+    i2 = proj.image_list[line[2]]
+    if i2.name in i1.match_list and len(i1.match_list[i2.name]):
+        return
+    need_des = not pair_cache.cached(pair_cache.pair_key(i1, i2, strategy))
+    for image in [i1, i2]:
+        if image.kp_array is None or not len(image.kp_array):
+            image.load_features()
+        if need_des and image.des_list is None:
+            image.load_descriptors(mmap=False)
+
+# match the image pair with the requested strategy and compute the
+# smart surface and yaw error estimates from the result.  The property
+# tree is not touched here, see merge_pair_result().
+def match_pair(i1, i2, strategy, review=False, ground_m=None):
+    load_image_features(i1)
+    load_image_features(i2)
+
+    if strategy == "smart":
+        match_fwd, match_rev = smart_pair_matches(i1, i2, review, ground_m)
+    elif strategy == "traditional":
+        match_fwd, match_rev = bidirectional_pair_matches(i1, i2, review)
+    elif strategy == "bruteforce":
+        match_fwd, match_rev = bruteforce_pair_matches(i1, i2)
+    return pair_estimates(i1, i2, match_fwd, match_rev)
+
+# set the pair matches and compute the smart surface and yaw error
+# estimates, returns the same result tuple as match_pair()
+def pair_estimates(i1, i2, match_fwd, match_rev):
+    i1.match_list[i2.name] = match_fwd
+    i2.match_list[i1.name] = match_rev
+
+    surface = smart.estimate_surface_elevation(i1, i2)
+    yaw1 = smart.estimate_yaw_error(i1, i2)
+    yaw2 = smart.estimate_yaw_error(i2, i1)
+    return match_fwd, match_rev, surface, yaw1, yaw2
+
+# worker process entry point: task = (i, j, strategy, ground_m, yaw1,
+# yaw2) where ground_m and the yaw error estimates are the parent's
+# most recent values at the time the task was submitted.
+def match_pair_task(task):
+    i, j, strategy, ground_m, yaw1_error, yaw2_error = task
+    i1 = pool.proj.image_list[i]
+    i2 = pool.proj.image_list[j]
+    i1.set_aircraft_yaw_error_estimate(yaw1_error)
+    i2.set_aircraft_yaw_error_estimate(yaw2_error)
+    result = match_pair(i1, i2, strategy, ground_m=ground_m)
+    # the parent owns the match lists
+    del i1.match_list[i2.name]
+    del i2.match_list[i1.name]
+    return result
 
-    log('Generating work list for range:', min_dist, '-', max_dist)
-    work_list = []
-    for i, i1 in enumerate(tqdm(proj.image_list, smoothing=0.05)):
-        ned1, ypr1, q1 = i1.get_camera_pose()
-        for j, i2 in enumerate(proj.image_list):
-            if j <= i:
-                continue
-            # camera pose distance check
-            ned2, ypr2, q2 = i2.get_camera_pose()
-            dist = np.linalg.norm(np.array(ned2) - np.array(ned1))
-            dist = int(round(dist/median_int))*median_int # discretized sorting/cache friendlier
-            if dist >= min_dist and dist <= max_dist:
-                work_list.append( [dist, i, j] )
-
-    if sort:
-        # (optional) sort worklist from closest pairs to furthest pairs
-        # (caution, this is less cache friendly, but hopefully mitigated
-        # a bit by the discritized sorting scheme.)
-        #
-        # benefits of sorting by distance: more important work is done
-        # first (chance to quit early)
-        #
-        # benefits of sorting by order: for large memory usage, active
-        # memory pool decreases as work progresses (becoming more and
-        # more system friendly as the match progresses.)
-        work_list = sorted(work_list, key=lambda fields: fields[0])
-
-    # note: image.desc_timestamp is used to unload not recently
-    # used descriptors ... these burn a ton of memory so unloading
-    # things not recently used should help our memory foot print
-    # at hopefully not too much of a performance expense.
-
-    # process the work list
+# merge the result of match_pair() into the image match lists and the
+# smart property tree
+def merge_pair_result(i1, i2, result):
+    match_fwd, match_rev, surface, yaw1, yaw2 = result
+    i1.match_list[i2.name] = match_fwd
+    i2.match_list[i1.name] = match_rev
+
+    # update surface triangulation (estimate)
+    avg, std = smart.record_surface_estimate(i1, i2, *surface)
+    if avg and std:
+        qlog(" ", i1.name, i2.name, "surface est: %.1f" % avg, "std: %.1f" % std)
+    yaw1_error = smart.record_yaw_error_estimate(i1, i2, *yaw1)
+    i1.set_aircraft_yaw_error_estimate(yaw1_error)
+    yaw2_error = smart.record_yaw_error_estimate(i2, i1, *yaw2)
+    i2.set_aircraft_yaw_error_estimate(yaw2_error)
+
+    # new feature, depends on a reasonably quality initial camera
+    # pose!  caution: I've put a policy setting here in the middle
+    # of a capability for initial testing.  if we find a match,
+    # but the std dev of the altitude of the triangulated features
+    # > 25 (m) then we think this is a bad match and we delete the
+    # pairs.
+    if std and std >= 50 and len(i1.match_list[i2.name]) < 100:
+        log("Std dev of surface triangulation blew up, matches are probably bad so discarding them!", i1.name, i2.name, "avg:", avg, "std:", std, "count:", len(match_fwd))
+        #showMatchOrient(i1, i2, i1.match_list[i2.name])
+        i1.match_list[i2.name] = []
+        i2.match_list[i1.name] = []
+
+# walk the work list (with eta estimation) and yield the image pairs
+# that still need to be matched as worker tasks.  Pairs found in the
+# pair cache are merged right here.  The (optional) prefetcher loads
+# the features of the upcoming work list pairs.
+def gen_pair_tasks(proj, work_list, strategy, parallel, prefetcher=None):
+    t_start = time.time()
     n_count = 0
-    save_time = time.time()
-    save_interval = 300     # seconds
-    log("Processing worklist matches:")
     for line in tqdm(work_list, smoothing=0.05):
+        if prefetcher is not None:
+            prefetcher.get(n_count)
         dist = line[0]
         i = line[1]
         j = line[2]
@@ -785,68 +1074,248 @@ def find_matches(proj, K, strategy="smart", transform="homography",
         qlog(msg)
         qlog("  separation (approx) = %.0f (m)" % dist)
 
-        # update cache timers and make sure features/descriptors are loaded
-        i1.desc_timestamp = time.time()
-        i2.desc_timestamp = time.time()
-        if i1.kp_list is None or i1.des_list is None or not len(i1.kp_list) or not len(i1.des_list):
-            i1.detect_features(detect_scale)
-        if i2.kp_list is None or i2.des_list is None or not len(i2.kp_list) or not len(i2.des_list):
-            i2.detect_features(detect_scale)
-
-        if strategy == "smart":
-            match_fwd, match_rev = smart_pair_matches(i1, i2, review)
-        elif strategy == "traditional":
-            match_fwd, match_rev = bidirectional_pair_matches(i1, i2, review)
-        elif strategy == "bruteforce":
-            match_fwd, match_rev = bruteforce_pair_matches(i1, i2)
-        i1.match_list[i2.name] = match_fwd
-        i2.match_list[i1.name] = match_rev
-
-        # update surface triangulation (estimate)
-        avg, std = smart.update_surface_estimate(i1, i2)
-        if avg and std:
-            qlog(" ", i1.name, i2.name, "surface est: %.1f" % avg, "std: %.1f" % std)
-        yaw1_error = smart.update_yaw_error_estimate(i1, i2)
-        i1.set_aircraft_yaw_error_estimate(yaw1_error)
-        yaw2_error = smart.update_yaw_error_estimate(i2, i1)
-        i2.set_aircraft_yaw_error_estimate(yaw2_error)
-
-        # new feature, depends on a reasonably quality initial camera
-        # pose!  caution: I've put a policy setting here in the middle
-        # of a capability for initial testing.  if we find a match,
-        # but the std dev of the altitude of the triangulated features
-        # > 25 (m) then we think this is a bad match and we delete the
-        # pairs.
-        if std and std >= 50 and len(i1.match_list[i2.name]) < 100:
-            log("Std dev of surface triangulation blew up, matches are probably bad so discarding them!", i1.name, i2.name, "avg:", avg, "std:", std, "count:", len(match_fwd))
-            #showMatchOrient(i1, i2, i1.match_list[i2.name])
-            i1.match_list[i2.name] = []
-            i2.match_list[i1.name] = []
-        # save our work so far, and flush descriptor cache
+        cached = pair_cache.lookup(pair_cache.pair_key(i1, i2, strategy))
+        if cached is not None:
+            qlog("  using cached result")
+            merge_pair_result(i1, i2, pair_estimates(i1, i2, *cached))
+            # the features are loaded now (for the estimates), keep
+            # them under the cache budget
+            desc_cache.touch(i1)
+            desc_cache.touch(i2)
+            continue
+
+        ground_m = None
+        yaw1_error = None
+        yaw2_error = None
+        if parallel:
+            # workers don't see our property tree updates, so hand
+            # them our current ground and yaw error estimates
+            if not matcher_node.hasChild("ground_m"):
+                ground_m = smart.get_surface_estimate(i1, i2)
+            yaw1_error = i1.get_aircraft_yaw_error_estimate()
+            yaw2_error = i2.get_aircraft_yaw_error_estimate()
+        yield (i, j, strategy, ground_m, yaw1_error, yaw2_error)
+
+# find all the image pairs (i < j) with a camera separation in the
+# [min_dist, max_dist] range.  Distances are discretized to multiples
+# of median_int (sorting/cache friendlier) and the pairs are returned
+# as [dist, i, j] records in (i, j) order.  Candidate pairs come from a
+# kd-tree radius query so we avoid visiting all n^2 pairs.
+def gen_work_list(ned, median_int, min_dist, max_dist):
+    if len(ned) < 2:
+        return []
+    # a pair rounds down into range if it is within half an interval
+    # of max_dist
+    radius = max_dist + 0.5 * median_int + 1.0
+    tree = scipy.spatial.cKDTree(ned)
+    pairs = tree.query_pairs(radius, output_type='ndarray')
+    if not len(pairs):
+        return []
+    order = np.lexsort((pairs[:,1], pairs[:,0]))
+    pairs = pairs[order]
+    dist = np.linalg.norm(ned[pairs[:,1]] - ned[pairs[:,0]], axis=1)
+    # discretized sorting/cache friendlier (np.rint rounds half to
+    # even just like round())
+    dist = np.rint(dist / median_int).astype(int) * median_int
+    keep = (dist >= min_dist) & (dist <= max_dist)
+    return [ [d, i, j] for d, i, j in zip(dist[keep].tolist(),
+                                        pairs[keep,0].tolist(),
+                                        pairs[keep,1].tolist()) ]
+
+# project the image outline onto the ground (the forced ground_m or
+# the srtm surface under the camera) and return the convex hull of the
+# footprint in NE coordinates.  Rays that miss the ground (at or above
+# the horizon) or hit it further out than the maximum ground range
+# (/config/matcher/max_range, default 5x the camera height above
+# ground) are clipped to that range, so oblique footprints stay
+# bounded.
+def image_footprint(image, IK, outline):
+    if matcher_node.hasChild("ground_m"):
+        ground_m = matcher_node.getFloat("ground_m")
+    else:
+        ground_m = smart.get_srtm_surface(image)
+    proj_list = project.projectVectors( IK, image.get_body2ned(),
+                                        image.get_cam2body(), outline )
+    ned, ypr, quat = image.get_camera_pose()
+    agl = -(ned[2] + ground_m)
+    if matcher_node.hasChild("max_range"):
+        max_range = matcher_node.getFloat("max_range")
+    else:
+        max_range = 5 * max(agl, 1.0)
+    v = np.array(proj_list)
+    horiz = np.linalg.norm(v[:,:2], axis=1)
+    dirs = v[:,:2] / np.where(horiz > 0, horiz, 1.0)[:,np.newaxis]
+    hits = (v[:,2] > 0) & (agl > 0)
+    offsets = dirs * max_range
+    factor = agl / v[hits,2]
+    offsets[hits] = v[hits,:2] * factor[:,np.newaxis]
+    ground_range = np.linalg.norm(offsets, axis=1)
+    far = ground_range > max_range
+    offsets[far] = dirs[far] * max_range
+    pts = (np.array(ned[:2]) + offsets).astype(np.float32)
+    return cv2.convexHull(pts).reshape(-1, 2)
+
+# find all the image pairs (i < j) whose ground footprints overlap by
+# at least min_overlap (intersection area as a fraction of the smaller
+# footprint.)  Returns [dist, i, j] records (dist is the camera
+# separation) and the overlap of each pair, in (i, j) order.
+def gen_footprint_work_list(proj, min_overlap):
+    K = camera.get_K()
+    IK = np.linalg.inv(K)
+    w, h = camera.get_image_params()
+    outline = gen_grid(w, h, 4)
+    hulls = []
+    centers = []
+    radius = []
+    areas = []
+    ned_list = []
+    for image in tqdm(proj.image_list, smoothing=0.05):
+        hull = image_footprint(image, IK, outline)
+        center = np.mean(hull, axis=0)
+        hulls.append(hull)
+        centers.append(center)
+        radius.append(np.max(np.linalg.norm(hull - center, axis=1)))
+        areas.append(cv2.contourArea(hull))
+        ned, ypr, quat = image.get_camera_pose()
+        ned_list.append(ned)
+    if len(hulls) < 2:
+        return [], []
+    ned_list = np.array(ned_list)
+
+    # only footprints with intersecting bounding circles can overlap:
+    # query each center with its own radius plus the largest one (so a
+    # few large footprints don't make every query near all-pairs) and
+    # then check the actual radius of each candidate
+    radius = np.array(radius)
+    tree = scipy.spatial.cKDTree(np.array(centers))
+    neighbors = tree.query_ball_point(np.array(centers),
+                                      radius + np.max(radius))
+    pairs = [ (i, j) for i in range(len(hulls))
+              for j in sorted(neighbors[i]) if j > i ]
+    work_list = []
+    overlaps = []
+    for i, j in pairs:
+        if np.linalg.norm(centers[j] - centers[i]) > radius[i] + radius[j]:
+            continue
+        area, poly = cv2.intersectConvexConvex(hulls[i], hulls[j])
+        min_area = min(areas[i], areas[j])
+        if min_area <= 0:
+            continue
+        overlap = area / min_area
+        if overlap >= min_overlap:
+            dist = np.linalg.norm(ned_list[j] - ned_list[i])
+            work_list.append( [dist, i, j] )
+            overlaps.append(overlap)
+    return work_list, overlaps
+
+def find_matches(proj, K, strategy="smart", transform="homography",
+                 sort=False, review=False, workers=1, rematch=False,
+                 schedule="distance"):
+    n = len(proj.image_list) - 1
+    n_work = float(n*(n+1)/2)
+
+    if schedule == "footprint":
+        # pairs with overlapping (projected) ground footprints
+        min_overlap = matcher_node.getFloat("min_overlap")
+        log('Generating work list for footprint overlap >= %.2f' % min_overlap)
+        work_list, overlaps = gen_footprint_work_list(proj, min_overlap)
+        if sort:
+            # (optional) sort worklist from most to least overlap
+            order = sorted(range(len(work_list)),
+                           key=lambda k: overlaps[k], reverse=True)
+            work_list = [ work_list[k] for k in order ]
+    else:
+        intervals = []
+        for i in range(len(proj.image_list)-1):
+            ned1, ypr1, q1 = proj.image_list[i].get_camera_pose()
+            ned2, ypr2, q2 = proj.image_list[i+1].get_camera_pose()
+            dist = np.linalg.norm(np.array(ned2) - np.array(ned1))
+            intervals.append(dist)
+            print(i, dist)
+        median = np.median(intervals)
+        log("Median pair interval: %.1f m" % median)
+        median_int = int(round(median))
+
+        if matcher_node.hasChild("min_dist"):
+            min_dist = matcher_node.getFloat("min_dist")
+        else:
+            min_dist = 0
+        if matcher_node.hasChild("max_dist"):
+            max_dist = matcher_node.getFloat("max_dist")
+        else:
+            max_dist = median_int * 4
+
+        log('Generating work list for range:', min_dist, '-', max_dist)
+        ned_list = []
+        for i1 in proj.image_list:
+            ned, ypr, q = i1.get_camera_pose()
+            ned_list.append(ned)
+        work_list = gen_work_list(np.array(ned_list), median_int,
+                                  min_dist, max_dist)
+
+        if sort:
+            # (optional) sort worklist from closest pairs to furthest pairs
+            # (caution, this is less cache friendly, but hopefully mitigated
+            # a bit by the discritized sorting scheme.)
+            #
+            # benefits of sorting by distance: more important work is done
+            # first (chance to quit early)
+            #
+            # benefits of sorting by order: for large memory usage, active
+            # memory pool decreases as work progresses (becoming more and
+            # more system friendly as the match progresses.)
+            work_list = sorted(work_list, key=lambda fields: fields[0])
+
+    # note: keypoints/descriptors burn a ton of memory so the
+    # descriptor cache unloads the least recently used ones when we
+    # go over the configured memory budget.
+
+    # process the work list.  With workers > 1 the pairs are matched
+    # in a pool of worker processes (each loading descriptors on
+    # demand) and the results are merged here as they complete.
+    save_time = time.time()
+    save_interval = 300     # seconds
+    log("Processing worklist matches:", len(work_list), "pairs")
+    pair_cache.init(proj.analysis_dir, rematch)
+    prefetcher = None
+    if workers <= 1 and prefetch_window > 0:
+        load = lambda line: prefetch_pair(proj, line, strategy)
+        prefetcher = prefetch.Prefetcher(load, work_list,
+                                         window=prefetch_window)
+    tasks = gen_pair_tasks(proj, work_list, strategy, workers > 1,
+                           prefetcher)
+    if workers > 1:
+        log("Matching with %d worker processes" % workers)
+        results = pool.run(match_pair_task, tasks, workers,
+                           proj.project_dir, setup=configure)
+    else:
+        results = ( (task, match_pair(proj.image_list[task[0]],
+                                      proj.image_list[task[1]],
+                                      strategy, review))
+                    for task in tasks )
+    for task, result in results:
+        i1 = proj.image_list[task[0]]
+        i2 = proj.image_list[task[1]]
+        merge_pair_result(i1, i2, result)
+        pair_cache.store(pair_cache.pair_key(i1, i2, strategy),
+                         result[0], result[1])
+
+        # save our work so far
         if time.time() >= save_time + save_interval:
             log('saving matches and image meta data ...')
             saveMatches(proj.image_list)
             smart.save(proj.analysis_dir)
+            pair_cache.save()
             save_time = time.time()
-            time_list = []
-            for i3 in proj.image_list:
-                if not i3.des_list is None:
-                    time_list.append( [i3.desc_timestamp, i3] )
-            time_list = sorted(time_list, key=lambda fields: fields[0],
-                               reverse=True)
-            # may wish to monitor and update cache_size formula
-            cache_size = 20 + 5 * (int(math.sqrt(len(proj.image_list))) + 1)
-            flush_list = time_list[cache_size:]
-            qlog("flushing keypoint/descriptor cache - size: %d (over by: %d)" % (cache_size, len(flush_list)) )
-            for line in flush_list:
-                qlog('  clearing descriptors for:', line[1].name)
-                line[1].kp_list = None
-                line[1].des_list = None
-                line[1].uv_list = None
+
+    if prefetcher is not None:
+        prefetcher.close()
 
     # and the final save
     saveMatches(proj.image_list)
     smart.save(proj.analysis_dir)
+    pair_cache.save()
+    pair_cache.report()
     print('Pair-wise matches successfully saved.')
 
 def saveMatches(image_list):
@@ -15,10 +15,13 @@ import math
 # from matplotlib import cm
 import numpy as np
 from scipy.optimize import least_squares
-from scipy.sparse import lil_matrix
+from scipy.sparse import csr_matrix
 
 from . import camera
+from . import groups
 from .logger import log, qlog
+from . import pool
+from . import tracks
 from . import transformations
 
 d2r = math.pi / 180.0
@@ -62,6 +65,37 @@ def transform_points( A, pts_list ):
                          float(dst[2][i]) ] )
     return result
 
+# skew symmetric (cross product) matrices (n,3,3) for an (n,3) array
+def skew(v):
+    S = np.zeros((len(v), 3, 3))
+    S[:,0,1] = -v[:,2]
+    S[:,0,2] = v[:,1]
+    S[:,1,0] = v[:,2]
+    S[:,1,2] = -v[:,0]
+    S[:,2,0] = -v[:,1]
+    S[:,2,1] = v[:,0]
+    return S
+
+# rotation matrices (n,3,3) for an (n,3) array of rodrigues vectors
+# (the same as cv2.Rodrigues() for each one)
+def rodrigues(rvecs):
+    theta = np.linalg.norm(rvecs, axis=1)
+    small = theta < np.finfo(float).eps
+    k = rvecs / np.where(small, 1.0, theta)[:,np.newaxis]
+    c = np.where(small, 1.0, np.cos(theta))[:,np.newaxis,np.newaxis]
+    s = np.where(small, 0.0, np.sin(theta))[:,np.newaxis,np.newaxis]
+    R = (1 - c) * k[:,:,np.newaxis] * k[:,np.newaxis,:] + s * skew(k)
+    R[:,0,0] += c[:,0,0]
+    R[:,1,1] += c[:,0,0]
+    R[:,2,2] += c[:,0,0]
+    return R
+
+# mark all the optimized poses as invalid
+def invalidate_poses(proj):
+    for image in proj.image_list:
+        opt_cam_node = image.node.getChild('camera_pose_opt', True)
+        opt_cam_node.setBool('valid', False)
+
 # This is a python class that optimizes the estimate camera and 3d
 # point fits by minimizing the mean reprojection error.
 class Optimizer():
@@ -81,6 +115,7 @@ class Optimizer():
         self.ftol = 1e-4              # stop condition - better
         self.min_chain_len = 2        # use whatever matches are defind upstream
         self.with_bounds = True
+        self.analytic_jac = True      # False = finite differences
         self.ncp = 6
 
     # plot range
@@ -120,39 +155,34 @@ class Optimizer():
         n = n_cameras * self.ncp + n_points * 3
         if self.optimize_calib == 'global':
             n += 8  # three K params (fx == fy) + five distortion params
-        A = lil_matrix((m, n), dtype=int)
         log('sparsity matrix is %d x %d' % (m, n))
-
-        i = np.arange(camera_indices.size)
-        for s in range(self.ncp):
-            A[2 * i, camera_indices * self.ncp + s] = 1
-            A[2 * i + 1, camera_indices * self.ncp + s] = 1
-
-        for s in range(3):
-            A[2 * i, n_cameras * self.ncp + point_indices * 3 + s] = 1
-            A[2 * i + 1, n_cameras * self.ncp + point_indices * 3 + s] = 1
-
-        if self.optimize_calib == 'global':
-            for s in range(0,3): # K
-                A[2 * i, n_cameras * self.ncp + n_points * 3 + s] = 1
-                A[2 * i + 1, n_cameras * self.ncp + n_points * 3 + s] = 1
-            for s in range(3,8): # dist coeffs
-                A[2 * i, n_cameras * self.ncp + n_points * 3 + s] = 1
-                A[2 * i + 1, n_cameras * self.ncp + n_points * 3 + s] = 1
-
+        cols = self.jacobian_columns(n_cameras, n_points, camera_indices,
+                                     point_indices)
+        n_cols = len(cols) // m if m else 0
+        indptr = np.arange(m + 1, dtype=np.int64) * n_cols
+        A = csr_matrix((np.ones(len(cols), dtype=int), cols, indptr),
+                       shape=(m, n))
         log('A-matrix non-zero elements:', A.nnz)
         return A
 
-    # compute an array of residuals (one for each observation)
-    # params contains camera parameters, 3-D coordinates, and
-    # camera calibration parameters.
-    def fun(self, params, n_cameras, n_points, by_camera_point_indices, by_camera_points_2d):
-        error = None
-        # extract the parameters
-        camera_params = params[:n_cameras * self.ncp].reshape((n_cameras, self.ncp))
-        
-        points_3d = params[n_cameras * self.ncp:n_cameras * self.ncp + n_points * 3].reshape((n_points, 3))
-        
+    # column index of each jacobian (or sparsity) entry, row by row.
+    # The two rows of an observation share the same columns: the
+    # camera parameters, the point coordinates, and the global
+    # calibration (if optimized.)
+    def jacobian_columns(self, n_cameras, n_points, camera_indices,
+                         point_indices):
+        n_cols = self.ncp + 3
+        if self.optimize_calib == 'global':
+            n_cols += 8
+        cols = np.empty((camera_indices.size, n_cols), dtype=np.int64)
+        cols[:,:self.ncp] = camera_indices[:,np.newaxis] * self.ncp + np.arange(self.ncp)
+        cols[:,self.ncp:self.ncp+3] = n_cameras * self.ncp + point_indices[:,np.newaxis] * 3 + np.arange(3)
+        if self.optimize_calib == 'global':
+            cols[:,self.ncp+3:] = n_cameras * self.ncp + n_points * 3 + np.arange(8)
+        return np.repeat(cols, 2, axis=0).ravel()
+
+    # the camera calibration (K, distCoeffs) for a parameter vector
+    def get_calib(self, params, n_cameras, n_points):
         if self.optimize_calib == 'global':
             # assemble K and distCoeffs from the optimizer param list
             camera_calib = params[n_cameras * self.ncp + n_points * 3:]
@@ -166,50 +196,61 @@ class Optimizer():
             # use a fixed K and distCoeffs
             K = self.K
             distCoeffs = self.distCoeffs
+        return K, distCoeffs
+
+    # allocate the work buffers for fun() and jac() (once the
+    # observations are known.)
+    def alloc_buffers(self):
+        n_obs = len(self.camera_indices)
+        self.buf_R = np.empty((n_obs, 3, 3))
+        self.buf_X = np.empty((n_obs, 3))
+        self.buf_t = np.empty((n_obs, 3))
+        self.buf_p = np.empty((n_obs, 3))
+        self.jac_cols = self.jacobian_columns(self.n_cameras, self.n_points,
+                                              self.camera_indices,
+                                              self.point_indices)
+
+    # compute an array of residuals (u, v for each observation, in
+    # order of camera_indices/point_indices) params contains camera
+    # parameters, 3-D coordinates, and camera calibration parameters.
+    # All the observations are rotated, projected and distorted
+    # together (the opencv 5 coefficient model, same as
+    # cv2.projectPoints().)  The per observation work arrays are
+    # preallocated, the result is a new array each call (least_squares
+    # keeps previous results around.)
+    def fun(self, params, n_cameras, n_points, by_camera_point_indices=None,
+            by_camera_points_2d=None):
+        camera_params = params[:n_cameras * self.ncp].reshape((n_cameras, self.ncp))
+        points_3d = params[n_cameras * self.ncp:n_cameras * self.ncp + n_points * 3].reshape((n_points, 3))
+        K, distCoeffs = self.get_calib(params, n_cameras, n_points)
+        dist = np.zeros(5)
+        dist[:min(5, len(distCoeffs))] = distCoeffs[:5]
+        k1, k2, p1, p2, k3 = dist
+
+        # camera frame coordinates of each observed point
+        R = rodrigues(camera_params[:,:3])
+        np.take(R, self.camera_indices, axis=0, out=self.buf_R)
+        np.take(points_3d, self.point_indices, axis=0, out=self.buf_X)
+        np.take(camera_params[:,3:6], self.camera_indices, axis=0, out=self.buf_t)
+        p = self.buf_p
+        np.einsum('nij,nj->ni', self.buf_R, self.buf_X, out=p)
+        p += self.buf_t
+
+        # project and distort
+        x = p[:,0] / p[:,2]
+        y = p[:,1] / p[:,2]
+        xy = x * y
+        r2 = x * x + y * y
+        radial = 1 + r2 * (k1 + r2 * (k2 + r2 * k3))
+        xd = x * radial + 2 * p1 * xy + p2 * (r2 + 2 * x * x)
+        yd = y * radial + p1 * (r2 + 2 * y * y) + 2 * p2 * xy
+
+        error = np.empty(2 * len(x))
+        error[0::2] = self.points_2d[:,0] - (K[0,0] * xd + K[0,2])
+        error[1::2] = self.points_2d[:,1] - (K[1,1] * yd + K[1,2])
 
-        #fixme: global calibration optimization, but force distortion
-        #paramters to stay fixed to those originally given
-        #distCoeffs = self.distCoeffs
-
-        sum = 0
-        # cams_3d = np.zeros((n_cameras, 3)) # for plotting
-        by_cam = []             # for debugging data set problems
-        for i, cam in enumerate(camera_params):
-            rvec = cam[:3]
-            tvec = cam[3:6]
-            # ypr, ned = self.rvectvec2yprned(rvec, tvec)
-            # cams_3d[i] = ned # for plotting
-            if len(by_camera_point_indices[i]) == 0:
-                continue
-            proj_points, jac = cv2.projectPoints(points_3d[by_camera_point_indices[i]], rvec, tvec, K, distCoeffs)
-            sum += len(proj_points.ravel())
-            cam_error = (by_camera_points_2d[i] - proj_points).ravel()
-            by_cam.append( [np.mean(np.abs(cam_error)),
-                            np.amax(np.abs(cam_error)),
-                            self.camera_map_fwd[i] ] )
-            if error is None:
-                error = cam_error
-            else:
-                error = np.append(error, cam_error)
-
-        mre = np.mean(np.abs(error))
-        std = np.std(error)
-
-        # debug
-        count_std = 0
-        count_bad = 0
-        for e in error.tolist():
-            if e > mre + 3 * std:
-                count_std += 1
-            if e > 10000:
-                count_bad += 1
-        # print( 'std: %.2f %d/%d > 3*std (max: %.2f)' % (std, count_std, error.shape[0], np.amax(error)) )
-        # by_cam = sorted(by_cam, key=lambda fields: fields[0], reverse=True)
-        # for line in by_cam:
-        #     if line[0] > mre + 2*std:
-        #         print("  %s -- mean: %.3f max: %.3f" % (line[2], line[0], line[1]))
-        
         # provide some runtime feedback for the operator
+        mre = np.mean(np.abs(error))
         if self.last_mre is None or 1.0 - mre/self.last_mre > 0.001:
             # mre has improved by more than 0.1%
             self.last_mre = mre
@@ -219,32 +260,105 @@ class Optimizer():
                 log("distCoeffs: %.3f %.3f %.3f %.3f %.3f" %
                     (distCoeffs[0], distCoeffs[1], distCoeffs[2],
                      distCoeffs[3], distCoeffs[4]))
-            # if not self.graph is None:
-            #     points = points_3d
-            #     #points = cams_3d
-            #     self.graph.set_offsets(points[:,[1,0]])
-            #     self.graph.set_array(-points[:,2])
-            #     xmin, xmax = self.my_plot_range(points[:,1])
-            #     ymin, ymax = self.my_plot_range(points[:,0])
-            #     plt.xlim(xmin, xmax)
-            #     plt.ylim(ymin, ymax)
-            #     cmin, cmax = self.my_plot_range(-points[:,2], stats=True)
-            #     plt.clim(cmin, cmax)
-            #     plt.gcf().set_size_inches(16,9,forward=True)
-            #     plt.draw()
-            #     if False:
-            #         # animate the optimizer progress as a movie
-            #         # ex: ffmpeg -f image2 -r 2 -s 1280x720 -i optimizer-%03d.png -vcodec libx264 -crf 25  -pix_fmt yuv420p optimizer.mp4
-            #         plt_name = 'optimizer-%03d.png' % self.graph_counter
-            #         out_file = os.path.join(self.root, plt_name)
-            #         plt.savefig(out_file, dpi=80)
-            #         self.graph_counter += 1
-            #     plt.pause(0.01)
         return error
 
+    # analytic jacobian of fun() as a csr matrix with the same layout
+    # as bundle_adjustment_sparsity().  The residual is observed -
+    # projected so all the derivatives are of -projected.
+    def jac(self, params, n_cameras, n_points, by_camera_point_indices=None,
+            by_camera_points_2d=None):
+        camera_params = params[:n_cameras * self.ncp].reshape((n_cameras, self.ncp))
+        points_3d = params[n_cameras * self.ncp:n_cameras * self.ncp + n_points * 3].reshape((n_points, 3))
+        K, distCoeffs = self.get_calib(params, n_cameras, n_points)
+        dist = np.zeros(5)
+        dist[:min(5, len(distCoeffs))] = distCoeffs[:5]
+        k1, k2, p1, p2, k3 = dist
+        fx = K[0,0]
+        fy = K[1,1]
+        n_obs = len(self.camera_indices)
+
+        # camera frame coordinates (same as fun())
+        rvecs = camera_params[:,:3]
+        R = rodrigues(rvecs)
+        np.take(R, self.camera_indices, axis=0, out=self.buf_R)
+        np.take(points_3d, self.point_indices, axis=0, out=self.buf_X)
+        np.take(camera_params[:,3:6], self.camera_indices, axis=0, out=self.buf_t)
+        p = self.buf_p
+        np.einsum('nij,nj->ni', self.buf_R, self.buf_X, out=p)
+        p += self.buf_t
+        x = p[:,0] / p[:,2]
+        y = p[:,1] / p[:,2]
+        xy = x * y
+        r2 = x * x + y * y
+        radial = 1 + r2 * (k1 + r2 * (k2 + r2 * k3))
+        dradial = k1 + r2 * (2 * k2 + 3 * k3 * r2)  # d radial / d r2
+
+        # d(u, v) / d(camera frame point): (n,2,3)
+        iz = 1.0 / p[:,2]
+        dxd_dx = radial + 2 * x * x * dradial + 2 * p1 * y + 6 * p2 * x
+        dxd_dy = 2 * x * y * dradial + 2 * p1 * x + 2 * p2 * y
+        dyd_dx = dxd_dy
+        dyd_dy = radial + 2 * y * y * dradial + 6 * p1 * y + 2 * p2 * x
+        duv_dp = np.empty((n_obs, 2, 3))
+        duv_dp[:,0,0] = fx * dxd_dx * iz
+        duv_dp[:,0,1] = fx * dxd_dy * iz
+        duv_dp[:,0,2] = -fx * (dxd_dx * x + dxd_dy * y) * iz
+        duv_dp[:,1,0] = fy * dyd_dx * iz
+        duv_dp[:,1,1] = fy * dyd_dy * iz
+        duv_dp[:,1,2] = -fy * (dyd_dx * x + dyd_dy * y) * iz
+
+        # d(R X) / d(rvec) for each camera (Gallego & Yezzi, "A
+        # compact formula for the derivative of a 3-D rotation in
+        # exponential coordinates"):
+        #   -R [X]x (r r' + (R' - I) [r]x) / |r|^2
+        #   = -[R X]x R (r r' + (R' - I) [r]x) / |r|^2
+        # which is -[X]x for a (near) zero rotation.
+        theta2 = np.sum(rvecs * rvecs, axis=1)
+        small = theta2 < np.finfo(float).eps
+        M = rvecs[:,:,np.newaxis] * rvecs[:,np.newaxis,:] \
+            + np.einsum('nji,njk->nik', R - np.identity(3), skew(rvecs))
+        M /= np.where(small, 1.0, theta2)[:,np.newaxis,np.newaxis]
+        M[small] = np.identity(3)
+        RM = np.einsum('nij,njk->nik', R, M)
+        RX = p - self.buf_t
+        dp_dr = -np.einsum('nij,njk->nik', skew(RX), np.take(RM, self.camera_indices, axis=0))
+
+        n_cols = len(self.jac_cols) // (2 * n_obs) if n_obs else 0
+        data = np.empty((n_obs, 2, n_cols))
+        data[:,:,0:3] = -np.einsum('nij,njk->nik', duv_dp, dp_dr)
+        data[:,:,3:6] = -duv_dp
+        data[:,:,6:9] = -np.einsum('nij,njk->nik', duv_dp, self.buf_R)
+        if self.optimize_calib == 'global':
+            # f (fx == fy), cu, cv, k1, k2, p1, p2, k3
+            xd = x * radial + 2 * p1 * xy + p2 * (r2 + 2 * x * x)
+            yd = y * radial + p1 * (r2 + 2 * y * y) + 2 * p2 * xy
+            r4 = r2 * r2
+            data[:,0,9] = -xd
+            data[:,1,9] = -yd
+            data[:,0,10] = -1
+            data[:,1,10] = 0
+            data[:,0,11] = 0
+            data[:,1,11] = -1
+            data[:,0,12] = -fx * x * r2
+            data[:,1,12] = -fy * y * r2
+            data[:,0,13] = -fx * x * r4
+            data[:,1,13] = -fy * y * r4
+            data[:,0,14] = -fx * 2 * xy
+            data[:,1,14] = -fy * (r2 + 2 * y * y)
+            data[:,0,15] = -fx * (r2 + 2 * x * x)
+            data[:,1,15] = -fy * 2 * xy
+            data[:,0,16] = -fx * x * r4 * r2
+            data[:,1,16] = -fy * y * r4 * r2
+
+        m = 2 * n_obs
+        n = len(params)
+        indptr = np.arange(m + 1, dtype=np.int64) * n_cols
+        return csr_matrix((data.ravel(), self.jac_cols, indptr), shape=(m, n))
+
     # assemble the structures and remapping indices required for
-    # optimizing a group of images/features
-    def setup(self, proj, groups, group_index, matches_list, optimized=False,
+    # optimizing a group of images/features.  tracks is a tracks.Tracks
+    # store (all columns.)
+    def setup(self, proj, groups, group_index, tracks, optimized=False,
               cam_calib=False):
         log('Setting up optimizer data structures...')
         if cam_calib:
@@ -272,10 +386,6 @@ class Optimizer():
         #print(self.camera_map_fwd)
         #print(self.camera_map_rev)
         
-        # initialize the feature index remapping
-        self.feat_map_fwd = {}
-        self.feat_map_rev = {}
-
         self.K = camera.get_K(optimized)
         self.distCoeffs = np.array(camera.get_dist_coeffs(optimized))
         
@@ -287,82 +397,54 @@ class Optimizer():
             rvec, tvec = image.get_proj(optimized)
             self.camera_params[cam_idx*self.ncp:cam_idx*self.ncp+self.ncp] = np.append(rvec, tvec)
 
-        # count number of 3d points and observations
-        self.n_points = 0
-        n_observations = 0
-        for i, match in enumerate(matches_list):
-            # count the number of referenced observations
-            if match[1] == group_index: # used by the current group
-                count = 0
-                for m in match[2:]:
-                    if m[0] in placed_images:
-                        count += 1
-                if count >= self.min_chain_len:
-                    n_observations += count
-                    self.n_points += 1
-
-        # assemble 3d point estimates and build indexing maps
-        self.points_3d = np.empty(self.n_points * 3)
-        point_idx = 0
-        feat_used = 0
-        for i, match in enumerate(matches_list):
-            if match[1] == group_index: # used by the current group
-                count = 0
-                for m in match[2:]:
-                    if m[0] in placed_images:
-                        count += 1
-                if count >= self.min_chain_len:
-                    self.feat_map_fwd[i] = feat_used
-                    self.feat_map_rev[feat_used] = i
-                    feat_used += 1
-                    ned = np.array(match[0])
-                    if np.any(np.isnan(ned)):
-                        print(i, ned)
-                    self.points_3d[point_idx] = ned[0]
-                    self.points_3d[point_idx+1] = ned[1]
-                    self.points_3d[point_idx+2] = ned[2]
-                    point_idx += 3
-                
-        # assemble observations (image index, feature index, u, v)
-        self.by_camera_point_indices = [ [] for i in range(self.n_cameras) ]
-        self.by_camera_points_2d = [ [] for i in range(self.n_cameras) ]
-        #print('by_camera:', by_camera)
-        #points_2d = np.empty((n_observations, 2))
-        #obs_idx = 0
-        for i, match in enumerate(matches_list):
-            if match[1] == group_index: # used by the current group
-                count = 0
-                for m in match[2:]:
-                    if m[0] in placed_images:
-                        count += 1
-                if count >= self.min_chain_len:
-                    for m in match[2:]:
-                        if m[0] in placed_images:
-                            cam_index = self.camera_map_rev[m[0]]
-                            feat_index = self.feat_map_fwd[i]
-                            kp = m[1] # orig/distorted
-                            #kp = proj.image_list[m[0]].uv_list[m[1]] # undistorted
-                            self.by_camera_point_indices[cam_index].append(feat_index)
-                            self.by_camera_points_2d[cam_index].append(kp)
-
-        # convert to numpy native structures
-        for i in range(self.n_cameras):
-            size = len(self.by_camera_point_indices[i])
-            self.by_camera_point_indices[i] = np.array(self.by_camera_point_indices[i])
-            self.by_camera_points_2d[i] = np.asarray([self.by_camera_points_2d[i]]).reshape(size, 1, 2)
-
-        # generate the camera and point indices (for mapping the
-        # sparse jacobian entries which define which observations
-        # depend on which parameters.)
-        self.camera_indices = np.empty(n_observations, dtype=int)
-        self.point_indices = np.empty(n_observations, dtype=int)
-        obs_idx = 0
-        for i in range(self.n_cameras):
-            for j in range(len(self.by_camera_point_indices[i])):
-                self.camera_indices[obs_idx] = i
-                self.point_indices[obs_idx] = self.by_camera_point_indices[i][j]
-                obs_idx += 1
-        log("num observations:", obs_idx)
+        # the observations of the tracks in the current group (only
+        # the observations from placed images count), gathered in one
+        # pass over the track columns
+        cam_of_image = np.full(len(proj.image_list), -1, dtype=np.int64)
+        for index, i in self.camera_map_rev.items():
+            cam_of_image[index] = i
+        group_tracks = np.flatnonzero(np.asarray(tracks.group) == group_index)
+        starts = np.asarray(tracks.offsets[group_tracks])
+        sizes = np.asarray(tracks.offsets[group_tracks + 1]) - starts
+        obs_group = np.repeat(np.arange(len(group_tracks)), sizes)
+        rows = np.arange(len(obs_group)) + np.repeat(starts - np.cumsum(sizes) + sizes, sizes)
+        obs_cam = cam_of_image[np.asarray(tracks.obs_img[rows])]
+        placed = obs_cam >= 0
+        rows = rows[placed]
+        obs_cam = obs_cam[placed]
+        obs_group = obs_group[placed]
+
+        # tracks with enough placed observations become the 3d points
+        counts = np.bincount(obs_group, minlength=len(group_tracks))
+        used = counts >= self.min_chain_len
+        feat_of_group = np.cumsum(used) - 1
+        point_tracks = group_tracks[used]
+        self.n_points = len(point_tracks)
+        self.feat_map_fwd = dict(zip(point_tracks.tolist(), range(self.n_points)))
+        self.feat_map_rev = dict(zip(range(self.n_points), point_tracks.tolist()))
+
+        # 3d point estimates
+        ned = np.array(tracks.ned[point_tracks])
+        for i in np.flatnonzero(np.any(np.isnan(ned), axis=1)).tolist():
+            print(point_tracks[i], ned[i])
+        self.points_3d = ned.ravel()
+
+        # observations (camera index, feature index, u, v) sorted by
+        # camera (keeping the track order within each camera)
+        keep = used[obs_group]
+        obs_cam = obs_cam[keep]
+        order = np.argsort(obs_cam, kind='stable')
+        self.camera_indices = obs_cam[order]
+        self.point_indices = feat_of_group[obs_group[keep][order]]
+        self.points_2d = np.array(tracks.obs_uv[rows[keep][order]]) # orig/distorted
+
+        # the per camera views (for tools that work camera by camera)
+        splits = np.cumsum(np.bincount(self.camera_indices, minlength=self.n_cameras))[:-1]
+        self.by_camera_point_indices = np.split(self.point_indices, splits)
+        self.by_camera_points_2d = [ p.reshape(-1, 1, 2) for p in
+                                     np.split(self.points_2d, splits) ]
+        log("num observations:", len(self.camera_indices))
+        self.alloc_buffers()
 
     # assemble the structures and remapping indices required for
     # optimizing a group of images/features, call the optimizer, and
@@ -378,58 +460,35 @@ class Optimizer():
                       self.by_camera_point_indices, self.by_camera_points_2d)
         mre_start = np.mean(np.abs(f0))
 
-        A = self.bundle_adjustment_sparsity(self.n_cameras, self.n_points,
-                                            self.camera_indices,
-                                            self.point_indices)
+        # the sparsity pattern is only needed for finite differences
+        if self.analytic_jac:
+            jac = self.jac
+            A = None
+        else:
+            jac = '2-point'
+            A = self.bundle_adjustment_sparsity(self.n_cameras, self.n_points,
+                                                self.camera_indices,
+                                                self.point_indices)
 
         if self.with_bounds:
-            # quick test of bounds ... allow camera parameters to go free,
-            # but limit 3d points =to +/- 100m of initial guess
-            lower = []
-            upper = []
-            tol = 100.0
-            for i in range(self.n_cameras):
-                # unlimit the camera params
-                for j in range(self.ncp):
-                    if False and j >= 3 and j <= 5:
-                        # bound the altitude of camera (pretend we
-                        # trust dji to +/- 1m)
-                        lower.append( self.camera_params[i*self.ncp + j] - 1 )
-                        upper.append( self.camera_params[i*self.ncp + j] + 1 )
-                    else:
-                        lower.append( -np.inf )
-                        upper.append( np.inf )
-            for i in range(self.n_points * 3):
-                #lower.append( points_3d[i] - tol )
-                #upper.append( points_3d[i] + tol )
-                # let point locations float without constraint
-                lower.append( -np.inf )
-                upper.append( np.inf )
+            # quick test of bounds ... allow camera parameters and
+            # point locations to go free (the points could be limited
+            # to +/- 100m of the initial guess)
+            lower = np.full(len(x0), -np.inf)
+            upper = np.full(len(x0), np.inf)
             if self.optimize_calib == 'global':
+                calib = self.n_cameras * self.ncp + self.n_points * 3
                 tol = 0.0000001
-                # bound focal length
-                lower.append(self.K[0,0]*(1-tol))
-                upper.append(self.K[0,0]*(1+tol))
-                #lower.append(self.K[0,0]*0.9)
-                #upper.append(self.K[0,0]*1.1)
-                cu = self.K[0,2]
-                cv = self.K[1,2]
-                lower.append(cu*(1-tol))
-                upper.append(cu*(1+tol))
-                lower.append(cv*(1-tol))
-                upper.append(cv*(1+tol))
+                # bound focal length and center
+                #lower[calib] = self.K[0,0]*0.9
+                #upper[calib] = self.K[0,0]*1.1
+                calib0 = np.array( [self.K[0,0], self.K[0,2], self.K[1,2]] )
+                lower[calib:calib+3] = calib0 * (1-tol)
+                upper[calib:calib+3] = calib0 * (1+tol)
                 # unlimit radial distortion params, limit tangential
                 # params (5 parameters)
-                lower.append( -np.inf )
-                upper.append( np.inf )
-                lower.append( -np.inf )
-                upper.append( np.inf )
-                lower.append( -tol )
-                upper.append( tol )
-                lower.append( -tol )
-                upper.append( tol )
-                lower.append( -np.inf )
-                upper.append( np.inf )
+                lower[calib+5:calib+7] = -tol
+                upper[calib+5:calib+7] = tol
             bounds = [lower, upper]
         else:
             bounds = (-np.inf, np.inf)
@@ -444,6 +503,7 @@ class Optimizer():
         t0 = time.time()
         # bounds=bounds,
         res = least_squares(self.fun, x0,
+                            jac=jac,
                             jac_sparsity=A,
                             verbose=2,
                             method='trf',
@@ -495,13 +555,14 @@ class Optimizer():
                  self.camera_map_fwd, self.feat_map_rev,
                  fx, fy, cu, cv, distCoeffs_opt )
 
-    def update_camera_poses(self, proj):
+    # set the optimized camera poses.  With save=False the poses are
+    # only updated in memory (and the other images are left alone.)
+    def update_camera_poses(self, proj, save=True):
         log('Updated the optimized camera poses.')
         
         # mark all the optimized poses as invalid
-        for image in proj.image_list:
-            opt_cam_node = image.node.getChild('camera_pose_opt', True)
-            opt_cam_node.setBool('valid', False)
+        if save:
+            invalidate_poses(proj)
 
         for i, cam in enumerate(self.camera_params):
             image_index = self.camera_map_fwd[i]
@@ -522,7 +583,8 @@ class Optimizer():
             log(image.name, ned_orig, '->', newned, 'dist:', np.linalg.norm(np.array(ned_orig) - np.array(newned)))
             image.set_camera_pose( newned, yaw*r2d, pitch*r2d, roll*r2d, opt=True )
             image.placed = True
-        proj.save_images_info()
+        if save:
+            proj.save_images_info()
 
     # compare original camera locations with optimized camera
     # locations and derive a transform matrix to 'best fit' the new
@@ -530,8 +592,11 @@ class Optimizer():
     # group gps solution as our best absolute truth for positioning
     # the system in world coordinates.  (each separately optimized
     # group needs a separate/unique fit)
-    def refit(self, proj, matches, groups, group_index):
-        matches_opt = list(matches) # shallow copy
+    # the refit track locations are written to tracks.ned (a new array,
+    # so the loaded column may be a read only memory map.)  With
+    # save=False nothing is written (tracks.ned and the image info files
+    # are left alone.)  Returns the updated track indices and locations.
+    def refit(self, proj, tracks, groups, group_index, save=True):
         group = groups[group_index]
         log('refitting group size:', len(group))
         src_list = []
@@ -577,7 +642,8 @@ class Optimizer():
                 continue
             ned, [y, p, r], quat = image.get_camera_pose(opt=True)
             image.set_camera_pose(new_cams[i], y, p, r, opt=True)
-        proj.save_images_info()
+        if save:
+            proj.save_images_info()
 
         if True:
             # update optimized pose orientation.
@@ -601,7 +667,8 @@ class Optimizer():
                 qlog("  fit pos:", new_cams[i])
                 qlog("  dist moved:", dist)
                 dist_report.append( (dist, image.name) )
-            proj.save_images_info()
+            if save:
+                proj.save_images_info()
 
             dist_report = sorted(dist_report,
                                  key=lambda fields: fields[0],
@@ -619,15 +686,102 @@ class Optimizer():
         # master match structure.  Note we process groups in order of
         # little to big so if a match is in more than one group it
         # follows the larger group.
+        in_group = np.array([ image.name in group for image in proj.image_list ])
+        hits = np.bincount(tracks.obs_track(),
+                           weights=in_group[tracks.obs_img],
+                           minlength=len(tracks))
+        rows = []
+        feats = []
         for i, feat in enumerate(new_feats):
             match_index = self.feat_map_rev[i]
-            match = matches_opt[match_index]
-            in_group = False
-            for m in match[2:]:
-                if proj.image_list[m[0]].name in group:
-                    in_group = True
-                    break
-            if in_group:
-                #print(" before:", match)
-                match[0] = feat
-                #print(" after:", match)
+            if hits[match_index] > 0:
+                rows.append(match_index)
+                feats.append(feat)
+        rows = np.array(rows, dtype=np.int64)
+        feats = np.array(feats).reshape(-1, 3)
+        if save:
+            ned = np.array(tracks.ned)
+            ned[rows] = feats
+            tracks.ned = ned
+        return rows, feats
+
+# optimize and refit one group without saving anything.  Returns the
+# optimized poses of the group images [(index, ned, ypr)], the camera
+# calibration (fx, fy, cu, cv, dist_coeffs) and the refit track
+# locations (track indices, ned)
+def optimize_group(proj, group_list, store, group_index, optimized=False,
+                   cam_calib=False):
+    opt = Optimizer(proj.project_dir)
+    opt.setup(proj, group_list, group_index, store, optimized=optimized,
+              cam_calib=cam_calib)
+    cameras, features, cam_index_map, feat_index_map, \
+        fx, fy, cu, cv, distCoeffs = opt.run()
+    opt.update_camera_poses(proj, save=False)
+    rows, feats = opt.refit(proj, store, group_list, group_index, save=False)
+    poses = []
+    for index in opt.camera_map_fwd.values():
+        ned, ypr, quat = proj.image_list[index].get_camera_pose(opt=True)
+        poses.append( (index, ned, ypr) )
+    calib = (fx, fy, cu, cv, np.array(distCoeffs).tolist())
+    return poses, calib, rows, feats
+
+# worker process entry point, task is (group index, tracks path,
+# optimized, cam_calib)
+def optimize_group_task(task):
+    group_index, tracks_path, optimized, cam_calib = task
+    group_list = groups.load(pool.proj.analysis_dir)
+    store = tracks.load(tracks_path)
+    return optimize_group(pool.proj, group_list, store, group_index,
+                          optimized, cam_calib)
+
+# optimize every group, optionally in a pool of worker processes, and
+# save the results.  The groups with the most observations (the
+# longest solves) are started first.  Results are merged from the
+# smallest group to the largest so if a track is refit by more than one
+# group it follows the larger group (and the camera calibration comes
+# from the largest group.)
+def optimize_all_groups(proj, group_list, tracks_path, workers=1,
+                        optimized=False, cam_calib=False):
+    store = tracks.load(tracks_path)
+    used = store.group >= 0
+    obs_count = np.bincount(store.group[used], weights=store.sizes()[used],
+                            minlength=len(group_list))[:len(group_list)]
+    order = np.argsort(-obs_count, kind='stable').tolist()
+    for g in order:
+        log("group %d: %d images, %d observations" %
+            (g, len(group_list[g]), obs_count[g]))
+    tasks = [ (g, tracks_path, optimized, cam_calib) for g in order ]
+    if workers > 1:
+        results = pool.run(optimize_group_task, tasks, workers,
+                           proj.project_dir)
+    else:
+        results = ( (task, optimize_group(proj, group_list, store, task[0],
+                                          optimized, cam_calib))
+                    for task in tasks )
+    merged = {}
+    for task, result in results:
+        log("group %d optimized" % task[0])
+        merged[task[0]] = result
+
+    invalidate_poses(proj)
+    ned = np.array(store.ned)
+    calib = None
+    for g in sorted(merged, key=lambda g: len(group_list[g])):
+        poses, group_calib, rows, feats = merged[g]
+        for index, pose_ned, ypr in poses:
+            image = proj.image_list[index]
+            image.set_camera_pose(pose_ned, ypr[0], ypr[1], ypr[2], opt=True)
+            image.placed = True
+        ned[rows] = feats
+        calib = group_calib
+    proj.save_images_info()
+
+    if calib is not None:
+        fx, fy, cu, cv, distCoeffs = calib
+        camera.set_K(fx, fy, cu, cv, optimized=True)
+        camera.set_dist_coeffs(distCoeffs, optimized=True)
+        proj.save()
+
+    log("Writing optimized (fitted) track locations:", tracks_path)
+    store.ned = ned
+    tracks.save(tracks_path, store, ['ned'])
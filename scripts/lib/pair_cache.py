@@ -0,0 +1,139 @@
+# content addressed cache of pair matching results
+#
+# A pair result is stored under a key computed from the contents of
+# both images' feature and descriptor files plus the matcher
+# configuration (strategy, filter, ratio, min pairs, detector, scale.)
+# Changing any of these gives a new key so stale results are never
+# reused, and unchanged pairs can be reused without rematching.
+#
+# File digests are remembered (by path, size and modification time) in
+# digests.json so unchanged files aren't hashed again on every run.
+
+import hashlib
+import json
+import numpy as np
+import os
+
+from props import getNode
+
+from .logger import log
+
+detector_node = getNode('/config/detector', True)
+matcher_node = getNode('/config/matcher', True)
+
+cache_dir = None
+rematch = False                 # ignore (but update) cached results
+digests = {}                    # path -> [size, mtime_ns, digest]
+hits = 0
+misses = 0
+
+def init(analysis_dir, ignore_cached=False):
+    global cache_dir
+    global rematch
+    global digests
+    global hits
+    global misses
+    cache_dir = os.path.join(analysis_dir, 'cache', 'pairs')
+    rematch = ignore_cached
+    if not os.path.exists(cache_dir):
+        os.makedirs(cache_dir, exist_ok=True)
+    digests = {}
+    digest_file = os.path.join(cache_dir, 'digests.json')
+    if os.path.exists(digest_file):
+        try:
+            with open(digest_file, 'r') as fp:
+                digests = json.load(fp)
+        except:
+            log("Notice: unable to load:", digest_file)
+    hits = 0
+    misses = 0
+
+def save():
+    digest_file = os.path.join(cache_dir, 'digests.json')
+    tmp_file = digest_file + ".%d.tmp" % os.getpid()
+    with open(tmp_file, 'w') as fp:
+        # (a copy, prefetch threads may be adding digests)
+        json.dump(dict(digests), fp)
+    os.replace(tmp_file, digest_file)
+
+# sha1 of the file contents (None if the file doesn't exist)
+def file_digest(path):
+    if not os.path.exists(path):
+        return None
+    stat = os.stat(path)
+    if path in digests:
+        size, mtime, digest = digests[path]
+        if size == stat.st_size and mtime == stat.st_mtime_ns:
+            return digest
+    sha1 = hashlib.sha1()
+    with open(path, 'rb') as fp:
+        for block in iter(lambda: fp.read(1024*1024), b''):
+            sha1.update(block)
+    digest = sha1.hexdigest()
+    digests[path] = [stat.st_size, stat.st_mtime_ns, digest]
+    return digest
+
+# key for the pair result (None if the feature/descriptor files don't
+# exist yet)
+def pair_key(i1, i2, strategy):
+    sha1 = hashlib.sha1()
+    for path in [ i1.features_file, i1.desc_file,
+                  i2.features_file, i2.desc_file ]:
+        digest = file_digest(path)
+        if digest is None:
+            return None
+        sha1.update(digest.encode())
+    config = [ strategy,
+               matcher_node.getString('filter'),
+               "%.6f" % matcher_node.getFloat('match_ratio'),
+               "%d" % matcher_node.getInt('min_pairs'),
+               detector_node.getString('detector'),
+               "%.6f" % detector_node.getFloat('scale') ]
+    # settings that are only present when used (so existing cache
+    # entries stay valid for the default flann/unguided matching)
+    if matcher_node.hasChild('engine') and matcher_node.getString('engine') != 'flann':
+        config.append("engine=" + matcher_node.getString('engine'))
+    if matcher_node.getBool('guided'):
+        config.append("guided")
+        if matcher_node.hasChild('guided_radius'):
+            config.append("guided_radius=%.6f" % matcher_node.getFloat('guided_radius'))
+    if matcher_node.hasChild('ground_m'):
+        config.append("ground_m=%.3f" % matcher_node.getFloat('ground_m'))
+    sha1.update(" ".join(config).encode())
+    return sha1.hexdigest()
+
+# true if lookup(key) will find a cached result (doesn't count as a
+# hit or miss)
+def cached(key):
+    if key is None or rematch:
+        return False
+    return os.path.exists(os.path.join(cache_dir, key + '.npz'))
+
+# returns the cached (match_fwd, match_rev) result or None
+def lookup(key):
+    global hits
+    global misses
+    if key is not None and not rematch:
+        path = os.path.join(cache_dir, key + '.npz')
+        if os.path.exists(path):
+            hits += 1
+            data = np.load(path)
+            return data['fwd'].tolist(), data['rev'].tolist()
+    misses += 1
+    return None
+
+# pairs without matches aren't cached so they are retried (with
+# possibly better smart estimates) on the next run
+def store(key, match_fwd, match_rev):
+    if key is None or not len(match_fwd):
+        return
+    path = os.path.join(cache_dir, key + '.npz')
+    tmp_file = path + ".%d.tmp" % os.getpid()
+    with open(tmp_file, 'wb') as fp:
+        np.savez(fp,
+                 fwd=np.array(match_fwd, dtype=np.int32).reshape(-1, 2),
+                 rev=np.array(match_rev, dtype=np.int32).reshape(-1, 2))
+    os.replace(tmp_file, path)
+
+def report():
+    log("Pair cache: %d hits, %d misses" % (hits, misses))
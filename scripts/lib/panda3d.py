@@ -31,28 +31,10 @@ def make_textures_opencv(src_dir, analysis_dir, image_list, resolution=512):
         dst = os.path.join(dst_dir, image.name + '.JPG')
         log(src, '->', dst)
         if not os.path.exists(dst):
-            src = cv2.imread(src, flags=cv2.IMREAD_ANYCOLOR|cv2.IMREAD_ANYDEPTH|cv2.IMREAD_IGNORE_ORIENTATION)
-            height, width = src.shape[:2]
-            # downscale image first
-            method = cv2.INTER_AREA  # cv2.INTER_AREA
-            scale = cv2.resize(src, (0,0),
-                               fx=resolution/float(width),
-                               fy=resolution/float(height),
-                               interpolation=method)
+            # (the texture comes from the pyramid cache if it has
+            # been built)
             do_equalize = False
-            if do_equalize:
-                # convert to hsv color space
-                hsv = cv2.cvtColor(scale, cv2.COLOR_BGR2HSV)
-                hue,sat,val = cv2.split(hsv)
-                # adaptive histogram equalization on 'value' channel
-                clahe = cv2.createCLAHE(clipLimit=3.0, tileGridSize=(8,8))
-                aeq = clahe.apply(val)
-                # recombine
-                hsv = cv2.merge((hue,sat,aeq))
-                # convert back to rgb
-                result = cv2.cvtColor(hsv, cv2.COLOR_HSV2BGR)
-            else:
-                result = scale
+            result = image.load_texture(resolution, equalize=do_equalize)
             cv2.imwrite(dst, result)
             qlog("Texture %dx%d %s" % (resolution, resolution, dst))
     # make the dummy.jpg image from the first texture
@@ -61,15 +43,8 @@ def make_textures_opencv(src_dir, analysis_dir, image_list, resolution=512):
     dst = os.path.join(dst_dir, "dummy.jpg")
     log("Dummy:", src, dst)
     if not os.path.exists(dst):
-        src = cv2.imread(src, flags=cv2.IMREAD_ANYCOLOR|cv2.IMREAD_ANYDEPTH|cv2.IMREAD_IGNORE_ORIENTATION)
-        height, width = src.shape[:2]
-        # downscale image first
-        method = cv2.INTER_AREA  # cv2.INTER_AREA
         resolution = 64
-        dummy = cv2.resize(src, (0,0),
-                           fx=resolution/float(width),
-                           fy=resolution/float(height),
-                           interpolation=method)
+        dummy = image_list[0].load_texture(resolution)
         cv2.imwrite(dst, dummy)
         qlog("Texture %dx%d %s" % (resolution, resolution, dst))
     
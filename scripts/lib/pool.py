@@ -0,0 +1,51 @@
+# spread independent work items over a pool of worker processes
+#
+# Each worker process loads its own copy of the project (image meta
+# data, config and smart surface/yaw estimates) so this works the same
+# way with the 'fork' and 'spawn' multiprocessing start methods.  The
+# parent feeds tasks from a (possibly lazy) iterator and only keeps a
+# bounded number of them in flight, so any values computed by the
+# iterator at submit time reflect the most recent merged results.
+
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+from . import project
+from . import smart
+
+proj = None                     # the worker process copy of the project
+
+def init_project(project_dir, setup=None):
+    global proj
+    proj = project.ProjectMgr(project_dir)
+    proj.load_images_info()
+    smart.load(proj.analysis_dir)
+    smart.set_yaw_error_estimates(proj)
+    if setup is not None:
+        setup()
+
+# run func(task) for each task in a pool of worker processes and yield
+# (task, result) tuples in order of completion.  setup (if specified)
+# is called once in each worker after the project is loaded.
+def run(func, tasks, workers, project_dir, setup=None, window=None):
+    if window is None:
+        window = 2 * workers
+    task_iter = iter(tasks)
+    pending = {}
+    exhausted = False
+    with ProcessPoolExecutor(max_workers=workers,
+                             initializer=init_project,
+                             initargs=(project_dir, setup)) as executor:
+        while True:
+            while not exhausted and len(pending) < window:
+                try:
+                    task = next(task_iter)
+                except StopIteration:
+                    exhausted = True
+                    break
+                pending[executor.submit(func, task)] = task
+            if not len(pending):
+                break
+            done, not_done = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                task = pending.pop(future)
+                yield task, future.result()
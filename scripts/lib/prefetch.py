@@ -0,0 +1,40 @@
+# load upcoming items in background threads
+#
+# When we know the order items will be used in (the detection order,
+# the matching work list) the next few can be loaded while we work on
+# the current one.  Jpeg decoding, gzip and file reads release the
+# GIL so this hides most of the I/O latency (network mounted projects
+# especially.)  Only a bounded window of items is loaded ahead.
+
+from concurrent.futures import ThreadPoolExecutor
+
+class Prefetcher():
+    def __init__(self, load, items, window=8, threads=2):
+        self.load = load        # load(item) -> result
+        self.items = items
+        self.window = window
+        self.executor = ThreadPoolExecutor(max_workers=threads)
+        self.futures = {}       # position -> future
+        self.next = 0           # next position to submit
+
+    # start loading the items following position (up to the window)
+    def advance(self, position):
+        end = min(len(self.items), position + 1 + self.window)
+        self.next = max(self.next, position + 1)
+        while self.next < end:
+            self.futures[self.next] = self.executor.submit(self.load, self.items[self.next])
+            self.next += 1
+
+    # return the result for the item at position (waiting for it if
+    # it is still loading, or loading it now if it wasn't prefetched)
+    # and start loading the following items.  Call this for every
+    # position in order.
+    def get(self, position):
+        self.advance(position)
+        if position in self.futures:
+            return self.futures.pop(position).result()
+        return self.load(self.items[position])
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+        self.futures = {}
@@ -262,33 +262,17 @@ class ProjectMgr():
         dist_coeffs = np.array(camera.get_dist_coeffs())
         K = camera.get_K()
         # assemble the points in the proper format
-        uv_raw = np.zeros((len(uv_orig),1,2), dtype=np.float32)
-        for i, kp in enumerate(uv_orig):
-            uv_raw[i][0] = (kp[0], kp[1])
+        uv_raw = np.array(uv_orig, dtype=np.float32)[:,:2].reshape(-1, 1, 2)
         # do the actual undistort
         uv_new = cv2.undistortPoints(uv_raw, K, dist_coeffs, P=K)
         # return the results in an easier format
-        result = []
-        for i, uv in enumerate(uv_new):
-            result.append(uv_new[i][0])
-            #print "  orig = %s  undistort = %s" % (uv_raw[i][0], uv_new[i][0]
-        return result
+        return list(uv_new.reshape(-1, 2))
         
     # for each feature in each image, compute the undistorted pixel
     # location (from the calibrated distortion parameters)
     def undistort_image_keypoints(self, image, optimized=False):
-        if len(image.kp_list) == 0:
-            return
-        K = camera.get_K(optimized)
-        uv_raw = np.zeros((len(image.kp_list),1,2), dtype=np.float32)
-        for i, kp in enumerate(image.kp_list):
-            uv_raw[i][0] = (kp.pt[0], kp.pt[1])
-        dist_coeffs = camera.get_dist_coeffs(optimized)
-        uv_new = cv2.undistortPoints(uv_raw, K, np.array(dist_coeffs), P=K)
-        image.uv_list = []
-        for i, uv in enumerate(uv_new):
-            image.uv_list.append(uv_new[i][0])
-            # print("  orig = %s  undistort = %s" % (uv_raw[i][0], uv_new[i]        
+        image.undistort_features(optimized)
+
     # for each feature in each image, compute the undistorted pixel
     # location (from the calibrated distortion parameters)
     def undistort_keypoints(self, optimized=False):
@@ -335,25 +319,25 @@ class ProjectMgr():
         # during feature matching
         if all:
             for image in self.image_list:
-                image.kp_used = np.ones(len(image.kp_list), np.bool_)
+                image.kp_used = np.ones(len(image.kp_array), np.bool_)
         else:
             for image in self.image_list:
-                image.kp_used = np.zeros(len(image.kp_list), np.bool_)
+                image.kp_used = np.zeros(len(image.kp_array), np.bool_)
             for i1 in self.image_list:
                 #print(i1.name, len(i1.match_list))
                 for key in i1.match_list:
                     matches = i1.match_list[key]
                     i2 = self.findImageByName(key)
-                    if not i2 is None:
+                    if not i2 is None and len(matches):
                         # ignore match pairs not from our area set
-                        for k, pair in enumerate(matches):
-                            i1.kp_used[ pair[0] ] = True
-                            i2.kp_used[ pair[1] ] = True
+                        pairs = np.array(matches, dtype=int).reshape(-1, 2)
+                        i1.kp_used[ pairs[:,0] ] = True
+                        i2.kp_used[ pairs[:,1] ] = True
                     
     def compute_kp_usage_new(self, matches_direct):
         log("[new] Determining feature usage in matching pairs...")
         for image in self.image_list:
-            image.kp_used = np.zeros(len(image.kp_list), np.bool_)
+            image.kp_used = np.zeros(len(image.kp_array), np.bool_)
         for match in matches_direct:
             for p in match[1:]:
                 image = self.image_list[ p[0] ]
@@ -0,0 +1,124 @@
+# reduced resolution image cache
+#
+# Detection, histograms, textures, etc. all need smaller versions of
+# the original (large) images.  Instead of each of these decoding the
+# full image and resizing it independently, the pyramid cache stores
+# 1/2, 1/4 and 1/8 size versions of each image plus fixed size square
+# textures under ImageAnalysis/cache/pyramid.  Image.load_rgb() and
+# Image.load_texture() read the smallest level that meets the
+# request.  The levels are lossless (png) copies of what
+# image.read_level() returns, so features detected from the pyramid
+# are the same as without it.  Textures are only used for rendering
+# and are saved as jpeg.
+#
+# Each image has a small json file with the size and modification
+# time of the source image it was built from; if the source changes
+# the levels are rebuilt (and ignored until then.)
+
+import cv2
+import json
+import os
+import time
+from tqdm import tqdm
+
+from . import image
+from .logger import log, qlog
+from . import pool
+
+jpeg_quality = 95
+
+# write to a temp file and rename so a partially written file is
+# never seen (the temp name keeps the extension for imwrite)
+def write_image(path, rgb, params=[]):
+    ext = os.path.splitext(path)[1]
+    tmp_file = path + ".%d.tmp%s" % (os.getpid(), ext)
+    cv2.imwrite(tmp_file, rgb, params)
+    os.replace(tmp_file, path)
+
+def write_jpeg(path, rgb):
+    write_image(path, rgb, [cv2.IMWRITE_JPEG_QUALITY, jpeg_quality])
+
+# build the cache files for one image (if needed.)  Returns True if
+# the pyramid was (re)built.
+def build_image(img, force=False):
+    if not force and img.pyramid_valid():
+        return False
+    pyramid_dir = os.path.dirname(img.pyramid_base)
+    if not os.path.exists(pyramid_dir):
+        os.makedirs(pyramid_dir, exist_ok=True)
+    stat = os.stat(img.image_file)
+
+    # the same images load_rgb() reads without a pyramid: reduced
+    # jpeg decodes, or the full image halved for each level
+    full = None
+    header = image.jpeg_header(img.image_file)
+    if image.reduced_jpeg(header):
+        width, height = header[:2]
+        levels = [ image.read_level(img.image_file, level)[0]
+                   for level in range(1, image.pyramid_levels + 1) ]
+    else:
+        full, (width, height) = image.read_level(img.image_file, 0)
+        levels = []
+        for level in range(1, image.pyramid_levels + 1):
+            levels.append(image.reduce_level(levels[-1] if levels else full, 1))
+    for level, reduced in enumerate(levels, 1):
+        write_image(img.pyramid_file(level), reduced)
+
+    # textures are resized from the smallest level that covers them
+    for resolution in image.texture_sizes:
+        src = None
+        for level in levels:
+            if min(level.shape[:2]) >= resolution:
+                src = level
+        if src is None:
+            if full is None:
+                full, size = image.read_level(img.image_file, 0)
+            src = full
+        texture = cv2.resize(src, (resolution, resolution),
+                             interpolation=cv2.INTER_AREA)
+        write_jpeg(img.texture_file(resolution), texture)
+
+    # the info file is written last, it marks the pyramid as complete
+    info = { 'version': image.pyramid_version, 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns,
+             'width': width, 'height': height }
+    info_file = img.pyramid_info_file()
+    tmp_file = info_file + ".%d.tmp" % os.getpid()
+    with open(tmp_file, 'w') as fp:
+        json.dump(info, fp)
+    os.replace(tmp_file, info_file)
+    return True
+
+# build the image pyramid and return (built, seconds)
+def timed_build(img, force=False):
+    start = time.time()
+    built = build_image(img, force)
+    return built, time.time() - start
+
+# worker process entry point, task is (image index, force)
+def build_image_task(task):
+    index, force = task
+    return timed_build(pool.proj.image_list[index], force)
+
+# build (or update) the pyramid cache for all the project images,
+# optionally in a pool of worker processes
+def build(proj, workers=1, force=False):
+    tasks = []
+    for i, img in enumerate(proj.image_list):
+        if img.image_file is None:
+            continue
+        if force or not img.pyramid_valid():
+            tasks.append( (i, force) )
+    log("Image pyramid: %d images to build (%d up to date)" %
+        (len(tasks), len(proj.image_list) - len(tasks)))
+    if not len(tasks):
+        return
+
+    if workers > 1:
+        results = pool.run(build_image_task, tasks, workers,
+                           proj.project_dir)
+    else:
+        results = ( (task, timed_build(proj.image_list[task[0]], task[1]))
+                    for task in tasks )
+    for task, (built, seconds) in tqdm(results, total=len(tasks),
+                                       smoothing=0.05):
+        qlog("pyramid: %s %.2fs" % (proj.image_list[task[0]].name, seconds))
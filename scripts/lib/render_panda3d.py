@@ -12,6 +12,7 @@ from . import camera
 from .logger import log, qlog
 from . import panda3d
 from . import project
+from . import tracks
 #from . import objmtl            # temporary?
 
 r2d = 180 / math.pi
@@ -86,51 +87,52 @@ def build_map(proj, group_list, group_index):
             ref_node.getFloat('alt_m') ]
 
     log("Loading optimized match points ...")
-    matches = pickle.load( open( os.path.join(proj.analysis_dir, "matches_grouped"), "rb" ) )
-
-    # initialize temporary structures for vanity stats
-    for image in proj.image_list:
-        image.sum_values = 0.0
-        image.sum_count = 0.0
-        image.max_z = -9999.0
-        image.min_z = 9999.0
+    store = tracks.load(tracks.tracks_dir(proj.analysis_dir))
 
     # elevation stats
     log("Computing stats...")
-    ned_list = []
-    for match in matches:
-        if match[1] == group_index:  # used by current group
-            ned_list.append(match[0])
-    avg = -np.mean(np.array(ned_list)[:,2])
-    std = np.std(np.array(ned_list)[:,2])
+    used = np.flatnonzero(store.group == group_index) # used by current group
+    ned_list = np.array(store.ned[used])
+    avg = -np.mean(ned_list[:,2])
+    std = np.std(ned_list[:,2])
     log("Average elevation: %.2f" % avg)
     log("Standard deviation: %.2f" % std)
 
     # sort through points
     log('Reading feature locations from optimized match points ...')
-    raw_points = []
-    raw_values = []
-    for match in matches:
-        if match[1] == group_index:  # used by current group
-            ned = match[0]
-            diff = abs(-ned[2] - avg)
-            if diff < 10*std:
-                raw_points.append( [ned[1], ned[0]] )
-                raw_values.append( ned[2] )
-                for m in match[2:]:
-                    if proj.image_list[m[0]].name in group_list[group_index]:
-                        image = proj.image_list[ m[0] ]
-                        z = -ned[2]
-                        image.sum_values += z
-                        image.sum_count += 1
-                        if z < image.min_z:
-                            image.min_z = z
-                            #print(min_z, match)
-                        if z > image.max_z:
-                            image.max_z = z
-                            #print(max_z, match)
-            else:
-                log("Discarding match with excessive altitude:", match)
+    diff = np.abs(-ned_list[:,2] - avg)
+    keep = diff < 10*std
+    for i in used[~keep]:
+        log("Discarding match with excessive altitude:", i, store.ned[i])
+    used = used[keep]
+    ned_list = ned_list[keep]
+    raw_points = ned_list[:,[1,0]].tolist()
+    raw_values = ned_list[:,2].tolist()
+
+    # vanity stats: elevation of the features seen by each group image
+    starts = store.offsets[used]
+    sizes = store.offsets[used+1] - starts
+    first = np.cumsum(sizes) - sizes
+    rows = np.repeat(starts - first, sizes) + np.arange(np.sum(sizes))
+    obs_img = np.asarray(store.obs_img[rows])
+    z = np.repeat(-ned_list[:,2], sizes)
+    in_group = np.array([ image.name in group_list[group_index]
+                          for image in proj.image_list ])
+    sel = in_group[obs_img]
+    obs_img = obs_img[sel]
+    z = z[sel]
+    n = len(proj.image_list)
+    sum_values = np.bincount(obs_img, weights=z, minlength=n)
+    sum_count = np.bincount(obs_img, minlength=n)
+    min_z = np.full(n, 9999.0)
+    max_z = np.full(n, -9999.0)
+    np.minimum.at(min_z, obs_img, z)
+    np.maximum.at(max_z, obs_img, z)
+    for i, image in enumerate(proj.image_list):
+        image.sum_values = sum_values[i]
+        image.sum_count = sum_count[i]
+        image.min_z = min_z[i]
+        image.max_z = max_z[i]
 
     # save the surface definition as a separate file
     models_dir = os.path.join(proj.analysis_dir, 'models')
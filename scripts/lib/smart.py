@@ -34,9 +34,9 @@ def triangulate_features(i1, i2):
     if len(i1.match_list[i2.name]) == 0:
         return None
 
-    if not i1.kp_list or not len(i1.kp_list):
+    if i1.kp_array is None or not len(i1.kp_array):
         i1.load_features()
-    if not i2.kp_list or not len(i2.kp_list):
+    if i2.kp_array is None or not len(i2.kp_array):
         i2.load_features()
 
     # camera calibration
@@ -52,12 +52,10 @@ def triangulate_features(i1, i2):
     PROJ2 = np.concatenate((R2, tvec2), axis=1)
 
     # setup data structures for cv2 call
-    uv1 = []; uv2 = []; indices = []
-    for pair in i1.match_list[i2.name]:
-        p1 = i1.kp_list[ pair[0] ].pt
-        p2 = i2.kp_list[ pair[1] ].pt
-        uv1.append( [p1[0], p1[1], 1.0] )
-        uv2.append( [p2[0], p2[1], 1.0] )
+    pairs = np.array(i1.match_list[i2.name])
+    ones = np.ones((len(pairs), 1))
+    uv1 = np.hstack((i1.kp_uv()[pairs[:,0]], ones))
+    uv2 = np.hstack((i2.kp_uv()[pairs[:,1]], ones))
     pts1 = IK.dot(np.array(uv1).T)
     pts2 = IK.dot(np.array(uv2).T)
     points = cv2.triangulatePoints(PROJ1, PROJ2, pts1[:2], pts2[:2])
@@ -74,18 +72,15 @@ def find_affine(i1, i2):
     if len(i1.match_list[i2.name]) == 0:
         return None
 
-    if not i1.kp_list or not len(i1.kp_list):
+    if i1.kp_array is None or not len(i1.kp_array):
         i1.load_features()
-    if not i2.kp_list or not len(i2.kp_list):
+    if i2.kp_array is None or not len(i2.kp_array):
         i2.load_features()
 
     # affine transformation from i2 uv coordinate system to i1
-    uv1 = []; uv2 = []; indices = []
-    for pair in i1.match_list[i2.name]:
-        uv1.append( i1.kp_list[ pair[0] ].pt )
-        uv2.append( i2.kp_list[ pair[1] ].pt )
-    uv1 = np.float32([uv1])
-    uv2 = np.float32([uv2])
+    pairs = np.array(i1.match_list[i2.name])
+    uv1 = np.float32([i1.kp_uv()[pairs[:,0]]])
+    uv2 = np.float32([i2.kp_uv()[pairs[:,1]]])
     affine, status = \
         cv2.estimateAffinePartial2D(uv2, uv1)
     return affine
@@ -195,6 +190,13 @@ def estimate_yaw_error(i1, i2):
 # tree records
 def update_surface_estimate(i1, i2):
     avg, std, dist_m = estimate_surface_elevation(i1, i2)
+    return record_surface_estimate(i1, i2, avg, std, dist_m)
+
+# update the property tree records with a (previously computed)
+# pairwise surface estimate.  Split out from update_surface_estimate()
+# so estimates computed in a worker process can be merged by the
+# parent.
+def record_surface_estimate(i1, i2, avg, std, dist_m):
     if avg is None:
         return None, None
 
@@ -248,10 +250,16 @@ def update_surface_estimate(i1, i2):
 
     return avg, std
 
-# compute the pairwise surface estimate and then update the property
+# compute the pairwise yaw error estimate and then update the property
 # tree records
 def update_yaw_error_estimate(i1, i2):
     yaw_error, dist, crs_affine, weight = estimate_yaw_error(i1, i2)
+    return record_yaw_error_estimate(i1, i2, yaw_error, dist, crs_affine,
+                                     weight)
+
+# update the property tree records with a (previously computed)
+# pairwise yaw error estimate, returns the new weighted average
+def record_yaw_error_estimate(i1, i2, yaw_error, dist, crs_affine, weight):
     if yaw_error is None:
         return 0
 
@@ -310,6 +318,11 @@ def get_surface_estimate(i1, i2):
     qlog("  SRTM ground (no triangulation yet): %.1f" % ground_m)
     return ground_m
 
+# srtm surface altitude under the camera pose
+def get_srtm_surface(image):
+    image_node = smart_node.getChild(image.name, True)
+    return image_node.getFloat("srtm_surface_m")
+
 # find srtm surface altitude under each camera pose
 def update_srtm_elevations(proj):
     for image in proj.image_list:
@@ -0,0 +1,151 @@
+# columnar track store (the matches_grouped data)
+#
+# The linked match chains (tracks) used to be kept as one big pickled
+# list of python lists:
+#
+#   [ ned, group, [img, [u, v]], [img, [u, v]], ... ]
+#
+# which takes several Gb of memory for large projects and is slow to
+# load and save.  The tracks store keeps the same data in flat numpy
+# arrays, one .npy file per column in ImageAnalysis/tracks/:
+#
+#   ned      (n, 3)  float64  track location (nan until triangulated)
+#   group    (n,)    int32    group the track belongs to (-1 = none)
+#   offsets  (n+1,)  int64    the observations of track i are the rows
+#                             offsets[i]:offsets[i+1] of obs_img/obs_uv
+#   obs_img  (m,)    int32    image index of each observation
+#   obs_uv   (m, 2)  float64  (distorted) keypoint location
+#
+# Columns are memory mapped (read only) when loaded so each step only
+# reads the columns (and pages) it actually uses.  Steps that update a
+# column build a new array and save just that column.
+
+import numpy as np
+import os
+import pickle
+
+from .logger import log
+
+columns = [ 'ned', 'group', 'offsets', 'obs_img', 'obs_uv' ]
+legacy_name = 'matches_grouped'
+
+class Tracks():
+    def __init__(self, ned=None, group=None, offsets=None, obs_img=None,
+                 obs_uv=None):
+        self.ned = ned
+        self.group = group
+        self.offsets = offsets
+        self.obs_img = obs_img
+        self.obs_uv = obs_uv
+
+    def __len__(self):
+        if self.offsets is not None:
+            return len(self.offsets) - 1
+        for name in columns:
+            if getattr(self, name) is not None:
+                return len(getattr(self, name))
+        return 0
+
+    # number of observations of each track
+    def sizes(self):
+        return np.diff(self.offsets)
+
+    # track index of each observation
+    def obs_track(self):
+        return np.repeat(np.arange(len(self)), self.sizes())
+
+def tracks_dir(analysis_dir):
+    return os.path.join(analysis_dir, 'tracks')
+
+def column_file(path, name):
+    return os.path.join(path, name + '.npy')
+
+def exists(path):
+    for name in columns:
+        if not os.path.exists(column_file(path, name)):
+            return False
+    return True
+
+# write the named columns (default: all the columns that are set).
+# Each file is written to a temp name and renamed so readers (and
+# existing memory maps of the old file) never see a partial column.
+def save(path, tracks, names=None):
+    if names is None:
+        names = [ name for name in columns
+                  if getattr(tracks, name) is not None ]
+    if not os.path.exists(path):
+        os.makedirs(path, exist_ok=True)
+    for name in names:
+        file = column_file(path, name)
+        tmp_file = file + ".%d.tmp" % os.getpid()
+        with open(tmp_file, 'wb') as fp:
+            np.save(fp, np.ascontiguousarray(getattr(tracks, name)))
+        os.replace(tmp_file, file)
+
+# load the named columns (default: all), the others are left as None.
+def load(path, names=None, mmap=True):
+    if names is None:
+        names = columns
+    tracks = Tracks()
+    for name in names:
+        mode = 'r' if mmap else None
+        setattr(tracks, name, np.load(column_file(path, name), mmap_mode=mode))
+    return tracks
+
+# build the columns from a legacy matches list
+def from_matches(matches):
+    n = len(matches)
+    sizes = [ len(match) - 2 for match in matches ]
+    offsets = np.zeros(n + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum(sizes)
+    ned = np.full((n, 3), np.nan)
+    for i, match in enumerate(matches):
+        if match[0] is not None:
+            ned[i] = match[0]
+    group = np.array([ match[1] for match in matches ], dtype=np.int32)
+    obs_img = np.array([ m[0] for match in matches for m in match[2:] ],
+                       dtype=np.int32)
+    obs_uv = np.array([ m[1] for match in matches for m in match[2:] ],
+                      dtype=np.float64).reshape(-1, 2)
+    return Tracks(ned, group, offsets, obs_img, obs_uv)
+
+# expand the columns back into a legacy matches list (for the tools
+# that still edit the match chains directly.)
+def to_matches(tracks):
+    ned_list = tracks.ned.tolist()
+    valid = ~np.any(np.isnan(tracks.ned), axis=1)
+    group_list = tracks.group.tolist()
+    offsets = tracks.offsets.tolist()
+    obs = [ [img, uv] for img, uv in zip(tracks.obs_img.tolist(),
+                                         tracks.obs_uv.tolist()) ]
+    matches = []
+    for i in range(len(tracks)):
+        ned = ned_list[i] if valid[i] else None
+        matches.append( [ned, group_list[i]] + obs[offsets[i]:offsets[i+1]] )
+    return matches
+
+# convert a legacy matches_grouped pickle into a tracks store
+def convert(matches_file, path):
+    log("Converting legacy matches file:", matches_file)
+    matches = pickle.load( open(matches_file, 'rb') )
+    tracks = from_matches(matches)
+    save(path, tracks)
+    log("Wrote %d tracks (%d observations) to: %s" %
+        (len(tracks), len(tracks.obs_img), path))
+
+# make sure the project has a tracks store, converting the legacy
+# matches_grouped file if that is all we have.  Returns the store path.
+def migrate(analysis_dir):
+    path = tracks_dir(analysis_dir)
+    legacy_file = os.path.join(analysis_dir, legacy_name)
+    if not exists(path) and os.path.exists(legacy_file):
+        convert(legacy_file, path)
+    return path
+
+# load/save the full store as a legacy matches list
+def load_matches(analysis_dir):
+    path = migrate(analysis_dir)
+    return to_matches(load(path, mmap=False))
+
+def save_matches(analysis_dir, matches):
+    save(tracks_dir(analysis_dir), from_matches(matches))
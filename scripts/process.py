@@ -20,7 +20,6 @@
 import argparse
 import numpy as np
 import os
-import pickle
 import socket                   # gethostname()
 import time
 
@@ -31,11 +30,13 @@ from lib import matcher
 from lib import match_cleanup
 from lib import optimizer
 from lib import pose
+from lib import pyramid
 from lib import project
 from lib import render_panda3d
 from lib import smart
 from lib import srtm
 from lib import state
+from lib import tracks
 
 # from the aura-props python package
 from props import getNode, PropertyNode
@@ -68,8 +69,10 @@ parser.add_argument('--surf-noctaves', default=4,
                     help='use a bigger number to detect bigger features')
 parser.add_argument('--orb-max-features', default=20000,
                     help='maximum ORB features')
-parser.add_argument('--grid-detect', default=1,
-                    help='run detect on gridded squares for (maybe) better feature distribution, 4 is a good starting value, only affects ORB method')
+parser.add_argument('--sift-max-features', type=int, default=0,
+                    help='maximum SIFT features (0 = unlimited)')
+parser.add_argument('--grid-detect', type=int, default=1,
+                    help='run detect on (overlapping) gridded tiles and keep the strongest features of each tile for better feature distribution, 4 is a good starting value')
 parser.add_argument('--star-max-size', default=16,
                     help='4, 6, 8, 11, 12, 16, 22, 23, 32, 45, 46, 64, 90, 128')
 parser.add_argument('--star-response-threshold', default=30)
@@ -83,21 +86,49 @@ parser.add_argument('--match-strategy', default='smart',
                     choices=['smart', 'traditional', 'bruteforce'])
 parser.add_argument('--match-ratio', default=0.75, type=float,
                     help='match ratio')
+parser.add_argument('--match-engine', default='flann',
+                    choices=['flann', 'cascade'],
+                    help='nearest neighbor search (cascade hashing is deterministic and faster on large feature sets, but finds slightly fewer true nearest neighbors; SIFT/SURF only)')
 parser.add_argument('--min-pairs', default=25, type=int,
                     help='minimum matches between image pairs to keep')
 parser.add_argument('--min-dist', type=float,
                     help='minimum 2d camera distance for pair comparison')
 parser.add_argument('--max-dist', type=float,
                     help='maximum 2d camera distance for pair comparison')
+parser.add_argument('--schedule', default='distance',
+                    choices=['distance', 'footprint'],
+                    help='pick pairs by camera distance or by ground footprint overlap')
+parser.add_argument('--min-overlap', type=float, default=0.1,
+                    help='minimum footprint overlap (fraction of the smaller footprint) for the footprint schedule')
+parser.add_argument('--max-range', type=float,
+                    help='maximum ground range (m) of the projected footprint corners (default 5x the height above ground)')
 parser.add_argument('--filter', default='gms',
                     choices=['gms', 'homography', 'fundamental', 'essential', 'none'])
 parser.add_argument('--min-chain-length', type=int, default=3, help='minimum match chain length (3 recommended)')
+parser.add_argument('--workers', type=int, default=1,
+                    help='number of worker processes for detection, pair matching and group optimization')
+parser.add_argument('--pyramid', action='store_true',
+                    help='build a cache of reduced resolution images (shared by detection, textures, etc.)')
+parser.add_argument('--cache-mb', type=int, default=2048,
+                    help='memory budget (Mb) for cached keypoints/descriptors and search indexes (per process)')
+parser.add_argument('--flann-cache', action='store_true',
+                    help='save the per-image flann search index in the cache directory')
+parser.add_argument('--prefetch', type=int, default=8,
+                    help='number of upcoming images/pairs to load in background threads (0 = off)')
+parser.add_argument('--rematch', action='store_true',
+                    help='ignore cached pair match results (recompute all pairs)')
 
 # for smart matching
 parser.add_argument('--ground', type=float, help="ground elevation")
+parser.add_argument('--guided', action='store_true',
+                    help='only compare descriptors near the pose/ground predicted location (smart strategy)')
+parser.add_argument('--guided-radius', type=float, default=0.05,
+                    help='guided search radius (fraction of the image diagonal)')
 
 # optimizer arguments
 parser.add_argument('--group', type=int, default=0, help='group number')
+parser.add_argument('--all-groups', action='store_true',
+                    help='optimize every group (in parallel with --workers)')
 parser.add_argument('--cam-calibration', action='store_true', help='include camera calibration in the optimization.')
 parser.add_argument('--refine', action='store_true', help='refine a previous optimization.')
 
@@ -242,13 +273,13 @@ if not state.check("STEP3a"):
     detector_node = getNode('/config/detector', True)
     detector_node.setString('detector', args.detector)
     detector_node.setString('scale', args.scale)
+    detector_node.setInt('grid_detect', args.grid_detect)
     if args.detector == 'SIFT':
-        pass
+        detector_node.setInt('sift_max_features', args.sift_max_features)
     elif args.detector == 'SURF':
         detector_node.setInt('surf_hessian_threshold', args.surf_hessian_threshold)
         detector_node.setInt('surf_noctaves', args.surf_noctaves)
     elif args.detector == 'ORB':
-        detector_node.setInt('grid_detect', args.grid_detect)
         detector_node.setInt('orb_max_features', args.orb_max_features)
     elif args.detector == 'Star':
         detector_node.setInt('star_max_size', args.star_max_size)
@@ -266,6 +297,7 @@ if not state.check("STEP3a"):
 
     matcher_node = getNode('/config/matcher', True)
     matcher_node.setFloat('match_ratio', args.match_ratio)
+    matcher_node.setString('engine', args.match_engine)
     matcher_node.setString('filter', args.filter)
     matcher_node.setInt('min_pairs', args.min_pairs)
     if args.min_dist:
@@ -273,8 +305,16 @@ if not state.check("STEP3a"):
     if args.max_dist:
         matcher_node.setFloat('max_dist', args.max_dist)
     matcher_node.setInt('min_chain_len', args.min_chain_length)
+    matcher_node.setFloat('min_overlap', args.min_overlap)
+    if args.max_range:
+        matcher_node.setFloat('max_range', args.max_range)
+    matcher_node.setInt('cache_bytes', args.cache_mb * 1024 * 1024)
+    matcher_node.setBool('flann_cache', args.flann_cache)
+    matcher_node.setInt('prefetch', args.prefetch)
     if args.ground:
         matcher_node.setFloat('ground_m', args.ground)
+    matcher_node.setBool('guided', args.guided)
+    matcher_node.setFloat('guided_radius', args.guided_radius)
     
     # save any config changes
     proj.save()
@@ -283,12 +323,23 @@ if not state.check("STEP3a"):
     K = camera.get_K()
     # print("K:", K)
 
-    log("Matching features")
-    
     # fire up the matcher
     matcher.configure()
+
+    if args.pyramid:
+        log("Building image pyramid cache")
+        pyramid.build(proj, workers=args.workers)
+
+    # detect all the features before matching so the (serial or
+    # parallel) matching starts with a warm feature cache
+    log("Detecting features")
+    matcher.detect_all_features(proj, workers=args.workers)
+
+    log("Matching features")
     matcher.find_matches(proj, K, strategy=args.match_strategy,
-                         transform=args.filter, sort=True, review=False)
+                         transform=args.filter, sort=True, review=False,
+                         workers=args.workers, rematch=args.rematch,
+                         schedule=args.schedule)
 
     feature_count = 0
     image_count = 0
@@ -299,7 +350,7 @@ if not state.check("STEP3a"):
 
     state.update("STEP3a")
 
-matches_name = os.path.join(proj.analysis_dir, "matches_grouped")
+tracks_path = tracks.tracks_dir(proj.analysis_dir)
 
 if not state.check("STEP3b"):
     proj.load_images_info()
@@ -310,32 +361,35 @@ if not state.check("STEP3b"):
     match_cleanup.check_for_pair_dups(proj)
     match_cleanup.check_for_1vn_dups(proj)
     matches_direct = match_cleanup.make_match_structure(proj)
-    matches_grouped = match_cleanup.link_matches(proj, matches_direct)
+    matches_grouped = match_cleanup.link_tracks(proj, matches_direct)
 
-    log("Writing full group chain file:", matches_name)
-    pickle.dump(matches_grouped, open(matches_name, "wb"))
+    log("Writing full group chain tracks:", tracks_path)
+    tracks.save(tracks_path, matches_grouped)
 
     state.update("STEP3b")
 
+# (projects from before the tracks store have a matches_grouped pickle)
+tracks.migrate(proj.analysis_dir)
+
 if not state.check("STEP3c"):
     proj.load_images_info()
     
     K = camera.get_K(optimized=False)
     IK = np.linalg.inv(K)
 
-    log("Loading source matches:", matches_name)
-    matches_grouped = pickle.load( open(matches_name, 'rb') )
+    log("Loading source tracks:", tracks_path)
+    matches_grouped = tracks.load(tracks_path, ['offsets', 'obs_img', 'obs_uv'])
     match_cleanup.triangulate_srtm(proj, matches_grouped)
-    log("Writing triangulated group file:", matches_name)
-    pickle.dump(matches_grouped, open(matches_name, "wb"))
+    log("Writing triangulated track locations:", tracks_path)
+    tracks.save(tracks_path, matches_grouped, ['ned'])
 
     state.update("STEP3c")
 
 if not state.check("STEP3d"):
     proj.load_images_info()
 
-    log("Loading source matches:", matches_name)
-    matches = pickle.load( open( matches_name, 'rb' ) )
+    log("Loading source tracks:", tracks_path)
+    matches = tracks.load(tracks_path, ['offsets', 'obs_img'])
     log("matched features:", len(matches))
 
     # compute the group connections within the image set.
@@ -349,15 +403,12 @@ if not state.check("STEP3d"):
     log(line)
 
     log("Counting allocated features...")
-    count = 0
-    for i, match in enumerate(matches):
-        if match[1] >= 0:
-            count += 1
+    count = np.count_nonzero(matches.group >= 0)
 
     print("Features: %d/%d" % (count, len(matches)))
     
-    log("Writing grouped tagged matches:", matches_name)
-    pickle.dump(matches, open(matches_name, "wb"))
+    log("Writing track group tags:", tracks_path)
+    tracks.save(tracks_path, matches, ['group'])
 
     state.update("STEP3d")
 
@@ -369,39 +420,46 @@ log("Step 4: Optimization (fit)", fancy=True)
 if not state.check("STEP4"):
     proj.load_images_info()
 
-    log("Loading source matches:", matches_name)
-    matches = pickle.load( open( matches_name, 'rb' ) )
-    log("matched features:", len(matches))
-
     # load the group connections within the image set
     group_list = groups.load(proj.analysis_dir)
 
-    opt = optimizer.Optimizer(args.project)
+    if args.all_groups:
+        # optimize (and refit) every group
+        optimizer.optimize_all_groups(proj, group_list, tracks_path,
+                                      workers=args.workers,
+                                      optimized=args.refine,
+                                      cam_calib=args.cam_calibration)
+    else:
+        log("Loading source tracks:", tracks_path)
+        matches = tracks.load(tracks_path)
+        log("matched features:", len(matches))
 
-    # setup the data structures
-    opt.setup( proj, group_list, args.group, matches, optimized=args.refine,
-               cam_calib=args.cam_calibration)
+        opt = optimizer.Optimizer(args.project)
 
-    # run the optimization (fit)
-    cameras, features, cam_index_map, feat_index_map, \
-        fx_opt, fy_opt, cu_opt, cv_opt, distCoeffs_opt \
-        = opt.run()
+        # setup the data structures
+        opt.setup( proj, group_list, args.group, matches, optimized=args.refine,
+                   cam_calib=args.cam_calibration)
 
-    # update camera poses
-    opt.update_camera_poses(proj)
+        # run the optimization (fit)
+        cameras, features, cam_index_map, feat_index_map, \
+            fx_opt, fy_opt, cu_opt, cv_opt, distCoeffs_opt \
+            = opt.run()
 
-    # update and save the optimized camera calibration
-    camera.set_K(fx_opt, fy_opt, cu_opt, cv_opt, optimized=True)
-    camera.set_dist_coeffs(distCoeffs_opt.tolist(), optimized=True)
-    proj.save()
+        # update camera poses
+        opt.update_camera_poses(proj)
+
+        # update and save the optimized camera calibration
+        camera.set_K(fx_opt, fy_opt, cu_opt, cv_opt, optimized=True)
+        camera.set_dist_coeffs(distCoeffs_opt.tolist(), optimized=True)
+        proj.save()
 
-    # reposition the optimized data set to best fit the original gps
-    # locations of the camera poses.
-    opt.refit(proj, matches, group_list, args.group)
+        # reposition the optimized data set to best fit the original gps
+        # locations of the camera poses.
+        opt.refit(proj, matches, group_list, args.group)
 
-    # write out the updated match_dict
-    log("Writing optimized (fitted) matches:", matches_name)
-    pickle.dump(matches, open(matches_name, 'wb'))
+        # write out the updated track locations
+        log("Writing optimized (fitted) track locations:", tracks_path)
+        tracks.save(tracks_path, matches, ['ned'])
 
     state.update("STEP4")
 
@@ -0,0 +1,83 @@
+#!/usr/bin/python3
+
+# Check the cascade hashing nearest neighbor search against an
+# exhaustive search on synthetic SIFT-like descriptors: every query
+# row must come back full (no -1 padding, even for small images where
+# many queries share a bucket with fewer than k train descriptors),
+# distances must be sorted, and the top-1 recall of noisy copies must
+# be close to exhaustive search.  Then time it against the flann
+# kdtree index the matcher uses by default.
+
+import argparse
+import cv2
+import numpy as np
+import os
+import sys
+import time
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '../scripts'))
+from lib import cascade_hash
+
+parser = argparse.ArgumentParser(description='Cascade hashing check and benchmark.')
+parser.add_argument('--features', type=int, default=3000, help='benchmark descriptor count')
+parser.add_argument('--noise', type=float, default=25.0, help='descriptor noise (of 512)')
+parser.add_argument('--seed', type=int, default=0)
+args = parser.parse_args()
+
+# sparse, non negative, clipped and normalized like SIFT
+def make_descriptors(n, rng):
+    des = np.maximum(rng.gamma(0.6, 1.0, size=(n, 128)) - 0.3, 0)
+    des = des / np.linalg.norm(des, axis=1, keepdims=True)
+    des = np.minimum(des, 0.2)
+    des = des / np.linalg.norm(des, axis=1, keepdims=True) * 512
+    return des.astype(np.float32)
+
+def noisy_copy(des, rng):
+    noisy = np.maximum(des + rng.normal(scale=args.noise, size=des.shape), 0)
+    return noisy.astype(np.float32)
+
+def exhaustive(query, train, k):
+    d2 = np.sum(query*query, axis=1)[:,np.newaxis] \
+        + np.sum(train*train, axis=1)[np.newaxis,:] \
+        - 2 * query.dot(train.T)
+    return np.argsort(d2, axis=1, kind='stable')[:,:k]
+
+rng = np.random.RandomState(args.seed)
+
+ok = True
+print('Small image check:')
+for n in [ 2, 20, 150, 1000 ]:
+    train = make_descriptors(n, rng)
+    query = noisy_copy(train, rng)
+    idx, dist = cascade_hash.knn_search(cascade_hash.HashIndex(query),
+                                        cascade_hash.HashIndex(train), 2)
+    short = np.sum(np.any(idx < 0, axis=1))
+    ordered = np.all(dist[:,0] <= dist[:,1])
+    recall = np.mean(idx[:,0] == exhaustive(query, train, 1)[:,0])
+    passed = short == 0 and ordered and recall >= 0.95
+    ok = ok and passed
+    print('  features: %4d  short rows: %d  sorted: %s  recall: %.3f  %s' %
+          (n, short, ordered, recall, 'ok' if passed else 'FAILED'))
+
+print('Benchmark:')
+train = make_descriptors(args.features, rng)
+query = noisy_copy(train, rng)
+truth = exhaustive(query, train, 1)[:,0]
+
+t0 = time.time()
+index = cv2.flann_Index(train, { 'algorithm': 1, 'trees': 5 })
+idx, dist = index.knnSearch(query, 2, params={ 'checks': 100 })
+elapsed_flann = time.time() - t0
+print('  flann    %6.3f sec  recall: %.3f' %
+      (elapsed_flann, np.mean(idx[:,0] == truth)))
+
+t0 = time.time()
+idx, dist = cascade_hash.knn_search(cascade_hash.HashIndex(query),
+                                    cascade_hash.HashIndex(train), 2)
+elapsed_cascade = time.time() - t0
+print('  cascade  %6.3f sec  recall: %.3f  speedup: %.1fx' %
+      (elapsed_cascade, np.mean(idx[:,0] == truth),
+       elapsed_flann / elapsed_cascade))
+
+if not ok:
+    sys.exit(1)
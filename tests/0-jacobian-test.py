@@ -0,0 +1,200 @@
+#!/usr/bin/python3
+
+# Check the optimizer residuals (Optimizer.fun()) against
+# cv2.projectPoints() and the analytic optimizer jacobian
+# (Optimizer.jac()) against central finite differences of the residual
+# function on a small synthetic survey, then time it against the
+# finite difference jacobian scipy builds from the sparsity pattern on
+# a larger one.
+#
+# The synthetic survey is a grid of nadir looking cameras over a
+# slightly bumpy patch of ground, every ground point is observed by
+# each camera that sees it (with a bit of pixel noise), and the
+# starting camera poses and points are perturbed from the truth.
+
+import argparse
+import cv2
+import numpy as np
+import os
+import sys
+import time
+from scipy.optimize import least_squares
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '../scripts'))
+from lib import optimizer
+
+parser = argparse.ArgumentParser(description='Optimizer jacobian check and benchmark.')
+parser.add_argument('--grid', type=int, default=12, help='benchmark camera grid size (grid x grid cameras)')
+parser.add_argument('--points', type=int, default=20000, help='benchmark ground points')
+parser.add_argument('--seed', type=int, default=0)
+args = parser.parse_args()
+
+width = 1000
+height = 750
+K = np.array( [[800.0, 0, 500.0],
+               [0, 800.0, 375.0],
+               [0, 0, 1]] )
+dist = np.array([-0.08, 0.03, 0.0005, -0.0003, 0.002])
+calib = np.hstack( (K[0,0], K[0,2], K[1,2], dist) )
+
+# build an optimizer with the observations of a synthetic survey
+# (bypassing setup(), which needs a project.)  Returns the optimizer
+# and the starting parameter vector.
+def make_problem(grid, n_points, cam_calib, rng):
+    opt = optimizer.Optimizer(None)
+    opt.optimize_calib = 'global' if cam_calib else 'none'
+    opt.K = K
+    opt.distCoeffs = dist
+
+    # cameras at 100m, 40m apart, looking straight down (camera x =
+    # east, y = south, z = down) with a few degrees of attitude error
+    R0 = np.array( [[0, 1, 0],
+                    [-1, 0, 0],
+                    [0, 0, 1]], dtype=float )
+    cams = []
+    for i in range(grid):
+        for j in range(grid):
+            ned = np.array([i * 40.0, j * 40.0, -100.0])
+            Rpert, jac = cv2.Rodrigues(rng.normal(scale=0.03, size=3))
+            R = Rpert.dot(R0)
+            rvec, jac = cv2.Rodrigues(R)
+            cams.append( np.hstack((rvec.ravel(), -R.dot(ned))) )
+    cams = np.array(cams)
+    n_cameras = len(cams)
+
+    span = (grid - 1) * 40.0
+    points = np.column_stack( (rng.uniform(-40, span + 40, n_points),
+                               rng.uniform(-40, span + 40, n_points),
+                               rng.normal(scale=3.0, size=n_points)) )
+
+    # observe each point from every camera that sees it
+    camera_indices = []
+    point_indices = []
+    uvs = []
+    for c in range(n_cameras):
+        uv, jac = cv2.projectPoints(points, cams[c,:3], cams[c,3:], K, dist)
+        uv = uv.reshape(-1, 2) + rng.normal(scale=0.5, size=(n_points, 2))
+        visible = np.flatnonzero( (uv[:,0] >= 0) & (uv[:,0] < width) &
+                                  (uv[:,1] >= 0) & (uv[:,1] < height) )
+        camera_indices.append(np.full(len(visible), c))
+        point_indices.append(visible)
+        uvs.append(uv[visible])
+
+    # drop the points with less than two observations
+    point_indices = np.concatenate(point_indices)
+    counts = np.bincount(point_indices, minlength=n_points)
+    used = np.flatnonzero(counts >= 2)
+    remap = np.full(n_points, -1)
+    remap[used] = np.arange(len(used))
+    camera_indices = np.concatenate(camera_indices)
+    uvs = np.concatenate(uvs)
+    keep = remap[point_indices] >= 0
+    opt.camera_indices = camera_indices[keep]
+    opt.point_indices = remap[point_indices[keep]]
+    opt.points_2d = uvs[keep]
+    opt.n_cameras = n_cameras
+    opt.n_points = len(used)
+    opt.alloc_buffers()
+
+    # perturbed starting point
+    x0 = np.hstack( (cams.ravel() + rng.normal(scale=0.01, size=cams.size),
+                     points[used].ravel() + rng.normal(scale=0.5, size=len(used) * 3)) )
+    if cam_calib:
+        x0 = np.hstack( (x0, calib * (1 + rng.normal(scale=0.001, size=8))) )
+    return opt, x0
+
+def residuals(opt, x):
+    return opt.fun(x, opt.n_cameras, opt.n_points)
+
+# the same residuals with cv2.projectPoints(), one camera at a time
+def cv2_residuals(opt, x):
+    n_cameras = opt.n_cameras
+    n_points = opt.n_points
+    cams = x[:n_cameras * 6].reshape(n_cameras, 6)
+    points = x[n_cameras * 6:n_cameras * 6 + n_points * 3].reshape(n_points, 3)
+    K, dist = opt.get_calib(x, n_cameras, n_points)
+    error = np.empty((len(opt.camera_indices), 2))
+    for c in range(n_cameras):
+        obs = np.flatnonzero(opt.camera_indices == c)
+        if not len(obs):
+            continue
+        uv, jac = cv2.projectPoints(points[opt.point_indices[obs]],
+                                    cams[c,:3], cams[c,3:], K, dist)
+        error[obs] = opt.points_2d[obs] - uv.reshape(-1, 2)
+    return error.ravel()
+
+# central differences, one parameter at a time
+def numeric_jac(opt, x):
+    J = np.zeros((2 * len(opt.camera_indices), len(x)))
+    for j in range(len(x)):
+        h = 1e-6 * max(1.0, abs(x[j]))
+        xp = x.copy()
+        xp[j] += h
+        xm = x.copy()
+        xm[j] -= h
+        J[:,j] = (residuals(opt, xp) - residuals(opt, xm)) / (2 * h)
+    return J
+
+rng = np.random.RandomState(args.seed)
+
+ok = True
+print('Residual check:')
+for cam_calib in [ False, True ]:
+    opt, x0 = make_problem(3, 300, cam_calib, rng)
+    err = np.max(np.abs(residuals(opt, x0) - cv2_residuals(opt, x0)))
+    passed = err < 1e-6
+    ok = ok and passed
+    print('  global calib: %s  max difference from cv2.projectPoints(): %.2e px  %s' %
+          (cam_calib, err, 'ok' if passed else 'FAILED'))
+
+print('Gradient check:')
+for cam_calib in [ False, True ]:
+    opt, x0 = make_problem(3, 300, cam_calib, rng)
+    Ja = opt.jac(x0, opt.n_cameras, opt.n_points)
+    Jn = numeric_jac(opt, x0)
+    A = opt.bundle_adjustment_sparsity(opt.n_cameras, opt.n_points,
+                                       opt.camera_indices, opt.point_indices)
+    A = A.tocsr()
+    same_layout = np.array_equal(Ja.indptr, A.indptr) \
+        and np.array_equal(Ja.indices, A.indices)
+    # the finite differences must be zero outside the pattern
+    pattern = (A.toarray() != 0)
+    outside = np.max(np.abs(Jn[~pattern])) if np.any(~pattern) else 0.0
+    err = np.abs(Ja.toarray() - Jn)
+    scale = np.maximum(1.0, np.abs(Jn))
+    rel = np.max(err / scale)
+    passed = same_layout and rel < 1e-4 and outside == 0.0
+    ok = ok and passed
+    print('  global calib: %s  jacobian %d x %d  same layout: %s  max error: %.2e  %s' %
+          (cam_calib, Ja.shape[0], Ja.shape[1], same_layout, rel,
+           'ok' if passed else 'FAILED'))
+
+print('Benchmark:')
+for cam_calib in [ False, True ]:
+    opt, x0 = make_problem(args.grid, args.points, cam_calib, rng)
+    A = opt.bundle_adjustment_sparsity(opt.n_cameras, opt.n_points,
+                                       opt.camera_indices, opt.point_indices)
+    print('  global calib: %s  cameras: %d  points: %d  observations: %d' %
+          (cam_calib, opt.n_cameras, opt.n_points, len(opt.camera_indices)))
+
+    # full solves, scipy's grouped finite differences (from the
+    # sparsity pattern) vs analytic
+    results = {}
+    for name, jac, sparsity in [ ('finite differences', '2-point', A),
+                                 ('analytic', opt.jac, None) ]:
+        opt.last_mre = None
+        t0 = time.time()
+        res = least_squares(opt.fun, x0, jac=jac, jac_sparsity=sparsity,
+                            method='trf', loss='linear', ftol=opt.ftol,
+                            x_scale='jac',
+                            args=(opt.n_cameras, opt.n_points))
+        elapsed = time.time() - t0
+        results[name] = elapsed / res.njev
+        print('    %-18s  %6.2f sec  %3d iterations  %.3f sec/iteration  mre: %.3f' %
+              (name, elapsed, res.njev, elapsed / res.njev,
+               np.mean(np.abs(res.fun))))
+    print('    per iteration speedup: %.1fx' %
+          (results['finite differences'] / results['analytic']))
+
+if not ok:
+    sys.exit(1)